@@ -0,0 +1,337 @@
+import json
+import os
+import platform
+import shutil
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import typer
+
+app = typer.Typer()
+
+# whether a higher value of each metric is better, used to compare reports
+HIGHER_IS_BETTER = {
+    "feature_store_write_vectors_per_s": True,
+    "feature_store_read_vectors_per_s": True,
+    "feature_bytes_per_vector": False,
+    "fit_seconds": False,
+    "hashes_per_s": True,
+    "hash_bytes_per_document": False,
+    "index_docs_per_s": True,
+    "query_p50_ms": False,
+    "query_p99_ms": False,
+    "recall_at_k": True,
+    "download_images_per_s": True,
+    "extract_features_per_s": True,
+}
+STAGES = ["store", "fit", "hash", "index", "query", "download", "extract"]
+
+
+def make_corpus(
+    n_vectors: int, dim: int, n_centres: int, seed: int
+) -> np.ndarray:
+    """
+    Vectors scattered around random centres, so that nearest neighbours are
+    meaningful and recall can be measured
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(n_centres, dim)).astype(np.float32)
+    assignments = rng.integers(0, n_centres, n_vectors)
+    noise = rng.normal(scale=0.5, size=(n_vectors, dim)).astype(np.float32)
+    return np.abs(centres[assignments] + noise)
+
+
+def brute_force_neighbours(
+    corpus: np.ndarray, query_indices: np.ndarray, k: int
+) -> List[set]:
+    normalised = corpus / np.linalg.norm(corpus, axis=1, keepdims=True)
+    similarities = normalised[query_indices] @ normalised.T
+    similarities[np.arange(len(query_indices)), query_indices] = -np.inf
+    top_k = np.argpartition(-similarities, k, axis=1)[:, :k]
+    return [set(map(str, row)) for row in top_k]
+
+
+def timed(function: Callable):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def compare(results: Dict[str, float], baseline_path: Path):
+    baseline = json.loads(baseline_path.read_text())["results"]
+    typer.echo(f"{'metric':<36}{'baseline':>14}{'current':>14}{'change':>10}")
+    for metric, value in results.items():
+        if metric not in baseline or not baseline[metric]:
+            continue
+        change = (value - baseline[metric]) / baseline[metric] * 100
+        better = (change > 0) == HIGHER_IS_BETTER.get(metric, True)
+        typer.echo(
+            f"{metric:<36}{baseline[metric]:>14.3f}{value:>14.3f}"
+            f"{change:>+9.1f}% {'better' if better else 'worse'}"
+        )
+
+
+@app.command()
+def main(
+    n_vectors: int = typer.Option(20000, help="Size of the synthetic corpus"),
+    dim: int = typer.Option(512, help="Dimensionality of the feature vectors"),
+    n_centres: int = typer.Option(
+        200, help="Number of clusters the synthetic vectors are drawn around"
+    ),
+    n_training_vectors: int = typer.Option(
+        5000, help="Number of vectors used to fit the model"
+    ),
+    n_groups: int = typer.Option(32, help="Number of LSH groups"),
+    n_clusters: int = typer.Option(64, help="Number of clusters per group"),
+    encoding: str = typer.Option(
+        "packed", help="Hash token encoding: text, packed or band"
+    ),
+    band_size: int = typer.Option(
+        2, help="Number of groups in each band, with the band encoding"
+    ),
+    n_queries: int = typer.Option(200, help="Number of search queries"),
+    k: int = typer.Option(10, help="Number of neighbours to evaluate"),
+    n_candidates: int = typer.Option(100, help="Candidates to re-rank"),
+    n_probes: int = typer.Option(
+        1, help="Number of nearest buckets to probe in each group"
+    ),
+    minimum_should_match: str = typer.Option(
+        "10%", help="Minimum number of matching hashes for a candidate"
+    ),
+    feature_dtype: str = typer.Option(
+        "float32", help="Feature storage dtype: float32, float16 or int8"
+    ),
+    reduction: str = typer.Option(
+        "none", help="Dimensionality reduction: none, pca or random"
+    ),
+    n_components: int = typer.Option(
+        128, help="Number of dimensions to reduce features to"
+    ),
+    n_images: int = typer.Option(500, help="Images to download and extract"),
+    backbone: str = typer.Option(
+        "vgg16", help="Feature extractor backbone, for the extract stage"
+    ),
+    extractor_backend: str = typer.Option(
+        "eager", help="Feature extractor backend, for the extract stage"
+    ),
+    stages: List[str] = typer.Option(
+        STAGES, "--stage", help="Stages to benchmark"
+    ),
+    storage: str = typer.Option(
+        "local",
+        help="Storage environment: local, or s3 against a local moto server",
+    ),
+    seed: int = typer.Option(0, help="Random seed"),
+    output: Path = typer.Option(
+        Path("/data/benchmarks/report.json"), help="Where to write the report"
+    ),
+    baseline: Optional[Path] = typer.Option(
+        None, help="A previous report to compare against"
+    ),
+):
+    if storage == "s3":
+        from moto.server import ThreadedMotoServer
+
+        moto_server = ThreadedMotoServer(port=0)
+        moto_server.start()
+        host, port = moto_server.get_host_and_port()
+        os.environ["AWS_S3_ENDPOINT_URL"] = f"http://{host}:{port}"
+        os.environ["AWS_S3_BUCKET_ID"] = "benchmark"
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ["STORAGE_ENVIRONMENT"] = storage
+
+    # src reads its configuration from the environment when it's imported
+    from src import io
+    from src.download import download_images
+    from src.feature_store import FeatureStore, compress_feature_store
+    from src.indexing import bulk_index, get_elasticsearch_client
+    from src.log import get_logger
+    from src.model import LSHModel
+    from src.search import SearchEngine
+    from stand_ins import ElasticsearchStandIn, ImageServer
+
+    log = get_logger()
+    if storage == "s3":
+        io.get_s3_client().create_bucket(Bucket="benchmark")
+
+    results = {}
+    corpus = make_corpus(n_vectors, dim, n_centres, seed)
+    ids = [str(i) for i in range(n_vectors)]
+    store_name = f"benchmark-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    if storage == "local":
+        shutil.rmtree(io.data_dir / store_name, ignore_errors=True)
+
+    log.info(f"Writing {n_vectors} vectors to the feature store")
+    feature_store = FeatureStore(store_name, dtype=feature_dtype)
+    _, seconds = timed(
+        lambda: (feature_store.append_many(ids, corpus), feature_store.close())
+    )
+    if "store" in stages:
+        results["feature_store_write_vectors_per_s"] = n_vectors / seconds
+        reader = FeatureStore(store_name)
+        sample = list(np.random.default_rng(seed).choice(ids, 1000))
+        _, seconds = timed(lambda: reader.get_many(sample))
+        results["feature_store_read_vectors_per_s"] = len(sample) / seconds
+        results["feature_bytes_per_vector"] = reader.row_bytes
+
+    log.info("Fitting model")
+    model = LSHModel(
+        n_groups=n_groups,
+        n_clusters=n_clusters,
+        encoding=encoding,
+        band_size=band_size,
+    )
+    training_indices = np.random.default_rng(seed).choice(
+        n_vectors, min(n_training_vectors, n_vectors), replace=False
+    )
+    training_features = corpus[training_indices]
+
+    def fit():
+        if reduction != "none":
+            model.fit_reduction(
+                training_features, reduction, n_components, seed=seed
+            )
+        model.fit(training_features, n_jobs=-1, seed=seed)
+
+    _, seconds = timed(fit)
+    if "fit" in stages:
+        results["fit_seconds"] = seconds
+
+    log.info("Hashing corpus")
+    hashes, seconds = timed(lambda: model.predict_batch(corpus))
+    if "hash" in stages:
+        results["hashes_per_s"] = n_vectors / seconds
+        results["hash_bytes_per_document"] = float(
+            np.mean([sum(map(len, tokens)) for tokens in hashes])
+        )
+
+    if "index" in stages or "query" in stages:
+        log.info("Indexing hashes")
+        es_stand_in = ElasticsearchStandIn()
+        es = get_elasticsearch_client(endpoint=es_stand_in.url)
+        summary = bulk_index(
+            es,
+            "benchmark",
+            (
+                (document_id, {"lsh-hash": document_hashes})
+                for document_id, document_hashes in zip(ids, hashes)
+            ),
+        )
+        results["index_docs_per_s"] = summary.docs_per_second
+
+    if "query" in stages:
+        query_store = FeatureStore(store_name)
+        if reduction != "none":
+            # re-rank against vectors in the reduced space, as a compressed
+            # store would hold them
+            query_store = compress_feature_store(
+                FeatureStore(f"{store_name}-reduced", dtype=feature_dtype),
+                query_store,
+                model,
+            )
+            results["feature_bytes_per_vector"] = query_store.row_bytes
+
+        log.info(f"Running {n_queries} queries")
+        engine = SearchEngine(
+            es,
+            "benchmark",
+            model,
+            query_store,
+            n_candidates=n_candidates,
+            minimum_should_match=minimum_should_match,
+            k=k,
+            n_probes=n_probes,
+        )
+        query_indices = np.random.default_rng(seed + 1).choice(
+            n_vectors, n_queries, replace=False
+        )
+        truth = brute_force_neighbours(corpus, query_indices, k)
+        latencies, recalls = [], []
+        for query_index, true_neighbours in zip(query_indices, truth):
+            response, seconds = timed(
+                lambda: engine.search(image_id=str(query_index))
+            )
+            latencies.append(seconds * 1000)
+            found = {result.id for result in response.results}
+            recalls.append(len(found & true_neighbours) / k)
+        results["query_p50_ms"] = float(np.percentile(latencies, 50))
+        results["query_p99_ms"] = float(np.percentile(latencies, 99))
+        results["recall_at_k"] = float(np.mean(recalls))
+
+    if "download" in stages:
+        log.info(f"Downloading {n_images} images")
+        image_server = ImageServer(seed=seed)
+        summary = download_images(
+            (
+                {"URL": f"{image_server.url}/{i}.jpg", "hash": str(i)}
+                for i in range(n_images)
+            ),
+            save=lambda image, filename: None,
+        )
+        results["download_images_per_s"] = summary.images_per_second
+
+    if "extract" in stages:
+        try:
+            import torch
+            from src.extraction import extract_all, load_feature_extractor
+        except ImportError:
+            log.warning("torch isn't installed, skipping the extract stage")
+        else:
+            log.info(f"Extracting features from {n_images} images")
+            extractor = load_feature_extractor(backbone, extractor_backend)
+            images = torch.rand(n_images, 3, 224, 224)
+            extractor(images[:1])
+            _, seconds = timed(lambda: extract_all(extractor, images))
+            results["extract_features_per_s"] = n_images / seconds
+
+    if storage == "local":
+        for name in [store_name, f"{store_name}-reduced"]:
+            shutil.rmtree(io.data_dir / name, ignore_errors=True)
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+        },
+        "config": {
+            "n_vectors": n_vectors,
+            "dim": dim,
+            "n_centres": n_centres,
+            "n_training_vectors": n_training_vectors,
+            "n_groups": n_groups,
+            "n_clusters": n_clusters,
+            "encoding": encoding,
+            "band_size": band_size,
+            "n_queries": n_queries,
+            "k": k,
+            "n_candidates": n_candidates,
+            "n_probes": n_probes,
+            "minimum_should_match": minimum_should_match,
+            "feature_dtype": feature_dtype,
+            "reduction": reduction,
+            "n_components": n_components,
+            "n_images": n_images,
+            "backbone": backbone,
+            "extractor_backend": extractor_backend,
+            "storage": storage,
+            "seed": seed,
+        },
+        "results": results,
+    }
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    log.info(f"Wrote report to {output}")
+    typer.echo(json.dumps(results, indent=2))
+    if baseline is not None:
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    app()
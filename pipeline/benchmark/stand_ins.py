@@ -0,0 +1,205 @@
+import json
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Optional
+from urllib.parse import urlparse
+
+import numpy as np
+from PIL import Image
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def start_server(handler_class) -> Server:
+    server = Server(("127.0.0.1", 0), handler_class)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def send_json(self, data, status: int = 200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ElasticsearchStandIn:
+    """
+    An in-memory stand-in for the parts of the elasticsearch API which the
+    pipeline uses: index creation, bulk indexing, mget, and bool queries of
+    constant-score term clauses with minimum_should_match.
+
+    Failures can be injected to test retries. `rejections` maps a document
+    id to the statuses which the next bulk requests containing it reject it
+    with, and `failed_requests` holds the statuses which the next bulk
+    requests fail outright with.
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.postings = defaultdict(set)
+        self.rejections = defaultdict(list)
+        self.failed_requests = []
+        self.bulk_requests = 0
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(JSONHandler):
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_PUT(self):
+                self.read_body()
+                self.send_json({"acknowledged": True})
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                body = self.read_body()
+                if path.endswith("/_bulk"):
+                    status = stand_in.fail_request()
+                    if status:
+                        self.send_json({"error": "injected failure"}, status)
+                    else:
+                        self.send_json(stand_in.bulk(body))
+                elif path.endswith("/_search"):
+                    self.send_json(stand_in.search(json.loads(body)))
+                elif path.endswith("/_mget"):
+                    self.send_json(stand_in.mget(json.loads(body)))
+                else:
+                    self.send_json({"acknowledged": True})
+
+        self.server = start_server(Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def fail_request(self) -> Optional[int]:
+        """The status to fail the next bulk request with, if any"""
+        with self.lock:
+            self.bulk_requests += 1
+            if self.failed_requests:
+                return self.failed_requests.pop(0)
+            return None
+
+    def bulk(self, body: bytes) -> dict:
+        lines = body.decode("utf-8").splitlines()
+        items = []
+        errors = False
+        with self.lock:
+            for action, document in zip(lines[::2], lines[1::2]):
+                document_id = json.loads(action)["index"]["_id"]
+                if self.rejections.get(document_id):
+                    status = self.rejections[document_id].pop(0)
+                    error = {"type": "injected", "reason": f"status {status}"}
+                    items.append(
+                        {
+                            "index": {
+                                "_id": document_id,
+                                "status": status,
+                                "error": error,
+                            }
+                        }
+                    )
+                    errors = True
+                    continue
+                document = json.loads(document)
+                self.documents[document_id] = document
+                for term in document["lsh-hash"]:
+                    self.postings[term].add(document_id)
+                items.append({"index": {"_id": document_id, "status": 201}})
+        return {"errors": errors, "items": items}
+
+    def mget(self, body: dict) -> dict:
+        return {
+            "docs": [
+                {"_id": document_id, "found": document_id in self.documents}
+                for document_id in body["ids"]
+            ]
+        }
+
+    def search(self, body: dict) -> dict:
+        query = body["query"]["bool"]
+        terms = [
+            (
+                clause["constant_score"]["filter"]["term"]["lsh-hash"],
+                clause["constant_score"].get("boost", 1.0),
+            )
+            for clause in query["should"]
+        ]
+        minimum = query.get("minimum_should_match", 1)
+        if isinstance(minimum, str) and minimum.endswith("%"):
+            minimum = int(len(terms) * float(minimum[:-1]) / 100)
+        minimum = max(int(minimum), 1)
+
+        scores = defaultdict(float)
+        matches = defaultdict(int)
+        for term, boost in terms:
+            for document_id in self.postings.get(term, ()):
+                scores[document_id] += boost
+                matches[document_id] += 1
+        hits = sorted(
+            (
+                (score, document_id)
+                for document_id, score in scores.items()
+                if matches[document_id] >= minimum
+            ),
+            reverse=True,
+        )[: body.get("size", 10)]
+        return {
+            "hits": {
+                "hits": [
+                    {
+                        "_id": document_id,
+                        "_score": score,
+                        "_source": {
+                            "description": self.documents[document_id].get(
+                                "description"
+                            )
+                        },
+                    }
+                    for score, document_id in hits
+                ]
+            }
+        }
+
+
+class ImageServer:
+    """Serves the same synthetic JPEG at every path"""
+
+    def __init__(self, size: int = 512, seed: int = 0):
+        pixels = np.random.default_rng(seed).integers(
+            0, 255, (size, size, 3), dtype=np.uint8
+        )
+        image_bytes = BytesIO()
+        Image.fromarray(pixels).save(image_bytes, format="JPEG")
+        image = image_bytes.getvalue()
+
+        class Handler(JSONHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(image)))
+                self.end_headers()
+                self.wfile.write(image)
+
+        self.server = start_server(Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
@@ -0,0 +1,48 @@
+import os
+
+from src.duplicates import default_name, find_duplicates
+from src.feature_store import FeatureStore
+from src.io import get_latest_model_name, load_model, save_json
+from src.log import get_logger
+from src.metrics import metrics
+
+log = get_logger()
+
+band_size = int(os.environ.get("DUPLICATE_BAND_SIZE", 8))
+min_shared_bands = int(os.environ.get("DUPLICATE_MIN_SHARED_BANDS", 1))
+max_distance = float(os.environ.get("DUPLICATE_MAX_DISTANCE", 0.05))
+max_bucket_size = int(os.environ.get("DUPLICATE_MAX_BUCKET_SIZE", 256))
+hash_batch_size = int(os.environ.get("HASH_BATCH_SIZE", 1024))
+
+model_name = os.environ.get("MODEL_NAME") or get_latest_model_name()
+log.info(f"Loading model {model_name}")
+model = load_model(model_name)
+
+feature_store = FeatureStore()
+log.info(f"Finding near-duplicates among {len(feature_store)} vectors")
+metrics.start_reporting()
+clusters = find_duplicates(
+    feature_store,
+    model,
+    band_size=band_size,
+    min_shared_bands=min_shared_bands,
+    max_distance=max_distance,
+    max_bucket_size=max_bucket_size,
+    batch_size=hash_batch_size,
+)
+
+n_duplicates = sum(len(cluster) - 1 for cluster in clusters)
+log.info(
+    f"Found {len(clusters)} clusters of near-duplicates, which {n_duplicates} "
+    "images could be collapsed into"
+)
+save_json(
+    {
+        "model_name": model_name,
+        "band_size": band_size,
+        "min_shared_bands": min_shared_bands,
+        "max_distance": max_distance,
+        "clusters": clusters,
+    },
+    default_name,
+)
@@ -1,49 +1,102 @@
-from io import BytesIO
+import os
 
-import requests
 from datasets import load_dataset
-from PIL import Image, UnidentifiedImageError
-from src.io import save_image, save_json, yield_image_filenames
+from src.download import download_images
+from src.descriptions import DescriptionStore, lookup_batch_size
+from src.io import get_manifest, save_image
 from src.log import get_logger
+from src.metrics import metrics
+from src.partition import Checkpoint, StreamPosition, get_partition
 
 log = get_logger()
 
-log.info("Loading dataset")
+concurrency = int(os.environ.get("DOWNLOAD_CONCURRENCY", 64))
+timeout = float(os.environ.get("DOWNLOAD_TIMEOUT", 5))
+requests_per_host_per_second = float(
+    os.environ.get("REQUESTS_PER_HOST_PER_SECOND", 10)
+)
+
+log.info("Streaming dataset")
 dataset = load_dataset(
     "ChristophSchuhmann/improved_aesthetics_6.5plus",
     split="train",
-    keep_in_memory=True,
+    streaming=True,
 )
 
-log.info("Saving descriptions")
-descriptions = {row["hash"]: row["TEXT"] for row in dataset}
-save_json(descriptions, "descriptions")
+# each partition downloads the rows whose hash falls in it, and writes their
+# descriptions to its own segments of the description store
+partition = get_partition()
+checkpoint = Checkpoint("get-images", partition)
+description_store = DescriptionStore(
+    writer=partition.name if partition.partitioned else None
+)
 
-log.info("Downloading images")
-existing_images = set(yield_image_filenames())
-for i, row in enumerate(dataset):
-    if str(row["hash"]) in existing_images:
-        log.info(
-            f"Skipping row {i}/{len(dataset)} ({i/len(dataset)*100:.2f}%)")
-        continue
-    else:
-        log.info(
-            f"Processing row {i}/{len(dataset)} ({i/len(dataset)*100:.2f}%)"
-        )
-        try:
-            log.debug(f"Downloading {row['URL']}")
-            image_response = requests.get(row["URL"], timeout=5)
-            image = Image.open(BytesIO(image_response.content))
-            image = image.convert("RGB")
-            image.thumbnail((256, 256))
-
-            save_image(image=image, filename=row["hash"])
-            descriptions[row["hash"]] = row["TEXT"]
-
-        except (
-            requests.RequestException,
-            UnidentifiedImageError,
-            OSError,
-        ) as e:
-            log.error(f"Error downloading image from {row['URL']}: {e}")
+# the checkpoint records how many rows of the stream have been finished with,
+# and a restarted task skips straight past them
+start_position = checkpoint.state.get("position", 0)
+if start_position:
+    log.info(f"Skipping the first {start_position} rows of the dataset")
+    dataset = dataset.skip(start_position)
+
+existing_images = get_manifest("images")
+stream_position = StreamPosition(start_position)
+# the descriptions of images which were already downloaded should have been
+# saved along with them, unless the task stopped before flushing them. They
+# are checked in batches, rather than with a lookup for every row
+unchecked_descriptions = {}
+
+
+def check_descriptions():
+    described = description_store.get_many(unchecked_descriptions)
+    description_store.add_many(
+        (image_id, description)
+        for image_id, description in unchecked_descriptions.items()
+        if image_id not in described
+    )
+    unchecked_descriptions.clear()
+
+
+def save_checkpoint(**state):
+    # descriptions and manifest entries are flushed first, so that the
+    # checkpoint never points past rows whose descriptions or images are
+    # missing. The manifest's atexit flush doesn't run when the task is
+    # killed
+    check_descriptions()
+    checkpoint.save_position(
+        stream_position, flush=(description_store, existing_images), **state
+    )
+
+
+def yield_new_rows():
+    for position, row in enumerate(dataset, start=start_position):
+        if checkpoint.due():
+            save_checkpoint()
+        if str(row["hash"]) not in partition:
+            stream_position.skip(position)
+            continue
+        if str(row["hash"]) in existing_images:
+            unchecked_descriptions[str(row["hash"])] = row["TEXT"]
+            if len(unchecked_descriptions) >= lookup_batch_size:
+                check_descriptions()
+            metrics.add("skip")
+            stream_position.skip(position)
             continue
+        description_store.add(row["hash"], row["TEXT"])
+        stream_position.start(position)
+        yield {**row, "position": position}
+
+
+log.info("Downloading images")
+metrics.start_reporting()
+summary = download_images(
+    yield_new_rows(),
+    save=lambda image, filename: save_image(image=image, filename=filename),
+    concurrency=concurrency,
+    requests_per_host_per_second=requests_per_host_per_second,
+    timeout=timeout,
+    on_done=lambda row: stream_position.finish(row["position"]),
+)
+log.info(str(summary))
+
+log.info("Saving descriptions")
+save_checkpoint(complete=True)
@@ -1,53 +1,126 @@
+import os
+import time
+from contextlib import nullcontext
+
+import numpy as np
 import torch
-from src.io import (
-    count_images,
-    load_image,
-    save_features,
-    yield_image_filenames,
-    yield_feature_filenames,
+from src.extraction import (
+    from_pixels,
+    load_feature_extractor,
+    load_pixel_cache,
+    pixel_shape,
+    to_pixels,
 )
+from src.feature_store import FeatureStore
+from src.io import load_image, reset_s3_client, yield_image_filenames
 from src.log import get_logger
-from torchvision import transforms
-from torchvision.models.vgg import vgg16
+from src.metrics import metrics
+from src.partition import checkpoint_interval, get_partition
+from torch.utils.data import DataLoader, Dataset
 
 log = get_logger()
 
-transform_pipeline = transforms.Compose(
-    [
-        transforms.Resize((224, 224)),
-        transforms.Lambda(lambda image: image.convert("RGB")),
-        transforms.ToTensor(),
-        transforms.Normalize(
-            mean=[0.485, 0.456, 0.406],  # imagenet_mean
-            std=[0.229, 0.224, 0.225],  # imagenet_std
-        ),
-    ]
-)
+batch_size = int(os.environ.get("FEATURE_BATCH_SIZE", 32))
+n_workers = int(os.environ.get("FEATURE_WORKERS", os.cpu_count() or 1))
+if os.environ.get("TORCH_THREADS"):
+    torch.set_num_threads(int(os.environ.get("TORCH_THREADS")))
+if os.environ.get("TORCH_INTEROP_THREADS"):
+    torch.set_num_interop_threads(int(os.environ.get("TORCH_INTEROP_THREADS")))
 
-torch.hub.set_dir("/data/models")
-feature_extractor = vgg16(progress=False).eval()
-feature_extractor.classifier = feature_extractor.classifier[:4]
-
-existing_features = set(yield_feature_filenames())
-total_images = count_images()
-for i, image_filename in enumerate(yield_image_filenames()):
-    if image_filename in existing_features:
-        log.info(
-            f"Skipping image {i + 1}/{total_images} "
-            f"({i/total_images*100:.2f}%)"
-        )
-        continue
-    else:
-        log.info(
-            f"Processing image {i + 1}/{total_images} "
-            f"({i/total_images*100:.2f}%)"
-        )
+
+class ImageDataset(Dataset):
+    def __init__(self, filenames, pixel_cache=None):
+        self.filenames = filenames
+        self.pixel_cache = pixel_cache
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, index):
+        filename = self.filenames[index]
         try:
-            image = load_image(image_filename)
-            image_tensor = transform_pipeline(image).unsqueeze(0)
-            features = feature_extractor(image_tensor)
-            features = features.to_dense().detach().numpy().flatten()
+            if self.pixel_cache is not None and filename in self.pixel_cache:
+                pixels = np.array(self.pixel_cache.get(filename))
+                return filename, torch.from_numpy(pixels.reshape(pixel_shape))
+            return filename, to_pixels(load_image(filename))
         except Exception as e:
-            log.error(f"Error processing image {image_filename}: {e}")
+            log.error(f"Error processing image {filename}: {e}")
+            return None
+
+
+def collate(items):
+    items = [item for item in items if item is not None]
+    if not items:
+        return [], None
+    filenames, pixels = zip(*items)
+    return list(filenames), torch.stack(pixels)
+
+
+def init_worker(worker_id):
+    reset_s3_client()
+
+
+feature_extractor = load_feature_extractor()
+
+# each partition extracts features for the images whose ids fall in it, and
+# writes its own shards. Anything already in the store is skipped, so the
+# store doubles as the checkpoint of a restarted task
+partition = get_partition()
+writer = partition.name if partition.partitioned else None
+feature_store = FeatureStore(writer=writer)
+# images are decoded and resized once, and later runs with other backbones
+# read their pixels back from the cache
+pixel_cache = load_pixel_cache(writer=writer)
+filenames = []
+n_skipped = 0
+for filename in partition.filter(yield_image_filenames()):
+    if filename in feature_store:
+        n_skipped += 1
+    else:
+        filenames.append(filename)
+log.info(
+    f"Extracting features for {len(filenames)} images in partition "
+    f"{partition.name}, skipping {n_skipped} which have already been "
+    "processed"
+)
+
+loader = DataLoader(
+    ImageDataset(filenames, pixel_cache),
+    batch_size=batch_size,
+    num_workers=n_workers,
+    collate_fn=collate,
+    worker_init_fn=init_worker,
+)
 
-        save_features(features, image_filename)
+# fetching and decoding happen in the loader's worker processes, so the main
+# process can only see how long it spends waiting for each batch
+metrics.set_total("inference", len(filenames))
+metrics.start_reporting()
+batches = iter(loader)
+last_flush = time.monotonic()
+with feature_store, pixel_cache or nullcontext():
+    while True:
+        with metrics.timer("load"):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        batch_filenames, pixels = batch
+        if not batch_filenames:
+            continue
+        n_images = len(batch_filenames)
+        with metrics.timer("inference", n_images):
+            features = feature_extractor(from_pixels(pixels))
+        if pixel_cache is not None:
+            with metrics.timer("cache", n_images):
+                for filename, image_pixels in zip(batch_filenames, pixels):
+                    if filename not in pixel_cache:
+                        pixel_cache.append(filename, image_pixels)
+        with metrics.timer("store", n_images):
+            feature_store.append_many(batch_filenames, features)
+        # flush partial shards now and then, so that a restarted task loses
+        # no more than a few minutes of work
+        if time.monotonic() - last_flush >= checkpoint_interval:
+            feature_store.flush()
+            if pixel_cache is not None:
+                pixel_cache.flush()
+            last_flush = time.monotonic()
@@ -1,82 +1,226 @@
 import os
 
-from elasticsearch import Elasticsearch
-from src.io import (
-    count_features,
-    get_latest_model_name,
-    load_features,
-    load_json,
-    load_model,
-    yield_feature_filenames,
+from src.descriptions import DescriptionStore
+from src.duplicates import load_duplicates
+from src.feature_store import FeatureStore
+from src.indexing import (
+    BulkIndexSummary,
+    bulk_index,
+    create_index,
+    find_missing_ids,
+    finish_bulk_build,
+    get_elasticsearch_client,
+    get_index_name,
+    get_versioned_index_name,
+    resolve_alias,
+    swap_alias,
 )
+from src.io import get_latest_model_name, get_manifest, load_model
 from src.log import get_logger
-from src.model import LSHModel
+from src.metrics import metrics
+from src.partition import Checkpoint, get_partition
 
 log = get_logger()
 
 log.info("Loading Elasticsearch client")
-es = Elasticsearch(
-    "https://" + os.environ.get("AWS_OPENSEARCH_ENDPOINT") + ":443",
-    http_auth=(
-        os.environ.get("AWS_OPENSEARCH_USERNAME"),
-        os.environ.get("AWS_OPENSEARCH_PASSWORD"),
-    ),
-)
+index_batch_size = int(os.environ.get("INDEX_BATCH_SIZE", 500))
+index_concurrency = int(os.environ.get("INDEX_CONCURRENCY", 4))
+index_max_retries = int(os.environ.get("INDEX_MAX_RETRIES", 3))
+es = get_elasticsearch_client(maxsize=index_concurrency)
+
+# each partition hashes the feature shards whose names fall in it, and
+# checkpoints the shards it has finished indexing
+partition = get_partition()
+checkpoint = Checkpoint("infer-hashes", partition)
+if partition.partitioned and not checkpoint.enabled:
+    raise ValueError("RUN_ID must be set to run infer-hashes in partitions")
 
-if os.environ.get("MODEL_NAME"):
+if checkpoint.state.get("model_name"):
+    model_name = checkpoint.state["model_name"]
+elif os.environ.get("MODEL_NAME"):
     model_name = os.environ.get("MODEL_NAME")
 else:
     model_name = get_latest_model_name()
 log.info(f"Loading model {model_name}")
-model_bytes = load_model(model_name)
-model = LSHModel(model_bytes=model_bytes)
+model = load_model(model_name)
 
 
-log.info("Loading image descriptions")
-descriptions = load_json("descriptions")
+# descriptions are looked up in batches as documents are indexed, rather
+# than loaded up front
+description_store = DescriptionStore()
 
-index_name = model_name.replace("T", "-").replace(":", "-")
-log.info(f"Creating index {index_name}")
-if es.indices.exists(index=index_name):
-    es.indices.delete(index=index_name)
+# near-duplicates found by find-duplicates can be collapsed, so that only
+# the representative of each cluster is indexed
+duplicates = {}
+if os.environ.get("COLLAPSE_DUPLICATES", "false") == "true":
+    duplicates = load_duplicates()
+    log.info(f"Collapsing {len(duplicates)} near-duplicate images")
 
-es.indices.create(
-    index=index_name,
-    body={
-        "mappings": {
-            "properties": {
-                "lsh-hash": {"type": "keyword"},
-                "description": {"type": "text", "analyzer": "english"},
-            }
-        }
-    },
+# searches go through an alias named after the model, which points at a
+# versioned index. A full rebuild writes to a new index and swaps the alias
+# over once it's complete, while an incremental run only adds the features
+# which are missing from the index that the alias already points at. Every
+# partition of a full rebuild writes to the same index, named after the run
+alias = get_index_name(model_name)
+index_mode = checkpoint.state.get(
+    "index_mode", os.environ.get("INDEX_MODE", "full")
 )
+if index_mode not in ("full", "incremental"):
+    raise ValueError(f"Unknown index mode: {index_mode}")
+if index_mode == "incremental" and not es.indices.exists(index=alias):
+    log.info(f"No index found for {alias}, falling back to a full rebuild")
+    index_mode = "full"
 
+if index_mode == "full":
+    index_name = get_versioned_index_name(alias, version=checkpoint.run_id)
+    log.info(f"Creating index {index_name}")
+    create_index(es, index_name, bulk_build=True, exist_ok=True)
+else:
+    index_name = alias
+    log.info(f"Adding missing features to {index_name}")
+checkpoint.save(model_name=model_name, index_mode=index_mode)
 
-total_features = count_features()
-for i, filename in enumerate(yield_feature_filenames()):
-    log.info(
-        f"Processing feature {i + 1} of {total_features} "
-        f"({i/total_features*100:.2f}%)"
-    )
-    try:
-        feature_vector = load_features(filename)
-        log.debug(f"Inferring hashes for {filename}")
-        predictions = model.predict(feature_vector.reshape(1, -1))
-    except Exception as e:
-        log.error(f"Error processing {filename}: {e}")
-        continue
-
-    log.debug(f"Indexing hashes for {filename}")
-    try:
-        es.index(
-            index=index_name,
-            id=filename,
-            body={
+
+hash_batch_size = int(os.environ.get("HASH_BATCH_SIZE", 1024))
+checkpoint_shards = int(os.environ.get("CHECKPOINT_SHARDS", 8))
+
+feature_store = FeatureStore()
+finished_shards = set(checkpoint.state.get("shards", []))
+# feature shards never change once they're written, so every shard whose
+# documents have all been indexed is recorded in a manifest named after the
+# index, and later runs skip it without reading it
+indexed_shards = get_manifest(
+    f"indexed-shards/{resolve_alias(es, index_name)}"
+)
+remaining_shards = [
+    shard
+    for shard in partition.filter(feature_store.shard_ids)
+    if shard not in finished_shards and shard not in indexed_shards
+]
+metrics.set_total(
+    "hash",
+    sum(len(feature_store.shard_ids[shard]) for shard in remaining_shards),
+)
+
+
+def yield_feature_batches(shards):
+    shards = feature_store.iter_shards(shards)
+    while True:
+        with metrics.timer("fetch"):
+            shard = next(shards, None)
+        if shard is None:
+            return
+        filenames, feature_vectors = shard
+        for start in range(0, len(filenames), hash_batch_size):
+            end = start + hash_batch_size
+            batch_filenames = filenames[start:end]
+            batch_vectors = feature_vectors[start:end]
+            if duplicates:
+                rows = [
+                    i
+                    for i, filename in enumerate(batch_filenames)
+                    if filename not in duplicates
+                ]
+                metrics.add("duplicate", len(batch_filenames) - len(rows))
+                batch_filenames = [batch_filenames[i] for i in rows]
+                batch_vectors = batch_vectors[rows]
+            if batch_filenames:
+                yield batch_filenames, batch_vectors
+
+
+def yield_missing_batches(shards):
+    """
+    Look up which of each shard's ids are missing from the index before
+    reading any vectors, and only read the rows which are missing, so that an
+    incremental run costs as much as the features which are new
+    """
+    for shard in shards:
+        filenames = [
+            filename
+            for filename in feature_store.shard_ids[shard]
+            if filename not in duplicates
+        ]
+        metrics.add(
+            "duplicate", len(feature_store.shard_ids[shard]) - len(filenames)
+        )
+        for start in range(0, len(filenames), hash_batch_size):
+            batch_filenames = filenames[start : start + hash_batch_size]
+            with metrics.timer("lookup", len(batch_filenames)):
+                missing = find_missing_ids(es, index_name, batch_filenames)
+            metrics.add("skip", len(batch_filenames) - len(missing))
+            if missing:
+                with metrics.timer("fetch", len(missing)):
+                    feature_vectors = feature_store.get_many(missing)
+                yield missing, feature_vectors
+
+
+def yield_documents(shards, undescribed):
+    if index_mode == "incremental":
+        batches = yield_missing_batches(shards)
+    else:
+        batches = yield_feature_batches(shards)
+    for filenames, feature_vectors in batches:
+        with metrics.timer("hash", len(filenames)):
+            batch_predictions = model.predict_batch(
+                feature_vectors, batch_size=hash_batch_size
+            )
+        with metrics.timer("describe", len(filenames)):
+            descriptions = description_store.get_many(filenames)
+        for filename, predictions in zip(filenames, batch_predictions):
+            if filename not in descriptions:
+                log.error(f"No description found for {filename}")
+                undescribed.append(filename)
+                continue
+            yield filename, {
                 "lsh-hash": predictions,
                 "description": descriptions[filename],
-            },
-        )
-    except Exception as e:
-        log.error(f"Error indexing hashes for {filename}: {e}")
-        continue
+            }
+
+
+log.info(
+    f"Indexing documents from {len(remaining_shards)} feature shards into "
+    f"{index_name}, skipping {len(finished_shards)} which this run has "
+    f"already done and {len(indexed_shards)} which were already indexed"
+)
+metrics.start_reporting()
+summary = BulkIndexSummary()
+for start in range(0, len(remaining_shards), checkpoint_shards):
+    shards = remaining_shards[start : start + checkpoint_shards]
+    undescribed = []
+    shards_summary = bulk_index(
+        es,
+        index_name,
+        yield_documents(shards, undescribed),
+        batch_size=index_batch_size,
+        concurrency=index_concurrency,
+        max_retries=index_max_retries,
+    )
+    summary.merge(shards_summary)
+    finished_shards.update(shards)
+    checkpoint.save(shards=sorted(finished_shards))
+    # shards with documents which couldn't be indexed are looked at again by
+    # the next run
+    if not shards_summary.failed and not undescribed:
+        for shard in shards:
+            indexed_shards.add(shard)
+        indexed_shards.flush()
+log.info(str(summary))
+for filename, error in summary.errors:
+    log.error(f"Error indexing hashes for {filename}: {error}")
+checkpoint.mark_complete()
+
+# the last partition of a full rebuild to finish swaps the alias over
+incomplete = checkpoint.incomplete_partitions()
+if index_mode == "full" and incomplete:
+    log.info(
+        f"Waiting for {len(incomplete)} other partitions to finish indexing "
+        f"into {index_name}. The last one will swap the alias over"
+    )
+elif index_mode == "full":
+    finish_bulk_build(es, index_name)
+    swap_alias(
+        es,
+        alias,
+        index_name,
+        delete_old=os.environ.get("KEEP_OLD_INDICES", "false") != "true",
+    )
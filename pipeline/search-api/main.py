@@ -0,0 +1,306 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from dataclasses import asdict
+
+import numpy as np
+from aiohttp import web
+from src.feature_store import FeatureStore
+from src.indexing import get_async_elasticsearch_client, get_index_name
+from src.io import get_latest_model_name, load_model
+from src.log import get_logger
+from src.search import SearchEngine
+
+log = get_logger()
+
+port = int(os.environ.get("PORT", 80))
+max_batch_size = int(os.environ.get("MAX_BATCH_SIZE", 64))
+max_batch_delay = float(os.environ.get("MAX_BATCH_DELAY_MS", 2)) / 1000
+cache_size = int(os.environ.get("HASH_CACHE_SIZE", 10000))
+es_connections = int(os.environ.get("ELASTICSEARCH_CONNECTIONS", 32))
+n_probes = int(os.environ.get("N_PROBES", 1))
+refresh_interval = float(os.environ.get("FEATURE_STORE_REFRESH_SECONDS", 10))
+
+
+class HashBatcher:
+    """
+    Collects the query vectors of concurrent requests and hashes them with a
+    single call to hash_batch. A batch is hashed as soon as it's full, or
+    max_delay seconds after its first query arrived. If hashing a batch
+    fails, only the queries which fail on their own get the error, and the
+    batcher carries on serving later requests.
+    """
+
+    def __init__(self, hash_batch, max_batch_size: int, max_delay: float):
+        self.hash_batch = hash_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+
+    async def hash(self, features: np.ndarray):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((features, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self.queue.get(), timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                features = np.vstack(
+                    [item[0].reshape(1, -1) for item in batch]
+                )
+                hashes = await loop.run_in_executor(
+                    None, self.hash_batch, features
+                )
+            except Exception:
+                # one bad query fails the whole batch, so its queries are
+                # hashed again one at a time, and only the bad ones fail
+                await self.hash_each(batch)
+                continue
+            for (_, future), query_hashes in zip(batch, hashes):
+                if not future.cancelled():
+                    future.set_result(query_hashes)
+
+    async def hash_each(self, batch):
+        loop = asyncio.get_running_loop()
+        for features, future in batch:
+            try:
+                (query_hashes,) = await loop.run_in_executor(
+                    None, self.hash_batch, features.reshape(1, -1)
+                )
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+                continue
+            if not future.cancelled():
+                future.set_result(query_hashes)
+
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+
+class LatencyStats:
+    def __init__(self, window: int = 10000, qps_window: float = 60.0):
+        self.latencies = deque(maxlen=window)
+        self.timestamps = deque()
+        self.qps_window = qps_window
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, seconds: float):
+        now = time.monotonic()
+        self.requests += 1
+        self.latencies.append(seconds)
+        self.timestamps.append(now)
+        while self.timestamps and self.timestamps[0] < now - self.qps_window:
+            self.timestamps.popleft()
+
+    def summary(self) -> dict:
+        latencies = np.array(self.latencies) * 1000
+        now = time.monotonic()
+        recent = sum(1 for t in self.timestamps if t >= now - self.qps_window)
+        summary = {
+            "requests": self.requests,
+            "errors": self.errors,
+            "qps": recent / self.qps_window,
+            "p50_ms": None,
+            "p99_ms": None,
+        }
+        if len(latencies):
+            summary["p50_ms"] = float(np.percentile(latencies, 50))
+            summary["p99_ms"] = float(np.percentile(latencies, 99))
+        return summary
+
+
+async def search(request):
+    app = request.app
+    engine = app["engine"]
+    start = time.perf_counter()
+    try:
+        if request.method == "POST":
+            body = await request.json()
+            image_id = None
+            features = np.asarray(body["features"], dtype=np.float32)
+            if (
+                features.ndim != 1
+                or features.shape[0] not in engine.model.input_dims
+            ):
+                raise ValueError(
+                    "features must be a vector of length "
+                    + " or ".join(map(str, engine.model.input_dims))
+                )
+            params = body
+        else:
+            params = request.query
+            image_id = params["id"]
+            features = None
+
+        cached = app["hash_cache"].get(image_id) if image_id else None
+        if cached is not None:
+            features, hashes = cached
+        else:
+            if image_id is not None:
+                if image_id not in engine.feature_store:
+                    raise web.HTTPNotFound(text=f"Unknown image id {image_id}")
+                # on s3 this is a blocking read, so it's kept off the loop
+                features = np.asarray(
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, engine.feature_store.get, image_id
+                    )
+                )
+            hashes = await app["batcher"].hash(features)
+            if image_id is not None:
+                app["hash_cache"].put(image_id, (features, hashes))
+
+        n_candidates = params.get("n_candidates")
+        es_response = await app["es"].search(
+            index=engine.index_name,
+            body=engine.build_search_body(
+                hashes,
+                n_candidates=int(n_candidates) if n_candidates else None,
+                minimum_should_match=params.get("minimum_should_match"),
+            ),
+        )
+        k = params.get("k")
+        response = await asyncio.get_running_loop().run_in_executor(
+            None,
+            engine.rerank,
+            features,
+            es_response,
+            int(k) if k else None,
+            image_id,
+        )
+    except (KeyError, ValueError) as e:
+        app["stats"].errors += 1
+        raise web.HTTPBadRequest(text=f"Invalid query: {e}")
+    except Exception:
+        app["stats"].errors += 1
+        raise
+
+    latency = time.perf_counter() - start
+    app["stats"].record(latency)
+    return web.json_response(
+        {
+            "results": [asdict(result) for result in response.results],
+            "n_candidates": response.n_candidates,
+            "latency_ms": latency * 1000,
+        }
+    )
+
+
+async def metrics(request):
+    app = request.app
+    return web.json_response(
+        {
+            **app["stats"].summary(),
+            "hash_cache_hits": app["hash_cache"].hits,
+            "hash_cache_misses": app["hash_cache"].misses,
+        }
+    )
+
+
+async def health(request):
+    return web.json_response({"status": "ok"})
+
+
+async def refresh_feature_store(feature_store: FeatureStore):
+    """
+    Pick up shards written since startup, so that images indexed by the
+    stream step can be re-ranked as soon as their features are flushed
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(refresh_interval)
+        try:
+            n_new = await loop.run_in_executor(None, feature_store.refresh)
+        except Exception as e:
+            log.error(f"Error refreshing the feature store: {e}")
+            continue
+        if n_new:
+            log.info(f"Added {n_new} new vectors to the feature store")
+
+
+async def start_background_tasks(app):
+    app["es"] = get_async_elasticsearch_client(maxsize=es_connections)
+    app["batcher_task"] = asyncio.create_task(app["batcher"].run())
+    app["refresh_task"] = None
+    if refresh_interval > 0:
+        app["refresh_task"] = asyncio.create_task(
+            refresh_feature_store(app["engine"].feature_store)
+        )
+
+
+async def cleanup(app):
+    app["batcher_task"].cancel()
+    if app["refresh_task"] is not None:
+        app["refresh_task"].cancel()
+    await app["es"].close()
+
+
+def create_app(model, feature_store, index_name) -> web.Application:
+    app = web.Application()
+    app["engine"] = SearchEngine(
+        es=None,
+        index_name=index_name,
+        model=model,
+        feature_store=feature_store,
+        n_probes=n_probes,
+    )
+    app["batcher"] = HashBatcher(
+        app["engine"].hash_batch, max_batch_size, max_batch_delay
+    )
+    app["hash_cache"] = LRUCache(cache_size)
+    app["stats"] = LatencyStats()
+    app.router.add_get("/search", search)
+    app.router.add_post("/search", search)
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/health", health)
+    app.on_startup.append(start_background_tasks)
+    app.on_cleanup.append(cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    model_name = os.environ.get("MODEL_NAME") or get_latest_model_name()
+    log.info(f"Loading model {model_name}")
+    model = load_model(model_name)
+    index_name = os.environ.get("INDEX_NAME") or get_index_name(model_name)
+    log.info(f"Serving similarity search over {index_name} on port {port}")
+    web.run_app(
+        create_app(model, FeatureStore(), index_name),
+        port=port,
+        access_log=None,
+    )
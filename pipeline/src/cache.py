@@ -0,0 +1,144 @@
+import os
+import threading
+from hashlib import sha256
+from pathlib import Path
+from typing import Callable, Iterator, Optional, Tuple
+from uuid import uuid4
+
+from .log import get_logger
+
+log = get_logger()
+
+
+class DiskCache:
+    """
+    A size-bounded, least-recently-used cache of s3 objects on local disk.
+
+    Files are named after the sha256 of the object's key, not of its
+    content, so a cached copy is never checked against s3 again. The cache
+    must only hold objects whose keys are never written twice: images and
+    features are saved once under their image id, models under the time
+    they were trained, and feature shards and description segments under
+    names which writers never reuse. Mutable files like json files and
+    manifests bypass it.
+
+    Files are written to a temporary name and renamed into place, so several
+    processes can safely share one directory. Reads bump a file's
+    modification time, and eviction removes the least recently used files
+    until the cache is back under 90% of max_bytes.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_fetched = 0
+        self.size = 0
+        # a large cache takes a while to scan, so its size is added up in the
+        # background rather than delaying startup. Files which are put while
+        # it runs may be counted twice, which only brings eviction forward,
+        # and eviction finds the real size again
+        self.size_scan = threading.Thread(target=self._scan_size, daemon=True)
+        self.size_scan.start()
+
+    def _scan_size(self):
+        size = sum(file_size for _, file_size, _ in self._files())
+        with self.lock:
+            self.size += size
+            should_evict = self.size > self.max_bytes
+        if should_evict:
+            self.evict()
+
+    def _files(self) -> Iterator[Tuple[float, int, Path]]:
+        """The modification time, size and path of every cached file"""
+        for subdirectory in os.scandir(self.directory):
+            if not subdirectory.is_dir():
+                continue
+            for entry in os.scandir(subdirectory.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, Path(entry.path)
+
+    def path_for(self, key: str) -> Path:
+        digest = sha256(key.encode("utf-8")).hexdigest()
+        return self.directory / digest[:2] / digest
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.path_for(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self.bytes_read += len(data)
+        return data
+
+    def put(self, key: str, data: bytes) -> Path:
+        path = self.path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = path.with_name(f"{path.name}.{uuid4().hex}.tmp")
+        temporary_path.write_bytes(data)
+        os.replace(temporary_path, path)
+        with self.lock:
+            self.size += len(data)
+            self.bytes_fetched += len(data)
+            should_evict = self.size > self.max_bytes
+        if should_evict:
+            self.evict()
+        return path
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], bytes]) -> bytes:
+        data = self.get(key)
+        if data is None:
+            data = fetch()
+            self.put(key, data)
+        return data
+
+    def get_path_or_fetch(self, key: str, fetch: Callable[[], bytes]) -> Path:
+        path = self.path_for(key)
+        if path.exists():
+            os.utime(path)
+            with self.lock:
+                self.hits += 1
+            return path
+        with self.lock:
+            self.misses += 1
+        return self.put(key, fetch())
+
+    def evict(self):
+        with self.lock:
+            # other processes share the directory, so the real size can only
+            # be found by looking at it
+            files = list(self._files())
+            size = sum(file_size for _, file_size, _ in files)
+            target = self.max_bytes * 0.9
+            for _, file_size, path in sorted(files):
+                if size <= target:
+                    break
+                path.unlink(missing_ok=True)
+                size -= file_size
+            self.size = size
+        log.debug(f"Evicted cache down to {size / 1e6:.1f} MB")
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "bytes_read": self.bytes_read,
+            "bytes_fetched": self.bytes_fetched,
+            "size": self.size,
+        }
@@ -0,0 +1,513 @@
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .feature_store import next_shard_name
+from .io import (
+    bucket,
+    data_dir,
+    fetch_s3_object,
+    get_s3_client,
+    list_description_files,
+    load_json,
+    read_s3_object,
+    s3_cache,
+    storage_env,
+)
+from .log import get_logger
+
+log = get_logger()
+
+default_name = os.environ.get("DESCRIPTION_STORE", "description-segments")
+default_segment_size = int(os.environ.get("DESCRIPTION_SEGMENT_SIZE", 100000))
+max_open_segments = int(os.environ.get("DESCRIPTION_OPEN_SEGMENTS", 32))
+
+# sqlite limits the number of parameters in a single query
+lookup_batch_size = 500
+
+# 10 bits and 7 hashes per id give bloom filters a false positive rate of
+# about 1%, so an id is almost always looked up in just the segment which
+# holds it
+bloom_bits_per_id = 10
+bloom_hashes = 7
+
+
+def writer_of(segment: str) -> Optional[str]:
+    return segment.rpartition("-")[0] or None
+
+
+def id_hashes(image_ids: Sequence[str]) -> np.ndarray:
+    """Two independent 64-bit hashes of every id, as an (N, 2) array"""
+    digests = b"".join(
+        blake2b(image_id.encode("utf-8"), digest_size=16).digest()
+        for image_id in image_ids
+    )
+    return np.frombuffer(digests, dtype="<u8").reshape(-1, 2)
+
+
+class BloomFilter:
+    """
+    A bloom filter of the ids in a segment, which is saved alongside it so
+    that lookups only query the segments which might hold each id
+    """
+
+    header = struct.Struct("<II")
+
+    def __init__(self, bits: np.ndarray, n_hashes: int = bloom_hashes):
+        self.bits = bits
+        self.n_hashes = n_hashes
+
+    @property
+    def n_bits(self) -> int:
+        return len(self.bits) * 8
+
+    @classmethod
+    def build(cls, image_ids: Sequence[str]) -> "BloomFilter":
+        n_bytes = max(-(-len(image_ids) * bloom_bits_per_id // 8), 8)
+        bloom = cls(np.zeros(n_bytes, dtype=np.uint8))
+        if image_ids:
+            positions = bloom.positions(id_hashes(image_ids)).reshape(-1)
+            np.bitwise_or.at(
+                bloom.bits,
+                positions // 8,
+                np.left_shift(1, positions % 8).astype(np.uint8),
+            )
+        return bloom
+
+    def positions(self, hashes: np.ndarray) -> np.ndarray:
+        """The (N, n_hashes) bit positions of some ids' hashes"""
+        steps = np.arange(self.n_hashes, dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            combined = hashes[:, :1] + steps * hashes[:, 1:]
+        return combined % np.uint64(self.n_bits)
+
+    def might_contain(self, hashes: np.ndarray) -> np.ndarray:
+        positions = self.positions(hashes)
+        set_bits = (self.bits[positions // 8] >> (positions % 8)) & 1
+        return set_bits.all(axis=1)
+
+    def to_bytes(self) -> bytes:
+        return (
+            self.header.pack(self.n_hashes, len(self.bits))
+            + self.bits.tobytes()
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "BloomFilter":
+        n_hashes, n_bytes = cls.header.unpack_from(data)
+        bits = np.frombuffer(
+            data, dtype=np.uint8, count=n_bytes, offset=cls.header.size
+        )
+        return cls(bits, n_hashes)
+
+
+class DescriptionStore:
+    """
+    An append-only store of image descriptions, keyed by image id. New
+    descriptions are buffered and flushed as segments, each of which is a
+    small sqlite database with the id as its primary key. Lookups query the
+    segments in batches, so neither writing nor reading ever holds more than
+    a segment's worth of descriptions in memory.
+
+    Writers flush whenever they checkpoint, so a flush folds the writer's
+    last segment into the new one if it isn't full yet. Each writer leaves at
+    most one partial segment, and the number of segments which a lookup
+    queries grows with the number of descriptions rather than the number of
+    flushes.
+
+    Every segment is saved with a bloom filter of its ids, and a lookup only
+    queries the segments whose filters might hold each id, so a batch of ids
+    touches about one segment per id however many segments there are.
+    Segments written before filters existed are queried for every id.
+
+    Locally, segments are queried in place. On s3, each segment is downloaded
+    when it's first queried, through the s3 cache if it's enabled. At most
+    `max_open_segments` segments are kept open at once, and those which are
+    already open are queried first.
+
+    Like the feature store, several processes can append to the same store if
+    each is given a different `writer` name, which prefixes the names of the
+    segments it writes.
+    """
+
+    def __init__(
+        self,
+        name: str = default_name,
+        segment_size: int = default_segment_size,
+        writer: Optional[str] = None,
+    ):
+        if storage_env not in ("local", "s3"):
+            raise ValueError(f"Unknown environment: {storage_env}")
+        self.name = name
+        self.segment_size = segment_size
+        self.writer = writer
+        self.segments: List[str] = []
+        self._buffer: Dict[str, str] = {}
+        self._connections: OrderedDict = OrderedDict()
+        self._local_paths: Dict[str, Path] = {}
+        self._blooms: Dict[str, Optional[BloomFilter]] = {}
+        self._download_dir: Optional[Path] = None
+        self._lock = threading.RLock()
+        if storage_env == "local":
+            (data_dir / name).mkdir(parents=True, exist_ok=True)
+        self.refresh()
+
+    def refresh(self) -> int:
+        """
+        Pick up the segments which other processes have written since the
+        store was opened, and forget any which they've merged away, returning
+        the number of new segments
+        """
+        segments = self._list_segments()
+        with self._lock:
+            for segment in set(self.segments) - set(segments):
+                self._forget(segment)
+            new_segments = [
+                segment for segment in segments if segment not in self.segments
+            ]
+            self.segments.extend(new_segments)
+        return len(new_segments)
+
+    def add(self, image_id: str, description: str):
+        with self._lock:
+            self._buffer[str(image_id)] = description
+            full = len(self._buffer) >= self.segment_size
+        if full:
+            self.flush()
+
+    def add_many(self, descriptions: Iterable[Tuple[str, str]]):
+        for image_id, description in descriptions:
+            self.add(image_id, description)
+
+    def flush(self):
+        with self._lock:
+            if not self._buffer:
+                return
+            descriptions = self._buffer
+            partial = self._partial_segment()
+            if partial is not None:
+                descriptions = {**self._read_segment(partial), **descriptions}
+            segment = next_shard_name(self._list_segments(), self.writer)
+            log.debug(
+                f"Writing {len(descriptions)} descriptions to segment "
+                f"{segment}"
+            )
+            # the new segment is written before the one it replaces is
+            # deleted, so readers never miss a description
+            self._write_segment(segment, descriptions)
+            self.segments.append(segment)
+            if partial is not None:
+                self._delete_segment(partial)
+            self._buffer = {}
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, image_id: str) -> bool:
+        return self.get(image_id) is not None
+
+    def get(self, image_id: str) -> Optional[str]:
+        return self.get_many([image_id]).get(str(image_id))
+
+    def get_many(self, image_ids: Iterable[str]) -> Dict[str, str]:
+        """
+        Look up the descriptions of a batch of ids, returning a dict which
+        leaves out any ids that have no description. Ids which are found in
+        one segment aren't looked for in the rest.
+        """
+        with self._lock:
+            found = {}
+            remaining = []
+            for image_id in map(str, image_ids):
+                if image_id in self._buffer:
+                    found[image_id] = self._buffer[image_id]
+                else:
+                    remaining.append(image_id)
+            # another writer can merge a segment away while looking, in which
+            # case the ids which haven't been found yet are routed again to
+            # the segments which replaced it
+            while remaining:
+                segment = None
+                try:
+                    for segment, segment_ids in self._route(remaining):
+                        segment_ids = [
+                            image_id
+                            for image_id in segment_ids
+                            if image_id not in found
+                        ]
+                        if segment_ids:
+                            found.update(self._query(segment, segment_ids))
+                except Exception:
+                    if segment is None or segment in self._list_segments():
+                        raise
+                    self.refresh()
+                    remaining = [
+                        image_id
+                        for image_id in remaining
+                        if image_id not in found
+                    ]
+                    continue
+                break
+        return found
+
+    def _route(self, image_ids: List[str]):
+        """
+        Yield each segment with the ids which its bloom filter might hold,
+        starting with the segments which are already open
+        """
+        hashes = id_hashes(image_ids)
+        segments = sorted(
+            self.segments, key=lambda segment: segment not in self._connections
+        )
+        for segment in segments:
+            bloom = self._bloom(segment)
+            if bloom is None:
+                yield segment, image_ids
+                continue
+            mask = bloom.might_contain(hashes)
+            if mask.any():
+                yield segment, [
+                    image_id
+                    for image_id, match in zip(image_ids, mask)
+                    if match
+                ]
+
+    def _query(self, segment: str, image_ids: List[str]) -> Dict[str, str]:
+        connection = self._connection(segment)
+        found = {}
+        for start in range(0, len(image_ids), lookup_batch_size):
+            batch = image_ids[start : start + lookup_batch_size]
+            found.update(
+                connection.execute(
+                    "SELECT id, description FROM descriptions "
+                    f"WHERE id IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+            )
+        return found
+
+    def _partial_segment(self) -> Optional[str]:
+        """This writer's last segment, if it isn't full"""
+        own = [
+            segment
+            for segment in self.segments
+            if writer_of(segment) == self.writer
+        ]
+        if not own:
+            return None
+        (n_rows,) = (
+            self._connection(own[-1])
+            .execute("SELECT COUNT(*) FROM descriptions")
+            .fetchone()
+        )
+        return own[-1] if n_rows < self.segment_size else None
+
+    def _read_segment(self, segment: str) -> Dict[str, str]:
+        return dict(
+            self._connection(segment).execute(
+                "SELECT id, description FROM descriptions"
+            )
+        )
+
+    def _connection(self, segment: str) -> sqlite3.Connection:
+        if segment in self._connections:
+            self._connections.move_to_end(segment)
+            return self._connections[segment]
+        path = self._segment_path(segment)
+        if not path.exists():
+            raise FileNotFoundError(path)
+        connection = sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, check_same_thread=False
+        )
+        self._connections[segment] = connection
+        if len(self._connections) > max_open_segments:
+            _, oldest = self._connections.popitem(last=False)
+            oldest.close()
+        return connection
+
+    def _segment_path(self, segment: str) -> Path:
+        """The path of a segment on local disk, downloading it from s3"""
+        if storage_env == "local":
+            return data_dir / self.name / f"{segment}.sqlite"
+        if segment in self._local_paths:
+            return self._local_paths[segment]
+        key = f"{self.name}/{segment}.sqlite"
+        if s3_cache is not None:
+            path = s3_cache.get_path_or_fetch(
+                f"{bucket}/{key}", lambda: fetch_s3_object(key)
+            )
+        else:
+            path = self._temporary_dir() / f"{segment}.sqlite"
+            if not path.exists():
+                path.write_bytes(fetch_s3_object(key))
+        self._local_paths[segment] = path
+        return path
+
+    def _bloom(self, segment: str) -> Optional[BloomFilter]:
+        """A segment's bloom filter, or None if it was saved without one"""
+        if segment in self._blooms:
+            return self._blooms[segment]
+        data = None
+        if storage_env == "local":
+            path = data_dir / self.name / f"{segment}.bloom"
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                pass
+        else:
+            s3 = get_s3_client()
+            try:
+                data = read_s3_object(f"{self.name}/{segment}.bloom")
+            except s3.exceptions.NoSuchKey:
+                pass
+        bloom = BloomFilter.from_bytes(data) if data is not None else None
+        self._blooms[segment] = bloom
+        return bloom
+
+    def _temporary_dir(self) -> Path:
+        if self._download_dir is None:
+            self._download_dir = Path(tempfile.mkdtemp(prefix="descriptions-"))
+        return self._download_dir
+
+    def _write_segment(self, segment: str, descriptions: Dict[str, str]):
+        # the filter is written before the segment, so that it exists by the
+        # time readers can see the segment
+        bloom = BloomFilter.build(list(descriptions))
+        if storage_env == "local":
+            bloom_path = data_dir / self.name / f"{segment}.bloom"
+            temporary_path = bloom_path.with_suffix(".bloom.tmp")
+            temporary_path.write_bytes(bloom.to_bytes())
+            os.replace(temporary_path, bloom_path)
+        else:
+            get_s3_client().put_object(
+                Bucket=bucket,
+                Key=f"{self.name}/{segment}.bloom",
+                Body=bloom.to_bytes(),
+                ContentType="application/octet-stream",
+            )
+        self._blooms[segment] = bloom
+
+        if storage_env == "local":
+            path = data_dir / self.name / f"{segment}.sqlite"
+        else:
+            path = self._temporary_dir() / f"{segment}.sqlite"
+        # the segment is built under a temporary name, so that readers never
+        # see a partial database
+        temporary_path = path.with_suffix(".tmp")
+        if temporary_path.exists():
+            temporary_path.unlink()
+        connection = sqlite3.connect(temporary_path)
+        with connection:
+            connection.execute(
+                "CREATE TABLE descriptions "
+                "(id TEXT PRIMARY KEY, description TEXT) WITHOUT ROWID"
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO descriptions VALUES (?, ?)",
+                sorted(descriptions.items()),
+            )
+        connection.close()
+        os.replace(temporary_path, path)
+        if storage_env == "s3":
+            s3 = get_s3_client()
+            s3.put_object(
+                Bucket=bucket,
+                Key=f"{self.name}/{segment}.sqlite",
+                Body=path.read_bytes(),
+                ContentType="application/x-sqlite3",
+            )
+            self._local_paths[segment] = path
+
+    def _delete_segment(self, segment: str):
+        self._forget(segment)
+        # the segment is deleted before its filter, so that readers never see
+        # a segment without the filter it was written with
+        for suffix in (".sqlite", ".bloom"):
+            if storage_env == "local":
+                (data_dir / self.name / f"{segment}{suffix}").unlink(
+                    missing_ok=True
+                )
+            else:
+                s3 = get_s3_client()
+                s3.delete_object(
+                    Bucket=bucket, Key=f"{self.name}/{segment}{suffix}"
+                )
+
+    def _forget(self, segment: str):
+        if segment in self.segments:
+            self.segments.remove(segment)
+        self._blooms.pop(segment, None)
+        connection = self._connections.pop(segment, None)
+        if connection is not None:
+            connection.close()
+        path = self._local_paths.pop(segment, None)
+        if path is not None and self._download_dir is not None:
+            if path.parent == self._download_dir:
+                path.unlink(missing_ok=True)
+
+    def _list_segments(self) -> List[str]:
+        if storage_env == "local":
+            filenames = [
+                path.name for path in (data_dir / self.name).iterdir()
+            ]
+        else:
+            s3 = get_s3_client()
+            paginator = s3.get_paginator("list_objects_v2")
+            filenames = []
+            pages = paginator.paginate(Bucket=bucket, Prefix=f"{self.name}/")
+            for page in pages:
+                for content in page.get("Contents", []):
+                    filenames.append(Path(content["Key"]).name)
+        return sorted(
+            filename[: -len(".sqlite")]
+            for filename in filenames
+            if filename.endswith(".sqlite")
+        )
+
+
+def migrate_description_files(
+    store: Optional[DescriptionStore] = None,
+) -> DescriptionStore:
+    """
+    Copy the descriptions saved in the old descriptions*.json files into a
+    DescriptionStore, skipping any which it already holds
+    """
+    store = store or DescriptionStore()
+    with store:
+        for filename in list_description_files():
+            descriptions = load_json(filename)
+            log.info(
+                f"Migrating {len(descriptions)} descriptions from {filename}"
+            )
+            image_ids = list(descriptions)
+            for start in range(0, len(image_ids), lookup_batch_size):
+                batch = image_ids[start : start + lookup_batch_size]
+                existing = store.get_many(batch)
+                store.add_many(
+                    (image_id, descriptions[image_id])
+                    for image_id in batch
+                    if image_id not in existing
+                )
+    return store
+
+
+if __name__ == "__main__":
+    migrate_description_files()
@@ -0,0 +1,158 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Callable, Iterable, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from PIL import Image, UnidentifiedImageError
+from requests.adapters import HTTPAdapter
+
+from .log import get_logger
+from .metrics import metrics
+
+log = get_logger()
+
+
+class HostRateLimiter:
+    """
+    Spaces out requests to each host so that no host receives more than
+    `requests_per_second` requests per second, across all threads
+    """
+
+    def __init__(self, requests_per_second: Optional[float] = None):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.next_times = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host: str):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            next_time = max(now, self.next_times.get(host, now))
+            self.next_times[host] = next_time + self.interval
+            if len(self.next_times) > 100_000:
+                self.next_times = {
+                    host: host_time
+                    for host, host_time in self.next_times.items()
+                    if host_time > now
+                }
+        if next_time > now:
+            time.sleep(next_time - now)
+
+
+@dataclass
+class DownloadSummary:
+    downloaded: int = 0
+    failed: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def images_per_second(self) -> float:
+        return self.downloaded / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"Downloaded {self.downloaded} images "
+            f"({self.bytes / 1e6:.1f} MB) in {self.seconds:.1f}s "
+            f"({self.images_per_second:.1f} images/s), "
+            f"with {self.failed} failures"
+        )
+
+
+def create_http_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_image(
+    session: requests.Session,
+    url: str,
+    timeout: float = 5,
+    size: int = 256,
+) -> Tuple[Image.Image, int]:
+    with metrics.timer("fetch"):
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+    with metrics.timer("decode"):
+        image = Image.open(BytesIO(response.content))
+        # decode jpegs at a reduced scale, which must happen before the
+        # conversion loads the full image
+        image.draft("RGB", (size, size))
+        image = image.convert("RGB")
+        image.thumbnail((size, size))
+    return image, len(response.content)
+
+
+def download_images(
+    rows: Iterable[dict],
+    save: Callable[[Image.Image, str], None],
+    concurrency: int = 64,
+    requests_per_host_per_second: Optional[float] = None,
+    timeout: float = 5,
+    on_done: Optional[Callable[[dict], None]] = None,
+) -> DownloadSummary:
+    """
+    Download, resize and save the image at row["URL"] for every row, keeping
+    up to `concurrency` rows in flight at once. Rows are consumed lazily, so
+    `rows` can be a stream of any length. Progress is recorded in the fetch,
+    decode and save stages of `metrics`, and dead links are only logged at
+    debug level, since they're common in scraped datasets. If `on_done` is
+    given, it's called from a worker thread with every row once it has been
+    saved or has failed.
+    """
+    session = create_http_session(concurrency)
+    rate_limiter = HostRateLimiter(requests_per_host_per_second)
+    summary = DownloadSummary()
+    lock = threading.Lock()
+
+    def process(row):
+        try:
+            download_and_save(row)
+        finally:
+            if on_done is not None:
+                on_done(row)
+
+    def download_and_save(row):
+        try:
+            rate_limiter.wait(urlparse(row["URL"]).netloc)
+            image, n_bytes = download_image(session, row["URL"], timeout)
+        except (
+            requests.RequestException,
+            UnidentifiedImageError,
+            OSError,
+        ) as e:
+            log.debug(f"Error downloading image from {row['URL']}: {e}")
+            with lock:
+                summary.failed += 1
+            return
+        try:
+            with metrics.timer("save"):
+                save(image, row["hash"])
+        except Exception as e:
+            log.error(f"Error saving image {row['hash']}: {e}")
+            with lock:
+                summary.failed += 1
+            return
+        with lock:
+            summary.downloaded += 1
+            summary.bytes += n_bytes
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = set()
+        for row in rows:
+            if len(in_flight) >= concurrency * 2:
+                _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            in_flight.add(executor.submit(process, row))
+        wait(in_flight)
+
+    summary.seconds = time.perf_counter() - start
+    return summary
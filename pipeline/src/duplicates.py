@@ -0,0 +1,212 @@
+import os
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from .feature_store import FeatureStore
+from .io import load_json
+from .log import get_logger
+from .metrics import metrics
+from .model import LSHModel
+
+log = get_logger()
+
+default_name = os.environ.get("DUPLICATES", "duplicates")
+
+
+def band_keys(
+    clusters: np.ndarray, n_clusters: int, band_size: int
+) -> np.ndarray:
+    """
+    Combine an (N, n_groups) array of cluster indices into an (N, n_bands)
+    array of bucket keys, one for every band of `band_size` neighbouring
+    groups. Keys wrap around in uint64, so two different bands can share a
+    key, but the pairs which that adds are removed by the exact check.
+    """
+    n_rows, n_groups = clusters.shape
+    if n_groups % band_size:
+        raise ValueError(
+            f"n_groups ({n_groups}) must be divisible by "
+            f"band_size ({band_size})"
+        )
+    bands = clusters.reshape(n_rows, n_groups // band_size, band_size)
+    keys = np.zeros(bands.shape[:2], dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for position in range(band_size):
+            clusters_at = bands[:, :, position].astype(np.uint64)
+            keys = keys * np.uint64(n_clusters) + clusters_at
+    return keys
+
+
+def yield_band_keys(
+    feature_store: FeatureStore,
+    model: LSHModel,
+    band_size: int,
+    batch_size: int = 1024,
+) -> Iterator[Tuple[List[str], np.ndarray]]:
+    """Yield the ids and band keys of every shard in the store"""
+    for ids, vectors in feature_store.iter_shards(max_workers=4):
+        with metrics.timer("hash", len(ids)):
+            clusters = model.predict_clusters(
+                np.asarray(vectors, dtype=np.float32), batch_size=batch_size
+            )
+            keys = band_keys(clusters, model.n_clusters, band_size)
+        yield ids, keys
+
+
+def candidate_pairs(
+    keys: np.ndarray, min_shared_bands: int = 1, max_bucket_size: int = 256
+) -> np.ndarray:
+    """
+    Self-join every band's buckets, returning an (M, 2) array of the row
+    pairs which share a bucket in at least `min_shared_bands` bands, with the
+    smaller row first. Every pair in a bucket is a candidate, so buckets with
+    more than `max_bucket_size` rows are skipped rather than letting the
+    number of pairs grow quadratically.
+    """
+    n_rows, n_bands = keys.shape
+    pair_codes = []
+    n_skipped = 0
+    for band in range(n_bands):
+        # a stable sort keeps the rows of each bucket in ascending order
+        order = np.argsort(keys[:, band], kind="stable")
+        sorted_keys = keys[order, band]
+        boundaries = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [n_rows]])
+        sizes = ends - starts
+        n_skipped += int(np.sum(sizes > max_bucket_size))
+        shared = (sizes > 1) & (sizes <= max_bucket_size)
+        for start, end in zip(starts[shared], ends[shared]):
+            rows = order[start:end]
+            first, second = np.triu_indices(len(rows), k=1)
+            pair_codes.append(
+                rows[first].astype(np.int64) * n_rows + rows[second]
+            )
+    if n_skipped:
+        log.warning(
+            f"Skipped {n_skipped} buckets with more than {max_bucket_size} "
+            "rows. Use a larger band size to split them up"
+        )
+    if not pair_codes:
+        return np.empty((0, 2), dtype=np.int64)
+    codes, counts = np.unique(np.concatenate(pair_codes), return_counts=True)
+    codes = codes[counts >= min_shared_bands]
+    return np.stack([codes // n_rows, codes % n_rows], axis=1)
+
+
+def verify_pairs(
+    feature_store: FeatureStore,
+    ids: List[str],
+    pairs: np.ndarray,
+    max_distance: float,
+    batch_size: int = 4096,
+) -> np.ndarray:
+    """
+    Keep the candidate pairs whose stored features are within
+    `max_distance` cosine distance of each other
+    """
+    verified = []
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start : start + batch_size]
+        with metrics.timer("verify", len(batch)):
+            rows, positions = np.unique(batch, return_inverse=True)
+            positions = positions.reshape(batch.shape)
+            vectors = np.asarray(
+                feature_store.get_many([ids[row] for row in rows]),
+                dtype=np.float32,
+            )
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.maximum(norms, 1e-12)
+            distances = 1 - np.sum(
+                vectors[positions[:, 0]] * vectors[positions[:, 1]], axis=1
+            )
+            verified.append(batch[distances <= max_distance])
+    if not verified:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.concatenate(verified)
+
+
+def cluster_pairs(pairs: np.ndarray) -> List[List[int]]:
+    """Group rows into the connected components of a set of pairs"""
+    parents: Dict[int, int] = {}
+
+    def find(row: int) -> int:
+        root = row
+        while parents.setdefault(root, root) != root:
+            root = parents[root]
+        while parents[row] != root:
+            parents[row], row = root, parents[row]
+        return root
+
+    for first, second in pairs.tolist():
+        first_root, second_root = find(first), find(second)
+        if first_root != second_root:
+            parents[max(first_root, second_root)] = min(
+                first_root, second_root
+            )
+
+    clusters: Dict[int, List[int]] = {}
+    for row in parents:
+        clusters.setdefault(find(row), []).append(row)
+    return list(clusters.values())
+
+
+def find_duplicates(
+    feature_store: FeatureStore,
+    model: LSHModel,
+    band_size: int = 8,
+    min_shared_bands: int = 1,
+    max_distance: float = 0.05,
+    max_bucket_size: int = 256,
+    batch_size: int = 1024,
+) -> List[List[str]]:
+    """
+    Find clusters of near-duplicate vectors in a feature store, without
+    comparing every pair. Every vector is hashed with the LSH model, and
+    every band of `band_size` groups is used as a bucket key. Vectors which
+    share a bucket in at least `min_shared_bands` bands are candidates, and
+    candidates whose exact cosine distance is at most `max_distance` are
+    linked into clusters. Each cluster is a sorted list of ids, whose first
+    id is the cluster's representative.
+    """
+    ids: List[str] = []
+    shard_keys = []
+    metrics.set_total("hash", len(feature_store))
+    for shard_ids, keys in yield_band_keys(
+        feature_store, model, band_size, batch_size
+    ):
+        ids.extend(shard_ids)
+        shard_keys.append(keys)
+    if not ids:
+        return []
+    keys = np.concatenate(shard_keys)
+    log.info(
+        f"Hashed {len(ids)} vectors into {keys.shape[1]} bands of "
+        f"{band_size} groups"
+    )
+
+    with metrics.timer("join"):
+        pairs = candidate_pairs(keys, min_shared_bands, max_bucket_size)
+    log.info(f"Verifying {len(pairs)} candidate pairs")
+    metrics.set_total("verify", len(pairs))
+    pairs = verify_pairs(feature_store, ids, pairs, max_distance)
+    log.info(f"Found {len(pairs)} pairs of near-duplicates")
+
+    clusters = [
+        sorted(ids[row] for row in rows) for rows in cluster_pairs(pairs)
+    ]
+    return sorted(clusters)
+
+
+def load_duplicates(name: str = default_name) -> Dict[str, str]:
+    """
+    Map the id of every near-duplicate found by find-duplicates to the id
+    of its cluster's representative. Representatives aren't included.
+    """
+    clusters = load_json(name)["clusters"]
+    return {
+        duplicate_id: cluster[0]
+        for cluster in clusters
+        for duplicate_id in cluster[1:]
+    }
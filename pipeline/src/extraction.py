@@ -0,0 +1,349 @@
+import inspect
+import json
+import os
+import sys
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import models
+
+from .log import get_logger
+
+log = get_logger()
+
+# torch and torchvision are only installed by the steps which extract
+# features, so this module is kept apart from the rest of src
+
+model_dir = Path("/data/models")
+default_backbone = os.environ.get("FEATURE_BACKBONE", "vgg16")
+default_backend = os.environ.get("FEATURE_BACKEND", "eager")
+
+BACKBONES = ("vgg16", "resnet50", "mobilenet_v3_large")
+BACKENDS = ("eager", "torchscript", "quantized", "onnx", "onnx-int8")
+# the extractor which every other one is compared against
+REFERENCE = ("vgg16", "eager")
+
+input_size = (224, 224)
+pixel_shape = (3, *input_size)
+imagenet_mean = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+imagenet_std = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+
+pixel_cache_name = os.environ.get("PIXEL_CACHE") or None
+pixel_shard_size = int(os.environ.get("PIXEL_SHARD_SIZE", 256))
+
+
+def to_pixels(image: Image.Image) -> torch.Tensor:
+    """
+    Decode an image and resize it to the model's input size, as a (3, 224,
+    224) uint8 tensor. JPEGs are decoded at the smallest reduced scale which
+    is still larger than the input, which skips most of the decoding work
+    for large images
+    """
+    image.draft("RGB", input_size)
+    image = image.convert("RGB").resize(input_size, Image.BILINEAR)
+    return torch.from_numpy(np.array(image)).permute(2, 0, 1).contiguous()
+
+
+def from_pixels(pixels: torch.Tensor) -> torch.Tensor:
+    """Normalise uint8 pixels, of one image or a batch, for the model"""
+    return (pixels.float() / 255 - imagenet_mean) / imagenet_std
+
+
+def preprocess(image: Image.Image) -> torch.Tensor:
+    return from_pixels(to_pixels(image))
+
+
+def load_pixel_cache(writer: Optional[str] = None):
+    """
+    The store of preprocessed pixels named by PIXEL_CACHE, or None if it
+    isn't set. Pixels are cached before they're normalised, so one cache
+    serves every backbone, and each image takes 150KB as a row of uint8s
+    """
+    if pixel_cache_name is None:
+        return None
+    from .feature_store import FeatureStore
+
+    return FeatureStore(
+        pixel_cache_name,
+        shard_size=pixel_shard_size,
+        dtype="uint8",
+        writer=writer,
+    )
+
+
+def build_backbone(name: str) -> torch.nn.Module:
+    """
+    A pretrained backbone with its classification head removed, so that it
+    outputs a feature vector for each image: 4096-d from vgg16's first fully
+    connected layer, 2048-d from resnet50, or 1280-d from mobilenet_v3_large
+    """
+    torch.hub.set_dir(str(model_dir))
+    if name == "vgg16":
+        module = models.vgg16(weights="DEFAULT", progress=False)
+        module.classifier = module.classifier[:4]
+    elif name == "resnet50":
+        module = models.resnet50(weights="DEFAULT", progress=False)
+        module.fc = torch.nn.Identity()
+    elif name == "mobilenet_v3_large":
+        module = models.mobilenet_v3_large(weights="DEFAULT", progress=False)
+        module.classifier = module.classifier[:2]
+    else:
+        raise ValueError(f"Unknown backbone: {name}")
+    return module.eval()
+
+
+class FeatureExtractor(ABC):
+    """Turns a batch of preprocessed images into an (N, dim) float32 array"""
+
+    def __init__(self, backbone: str, backend: str):
+        self.backbone = backbone
+        self.backend = backend
+
+    @property
+    def name(self) -> str:
+        return f"{self.backbone}:{self.backend}"
+
+    @abstractmethod
+    def __call__(self, images: torch.Tensor) -> np.ndarray:
+        ...
+
+
+class TorchExtractor(FeatureExtractor):
+    def __init__(self, backbone: str, backend: str, module: torch.nn.Module):
+        super().__init__(backbone, backend)
+        self.module = module
+
+    def __call__(self, images: torch.Tensor) -> np.ndarray:
+        with torch.inference_mode():
+            return self.module(images).numpy()
+
+
+class OnnxExtractor(FeatureExtractor):
+    def __init__(self, backbone: str, backend: str, model_path: Path):
+        # onnxruntime is an optional dependency of the onnx backends
+        import onnxruntime
+
+        super().__init__(backbone, backend)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(
+            str(model_path),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+
+    def __call__(self, images: torch.Tensor) -> np.ndarray:
+        return self.session.run(None, {"images": images.numpy()})[0]
+
+
+# newer versions of torch export through torch.export by default, whose
+# graphs onnxruntime's quantizer can't always infer shapes for
+legacy_onnx_exporter = (
+    {"dynamo": False}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters
+    else {}
+)
+
+
+def compile_extractor(
+    module: torch.nn.Module, backbone: str, backend: str
+) -> FeatureExtractor:
+    """
+    Wrap a backbone in one of the inference backends:
+
+    - eager: run the module as it is
+    - torchscript: trace and freeze the module, folding batch norms and
+      fusing convolutions with their activations
+    - quantized: dynamically quantize the weights of linear layers to int8.
+      Convolutions stay in float32, so this mostly helps vgg16, whose fully
+      connected layers hold most of its weights
+    - onnx: export the module and run it with onnxruntime
+    - onnx-int8: dynamically quantize the exported graph to int8, including
+      its convolutions. onnxruntime's int8 convolutions can be slower than
+      its float32 ones on CPUs without VNNI instructions, so check the
+      throughput before using it
+    """
+    if backend == "eager":
+        return TorchExtractor(backbone, backend, module)
+    if backend == "torchscript":
+        with torch.inference_mode():
+            traced = torch.jit.trace(module, torch.rand(1, 3, 224, 224))
+            traced = torch.jit.optimize_for_inference(
+                torch.jit.freeze(traced)
+            )
+        return TorchExtractor(backbone, backend, traced)
+    if backend == "quantized":
+        quantized = torch.ao.quantization.quantize_dynamic(
+            module, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        return TorchExtractor(backbone, backend, quantized)
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxExtractor(
+            backbone, backend, export_onnx(module, backbone, backend)
+        )
+    raise ValueError(f"Unknown extractor backend: {backend}")
+
+
+def export_onnx(module: torch.nn.Module, backbone: str, backend: str) -> Path:
+    """
+    Export a backbone to an onnx graph, quantized to int8 for onnx-int8.
+    Exports are slow, so they're cached alongside the downloaded weights
+    """
+    export_dir = model_dir / "extractors"
+    export_dir.mkdir(parents=True, exist_ok=True)
+    model_path = export_dir / f"{backbone}.onnx"
+    if not model_path.exists():
+        log.info(f"Exporting {backbone} to {model_path}")
+        temporary_path = model_path.with_suffix(".tmp")
+        torch.onnx.export(
+            module,
+            torch.rand(1, 3, 224, 224),
+            str(temporary_path),
+            input_names=["images"],
+            output_names=["features"],
+            dynamic_axes={"images": {0: "batch"}, "features": {0: "batch"}},
+            **legacy_onnx_exporter,
+        )
+        os.replace(temporary_path, model_path)
+    if backend == "onnx":
+        return model_path
+
+    quantized_path = export_dir / f"{backbone}.int8.onnx"
+    if not quantized_path.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        log.info(f"Quantizing {model_path} to {quantized_path}")
+        temporary_path = quantized_path.with_suffix(".tmp")
+        quantize_dynamic(
+            str(model_path), str(temporary_path), weight_type=QuantType.QInt8
+        )
+        os.replace(temporary_path, quantized_path)
+    return quantized_path
+
+
+def load_feature_extractor(
+    backbone: str = default_backbone, backend: str = default_backend
+) -> FeatureExtractor:
+    log.info(f"Loading {backbone} feature extractor with {backend} backend")
+    return compile_extractor(build_backbone(backbone), backbone, backend)
+
+
+def extract_all(
+    extractor: FeatureExtractor, images: torch.Tensor, batch_size: int = 32
+) -> np.ndarray:
+    return np.concatenate(
+        [extractor(batch) for batch in torch.split(images, batch_size)]
+    )
+
+
+def normalise(features: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    return features / np.maximum(norms, 1e-12)
+
+
+def neighbour_recall(
+    reference: np.ndarray, candidate: np.ndarray, k: int = 10
+) -> float:
+    """
+    The fraction of each vector's k nearest neighbours under the reference
+    features which are also among its k nearest neighbours under the
+    candidate features. Unlike a direct comparison of vectors, this works
+    across backbones with different output dimensions.
+    """
+
+    def top_k(features: np.ndarray) -> np.ndarray:
+        similarities = normalise(features) @ normalise(features).T
+        np.fill_diagonal(similarities, -np.inf)
+        return np.argpartition(-similarities, k, axis=1)[:, :k]
+
+    overlaps = [
+        len(set(reference_row) & set(candidate_row)) / k
+        for reference_row, candidate_row in zip(
+            top_k(reference), top_k(candidate)
+        )
+    ]
+    return float(np.mean(overlaps))
+
+
+def check_drift(
+    images: torch.Tensor,
+    extractors: List[str],
+    batch_size: int = 32,
+    k: int = 10,
+) -> List[Dict]:
+    """
+    Measure the throughput of each "backbone:backend" extractor, and how far
+    its features drift from the reference vgg16 eager extractor's. Backends
+    of the same backbone share its weights, so their features can be
+    compared directly by cosine similarity, while other backbones are only
+    compared by the overlap of each image's nearest neighbours.
+    """
+    backbones: Dict[str, torch.nn.Module] = {}
+    reference = None
+    results = []
+    for spec in [":".join(REFERENCE)] + extractors:
+        backbone, _, backend = spec.partition(":")
+        backend = backend or "eager"
+        if backbone not in backbones:
+            backbones[backbone] = build_backbone(backbone)
+        extractor = compile_extractor(backbones[backbone], backbone, backend)
+        # warm up, so that one-off setup isn't counted in the throughput
+        extractor(images[:1])
+        start = time.perf_counter()
+        features = extract_all(extractor, images, batch_size)
+        seconds = time.perf_counter() - start
+        if reference is None:
+            reference = features
+        result = {
+            "extractor": extractor.name,
+            "dim": features.shape[1],
+            "images_per_second": len(images) / seconds,
+            "cosine_similarity": None,
+            "min_cosine_similarity": None,
+            "neighbour_recall": neighbour_recall(reference, features, k),
+        }
+        if backbone == REFERENCE[0]:
+            similarities = np.sum(
+                normalise(reference) * normalise(features), axis=1
+            )
+            result["cosine_similarity"] = float(np.mean(similarities))
+            result["min_cosine_similarity"] = float(np.min(similarities))
+        log.info(
+            f"{extractor.name}: {result['images_per_second']:.1f} images/s, "
+            f"neighbour recall@{k} {result['neighbour_recall']:.3f}"
+            + (
+                f", cosine similarity {result['cosine_similarity']:.4f}"
+                if result["cosine_similarity"] is not None
+                else ""
+            )
+        )
+        results.append(result)
+    return results
+
+
+def load_check_images(n_images: int) -> torch.Tensor:
+    """Preprocess a sample of the downloaded images"""
+    from .io import load_image, yield_image_filenames
+    from .sampling import reservoir_sample
+
+    filenames = reservoir_sample(yield_image_filenames(), n_images, seed=0)
+    return torch.stack([preprocess(load_image(name)) for name in filenames])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "check":
+        raise SystemExit(
+            "Usage: python -m src.extraction check [backbone:backend ...]"
+        )
+    n_images = int(os.environ.get("DRIFT_CHECK_IMAGES", 256))
+    extractors = sys.argv[2:] or [
+        f"vgg16:{backend}" for backend in BACKENDS if backend != "eager"
+    ] + [f"{backbone}:eager" for backbone in BACKBONES[1:]]
+    log.info(f"Checking {len(extractors)} extractors on {n_images} images")
+    results = check_drift(load_check_images(n_images), extractors)
+    log.info(f"Drift check results:\n{json.dumps(results, indent=2)}")
@@ -0,0 +1,502 @@
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .io import (
+    bucket,
+    data_dir,
+    fetch_s3_object,
+    get_s3_client,
+    load_features,
+    load_many,
+    map_concurrently,
+    s3_cache,
+    s3_concurrency,
+    storage_env,
+    yield_feature_filenames,
+)
+from .log import get_logger
+from .model import LSHModel
+
+log = get_logger()
+
+FORMAT_VERSION = 1
+SUPPORTED_DTYPES = ("float32", "float16", "int8", "uint8")
+
+default_name = os.environ.get("FEATURE_STORE", "feature-shards")
+default_dtype = os.environ.get("FEATURE_DTYPE", "float32")
+
+
+def next_shard_name(shards: Iterable[str], writer: Optional[str]) -> str:
+    """
+    The name of a writer's next shard. Shards are named <number>, or
+    <writer>-<number> if they were written by a named writer
+    """
+    numbers = []
+    for shard in shards:
+        shard_writer, _, number = shard.rpartition("-")
+        if (shard_writer or None) == writer:
+            numbers.append(int(number))
+    shard_number = max(numbers) + 1 if numbers else 0
+    if writer is None:
+        return f"{shard_number:06d}"
+    return f"{writer}-{shard_number:06d}"
+
+
+class FeatureStore:
+    """
+    An append-only store of fixed-width feature vectors, split across shards
+    of raw row-major arrays. Each shard has a sidecar file listing the id of
+    every row, and together they make up the id -> (shard, row) index.
+
+    Locally, shards are read through np.memmap without copying. On s3, single
+    rows and runs of neighbouring rows are fetched with ranged GETs.
+
+    Vectors can be stored as float32, float16, int8 or uint8. int8 rows are
+    quantized symmetrically, and each is prefixed with its float32 scale, so
+    a 4096-d vector takes 4100 bytes rather than 16384. The dtype of an
+    existing store is read from its metadata, and int8 vectors are returned
+    as float32. uint8 rows are stored and returned as they are, for data
+    which is already in bytes, like preprocessed pixels.
+
+    Several processes can append to the same store if each is given a
+    different `writer` name, which prefixes the names of the shards it
+    writes so that they never collide.
+    """
+
+    def __init__(
+        self,
+        name: str = default_name,
+        shard_size: int = 4096,
+        dtype: str = default_dtype,
+        writer: Optional[str] = None,
+    ):
+        if storage_env not in ("local", "s3"):
+            raise ValueError(f"Unknown environment: {storage_env}")
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Unsupported feature dtype: {dtype}")
+        self.name = name
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+        self.writer = writer
+        self.dim: Optional[int] = None
+        self.index: Dict[str, Tuple[str, int]] = {}
+        self.shard_ids: Dict[str, List[str]] = {}
+        self._memmaps: Dict[str, np.memmap] = {}
+        self._buffer_ids: List[str] = []
+        # the position of every buffered id in _buffer_rows
+        self._buffered: Dict[str, int] = {}
+        self._buffer_rows: List[np.ndarray] = []
+        if storage_env == "local":
+            (data_dir / name).mkdir(parents=True, exist_ok=True)
+        self.load_index()
+
+    def __len__(self) -> int:
+        return len(self.index) + len(self._buffer_ids)
+
+    def __contains__(self, feature_id: str) -> bool:
+        return feature_id in self.index or feature_id in self._buffered
+
+    def ids(self) -> Iterator[str]:
+        for ids in self.shard_ids.values():
+            yield from ids
+
+    @property
+    def quantized(self) -> bool:
+        return self.dtype == np.int8
+
+    @property
+    def vector_dtype(self) -> np.dtype:
+        """The dtype of the vectors which are returned by reads"""
+        return np.dtype(np.float32) if self.quantized else self.dtype
+
+    @property
+    def row_dtype(self) -> np.dtype:
+        """The dtype of one row of a shard file"""
+        if self.quantized:
+            return np.dtype([("scale", "<f4"), ("values", "i1", (self.dim,))])
+        return np.dtype((self.dtype, (self.dim,)))
+
+    @property
+    def row_bytes(self) -> int:
+        return self.row_dtype.itemsize
+
+    def _encode(self, vectors: np.ndarray) -> bytes:
+        if not self.quantized:
+            return np.ascontiguousarray(vectors, dtype=self.dtype).tobytes()
+        rows = np.empty(len(vectors), dtype=self.row_dtype)
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        rows["scale"] = scales
+        rows["values"] = np.rint(vectors / scales[:, np.newaxis])
+        return rows.tobytes()
+
+    def _decode(self, rows: np.ndarray) -> np.ndarray:
+        """Turn an array of rows of row_dtype into an (N, dim) array"""
+        if not self.quantized:
+            return rows
+        return rows["values"] * rows["scale"][:, np.newaxis]
+
+    def load_index(self):
+        self.index, self.shard_ids = {}, {}
+        self.refresh()
+        log.debug(
+            f"Loaded feature store index with {len(self.index)} vectors "
+            f"in {len(self.shard_ids)} shards"
+        )
+
+    def refresh(self) -> int:
+        """
+        Add any shards which other processes have written since the index
+        was loaded, returning the number of new vectors
+        """
+        if self.dim is None:
+            metadata = self._read_json("meta.json")
+            if metadata is not None:
+                if metadata["version"] != FORMAT_VERSION:
+                    raise ValueError(
+                        "Unsupported feature store version: "
+                        f"{metadata['version']}"
+                    )
+                self.dim = metadata["dim"]
+                self.dtype = np.dtype(metadata["dtype"])
+
+        n_new = 0
+        for shard in self._list_shards():
+            if shard in self.shard_ids:
+                continue
+            ids = self._read_bytes(f"{shard}.ids").decode("utf-8").split()
+            # readers look ids up in the index before they look for the
+            # shard, so the shard is added first
+            self.shard_ids[shard] = ids
+            for row, feature_id in enumerate(ids):
+                self.index[feature_id] = (shard, row)
+            n_new += len(ids)
+        return n_new
+
+    def append(self, feature_id: str, features: np.ndarray):
+        features = np.asarray(features, dtype=self.vector_dtype).reshape(-1)
+        if self.dim is None:
+            self.dim = features.shape[0]
+        elif features.shape[0] != self.dim:
+            raise ValueError(
+                f"Expected a vector of length {self.dim}, "
+                f"got {features.shape[0]}"
+            )
+        self._buffered[feature_id] = len(self._buffer_rows)
+        self._buffer_ids.append(feature_id)
+        self._buffer_rows.append(features)
+        if len(self._buffer_ids) >= self.shard_size:
+            self.flush()
+
+    def append_many(self, feature_ids: Iterable[str], features: np.ndarray):
+        for feature_id, row in zip(feature_ids, features):
+            self.append(feature_id, row)
+
+    def flush(self):
+        if not self._buffer_ids:
+            return
+        if self._read_json("meta.json") is None:
+            self._write_bytes(
+                "meta.json",
+                json.dumps(
+                    {
+                        "version": FORMAT_VERSION,
+                        "dim": self.dim,
+                        "dtype": self.dtype.str,
+                    }
+                ).encode("utf-8"),
+            )
+
+        shard = self._next_shard_name()
+        log.debug(f"Writing {len(self._buffer_ids)} vectors to shard {shard}")
+        # the ids file is written last, so that readers never see a shard
+        # whose data isn't complete
+        self._write_bytes(
+            f"{shard}.bin", self._encode(np.vstack(self._buffer_rows))
+        )
+        self._write_bytes(
+            f"{shard}.ids", "\n".join(self._buffer_ids).encode("utf-8")
+        )
+
+        self.shard_ids[shard] = self._buffer_ids
+        for row, feature_id in enumerate(self._buffer_ids):
+            self.index[feature_id] = (shard, row)
+        self._buffer_ids, self._buffer_rows = [], []
+        self._buffered = {}
+
+    def _next_shard_name(self) -> str:
+        return next_shard_name(self._list_shards(), self.writer)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, feature_id: str) -> np.ndarray:
+        # vectors which haven't been flushed yet are served from the buffer
+        if feature_id in self._buffered:
+            return self._buffer_rows[self._buffered[feature_id]]
+        shard, row = self.index[feature_id]
+        if storage_env == "local":
+            return self._decode(self._memmap(shard)[row : row + 1])[0]
+        return self._read_rows(shard, row, row + 1)[0]
+
+    def get_many(
+        self, feature_ids: List[str], max_workers: int = s3_concurrency
+    ) -> np.ndarray:
+        if not feature_ids:
+            # an empty store doesn't know its dimension yet
+            return np.empty((0, self.dim or 0), dtype=self.vector_dtype)
+        result = np.empty(
+            (len(feature_ids), self.dim), dtype=self.vector_dtype
+        )
+        by_shard: Dict[str, List[Tuple[int, int]]] = {}
+        for position, feature_id in enumerate(feature_ids):
+            if feature_id in self._buffered:
+                buffer_row = self._buffered[feature_id]
+                result[position] = self._buffer_rows[buffer_row]
+                continue
+            shard, row = self.index[feature_id]
+            by_shard.setdefault(shard, []).append((row, position))
+
+        if storage_env == "local":
+            for shard, rows in by_shard.items():
+                shard_rows, positions = zip(*rows)
+                shard_array = self._memmap(shard)
+                result[list(positions)] = self._decode(
+                    shard_array[list(shard_rows)]
+                )
+            return result
+
+        def read_shard(shard_rows: Tuple[str, List[Tuple[int, int]]]):
+            # coalesce neighbouring rows into a single ranged read
+            shard, rows = shard_rows
+            rows.sort()
+            start = 0
+            for end in range(1, len(rows) + 1):
+                if end == len(rows) or rows[end][0] != rows[end - 1][0] + 1:
+                    first, last = rows[start][0], rows[end - 1][0]
+                    block = self._read_rows(shard, first, last + 1)
+                    for row, position in rows[start:end]:
+                        result[position] = block[row - first]
+                    start = end
+
+        if len(by_shard) == 1:
+            read_shard(next(iter(by_shard.items())))
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(read_shard, by_shard.items()))
+        return result
+
+    def iter_shards(
+        self, shards: Optional[Iterable[str]] = None, max_workers: int = 1
+    ) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """
+        Yield the (ids, array) of every shard, or of the given shards in the
+        given order. On s3, up to max_workers shards are read ahead
+        concurrently.
+        """
+        shards = list(self.shard_ids) if shards is None else shards
+        if storage_env == "local":
+            for shard in shards:
+                yield self.shard_ids[shard], self._decode(self._memmap(shard))
+            return
+
+        def read_shard(shard: str) -> np.ndarray:
+            return self._read_rows(shard, 0, len(self.shard_ids[shard]))
+
+        if max_workers <= 1:
+            for shard in shards:
+                yield self.shard_ids[shard], read_shard(shard)
+            return
+        for shard, array in map_concurrently(
+            read_shard, shards, max_workers=max_workers
+        ):
+            yield self.shard_ids[shard], array
+
+    def _memmap(self, shard: str) -> np.memmap:
+        if shard not in self._memmaps:
+            self._memmaps[shard] = np.memmap(
+                self._local_path(f"{shard}.bin"),
+                dtype=self.row_dtype,
+                mode="r",
+                shape=(len(self.shard_ids[shard]),),
+            )
+        return self._memmaps[shard]
+
+    def _read_rows(self, shard: str, start: int, end: int) -> np.ndarray:
+        data = self._read_bytes(
+            f"{shard}.bin",
+            byte_range=(start * self.row_bytes, end * self.row_bytes - 1),
+        )
+        return self._decode(np.frombuffer(data, dtype=self.row_dtype))
+
+    def _local_path(self, filename: str) -> Path:
+        return data_dir / self.name / filename
+
+    def _key(self, filename: str) -> str:
+        return f"{self.name}/{filename}"
+
+    def _list_shards(self) -> List[str]:
+        if storage_env == "local":
+            filenames = [
+                path.name for path in (data_dir / self.name).iterdir()
+            ]
+        else:
+            s3 = get_s3_client()
+            paginator = s3.get_paginator("list_objects_v2")
+            filenames = []
+            pages = paginator.paginate(Bucket=bucket, Prefix=f"{self.name}/")
+            for page in pages:
+                for content in page.get("Contents", []):
+                    filenames.append(Path(content["Key"]).name)
+        return sorted(
+            filename[: -len(".ids")]
+            for filename in filenames
+            if filename.endswith(".ids")
+        )
+
+    def _read_json(self, filename: str) -> Optional[dict]:
+        try:
+            return json.loads(self._read_bytes(filename))
+        except (FileNotFoundError, KeyError):
+            return None
+
+    def _read_bytes(
+        self, filename: str, byte_range: Optional[Tuple[int, int]] = None
+    ) -> bytes:
+        if storage_env == "local":
+            return self._read_file(self._local_path(filename), byte_range)
+
+        key = self._key(filename)
+        s3 = get_s3_client()
+        try:
+            if s3_cache is not None and filename != "meta.json":
+                # shards are never modified, so the whole object is cached
+                # and ranges are read from the local copy
+                path = s3_cache.get_path_or_fetch(
+                    f"{bucket}/{key}", lambda: fetch_s3_object(key)
+                )
+                try:
+                    return self._read_file(path, byte_range)
+                except FileNotFoundError:
+                    log.debug(f"{path} was evicted while being read")
+            return fetch_s3_object(
+                key,
+                byte_range=(
+                    f"bytes={byte_range[0]}-{byte_range[1]}"
+                    if byte_range is not None
+                    else None
+                ),
+            )
+        except s3.exceptions.NoSuchKey as e:
+            raise KeyError(filename) from e
+
+    @staticmethod
+    def _read_file(
+        path: Path, byte_range: Optional[Tuple[int, int]] = None
+    ) -> bytes:
+        with open(path, "rb") as f:
+            if byte_range is None:
+                return f.read()
+            f.seek(byte_range[0])
+            return f.read(byte_range[1] - byte_range[0] + 1)
+
+    def _write_bytes(self, filename: str, data: bytes):
+        if storage_env == "local":
+            path = self._local_path(filename)
+            temporary_path = path.with_suffix(path.suffix + ".tmp")
+            with open(temporary_path, "wb") as f:
+                f.write(data)
+            os.replace(temporary_path, path)
+        else:
+            s3 = get_s3_client()
+            s3.put_object(
+                Bucket=bucket,
+                Key=self._key(filename),
+                Body=data,
+                ContentType="application/octet-stream",
+            )
+
+
+def migrate_feature_files(
+    store: Optional[FeatureStore] = None,
+) -> FeatureStore:
+    """
+    Copy features saved in the old one-file-per-image format into a
+    FeatureStore, skipping any which it already holds
+    """
+    store = store or FeatureStore()
+    filenames = (
+        filename
+        for filename in yield_feature_filenames()
+        if filename not in store
+    )
+    with store:
+        for i, (filename, features) in enumerate(
+            load_many(load_features, filenames)
+        ):
+            store.append(filename, features)
+            if i % 10000 == 0:
+                log.info(f"Migrated {i} feature files")
+    log.info(f"Feature store holds {len(store)} vectors")
+    return store
+
+
+def compress_feature_store(
+    target: FeatureStore,
+    source: Optional[FeatureStore] = None,
+    model: Optional[LSHModel] = None,
+) -> FeatureStore:
+    """
+    Copy the vectors in a store into another, converting them to the target's
+    dtype, and projecting them into the reduced space of `model` if it has a
+    reduction. Vectors which the target already holds are skipped, so it can
+    be re-run as new features arrive.
+    """
+    source = source or FeatureStore()
+    with target:
+        for ids, vectors in source.iter_shards(max_workers=4):
+            rows = [
+                i
+                for i, feature_id in enumerate(ids)
+                if feature_id not in target
+            ]
+            if not rows:
+                continue
+            vectors = np.asarray(vectors[rows], dtype=np.float32)
+            if model is not None:
+                vectors = model.reduce(vectors)
+            target.append_many([ids[i] for i in rows], vectors)
+    log.info(
+        f"Compressed {len(source)} vectors of {source.row_bytes} bytes into "
+        f"{len(target)} vectors of {target.row_bytes} bytes"
+    )
+    return target
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "compress":
+        if len(sys.argv) not in (4, 5):
+            raise SystemExit(
+                "Usage: python -m src.feature_store compress "
+                "<target name> <dtype> [model name]"
+            )
+        from .io import load_model
+
+        compress_feature_store(
+            FeatureStore(sys.argv[2], dtype=sys.argv[3]),
+            model=load_model(sys.argv[4]) if len(sys.argv) == 5 else None,
+        )
+    else:
+        migrate_feature_files()
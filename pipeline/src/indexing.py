@@ -0,0 +1,335 @@
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import (
+    ConnectionError as ElasticsearchConnectionError,
+    RequestError,
+    TransportError,
+)
+
+from .log import get_logger
+from .metrics import metrics
+
+log = get_logger()
+
+# statuses which mean that the cluster was too busy to accept a document,
+# rather than that the document itself was bad
+RETRYABLE_STATUSES = {429, 502, 503, 504}
+MAX_RECORDED_ERRORS = 100
+
+
+def get_elasticsearch_endpoint() -> str:
+    if os.environ.get("ELASTICSEARCH_URL"):
+        return os.environ.get("ELASTICSEARCH_URL")
+    return "https://" + os.environ.get("AWS_OPENSEARCH_ENDPOINT") + ":443"
+
+
+def get_elasticsearch_auth() -> Optional[Tuple[str, str]]:
+    if not os.environ.get("AWS_OPENSEARCH_USERNAME"):
+        return None
+    return (
+        os.environ.get("AWS_OPENSEARCH_USERNAME"),
+        os.environ.get("AWS_OPENSEARCH_PASSWORD"),
+    )
+
+
+def get_elasticsearch_client(
+    endpoint: Optional[str] = None, maxsize: int = 10
+) -> Elasticsearch:
+    return Elasticsearch(
+        endpoint or get_elasticsearch_endpoint(),
+        http_auth=get_elasticsearch_auth(),
+        maxsize=maxsize,
+    )
+
+
+def get_async_elasticsearch_client(
+    endpoint: Optional[str] = None, maxsize: int = 10
+):
+    # the async client needs aiohttp, which only the search api installs
+    from elasticsearch import AsyncElasticsearch
+
+    return AsyncElasticsearch(
+        endpoint or get_elasticsearch_endpoint(),
+        http_auth=get_elasticsearch_auth(),
+        maxsize=maxsize,
+    )
+
+
+def get_index_name(model_name: str) -> str:
+    return model_name.replace("T", "-").replace(":", "-")
+
+
+# hashes are only ever matched exactly by term queries, so they're indexed
+# without doc values, norms or frequencies, and left out of the stored
+# _source, which search results never read
+INDEX_MAPPINGS = {
+    "_source": {"excludes": ["lsh-hash"]},
+    "properties": {
+        "lsh-hash": {
+            "type": "keyword",
+            "doc_values": False,
+            "norms": False,
+            "index_options": "docs",
+        },
+        "description": {"type": "text", "analyzer": "english"},
+    }
+}
+
+
+def get_versioned_index_name(alias: str, version: Optional[str] = None) -> str:
+    return f"{alias}-{version or datetime.now().strftime('%Y%m%d%H%M%S')}"
+
+
+def create_index(
+    es: Elasticsearch,
+    index_name: str,
+    bulk_build: bool = False,
+    exist_ok: bool = False,
+):
+    settings = {"codec": "best_compression"}
+    if bulk_build:
+        # refreshing while an index is built from scratch is wasted work,
+        # because nothing searches it until the alias is swapped over
+        settings["refresh_interval"] = "-1"
+    try:
+        es.indices.create(
+            index=index_name,
+            body={"settings": settings, "mappings": INDEX_MAPPINGS},
+        )
+    except RequestError as e:
+        # parallel tasks building the same index all try to create it
+        if not exist_ok or e.error != "resource_already_exists_exception":
+            raise
+        log.info(f"Index {index_name} already exists")
+
+
+def finish_bulk_build(es: Elasticsearch, index_name: str):
+    es.indices.put_settings(
+        index=index_name, body={"index": {"refresh_interval": None}}
+    )
+    es.indices.refresh(index=index_name)
+
+
+def resolve_alias(es: Elasticsearch, alias: str) -> str:
+    """
+    The name of the index which an alias points at. Indices built before
+    aliases were introduced have the alias' name themselves.
+    """
+    if es.indices.exists_alias(name=alias):
+        return next(iter(es.indices.get_alias(name=alias)))
+    return alias
+
+
+def swap_alias(
+    es: Elasticsearch, alias: str, index_name: str, delete_old: bool = True
+) -> List[str]:
+    """
+    Atomically point an alias at a new index, removing it from any indices
+    it pointed at before. Indices built before aliases were introduced have
+    the alias' name themselves, so they're removed in the same action.
+    """
+    actions = [{"add": {"index": index_name, "alias": alias}}]
+    old_indices = []
+    if es.indices.exists_alias(name=alias):
+        old_indices = list(es.indices.get_alias(name=alias).keys())
+        actions = [
+            {"remove": {"index": old_index, "alias": alias}}
+            for old_index in old_indices
+        ] + actions
+    elif es.indices.exists(index=alias):
+        actions.insert(0, {"remove_index": {"index": alias}})
+    es.indices.update_aliases(body={"actions": actions})
+    log.info(f"Pointed alias {alias} at {index_name}")
+
+    if delete_old:
+        for old_index in old_indices:
+            if old_index != index_name:
+                log.info(f"Deleting old index {old_index}")
+                es.indices.delete(index=old_index)
+    return old_indices
+
+
+def find_missing_ids(
+    es: Elasticsearch, index_name: str, ids: List[str]
+) -> List[str]:
+    if not ids:
+        return []
+    response = es.mget(index=index_name, body={"ids": ids}, _source=False)
+    return [doc["_id"] for doc in response["docs"] if not doc.get("found")]
+
+
+@dataclass
+class BulkIndexSummary:
+    indexed: int = 0
+    failed: int = 0
+    retried: int = 0
+    duplicates: int = 0
+    requests: int = 0
+    seconds: float = 0.0
+    errors: List[Tuple[str, str]] = field(default_factory=list)
+
+    @property
+    def docs_per_second(self) -> float:
+        return self.indexed / self.seconds if self.seconds else 0.0
+
+    def merge(self, other: "BulkIndexSummary"):
+        self.indexed += other.indexed
+        self.failed += other.failed
+        self.retried += other.retried
+        self.duplicates += other.duplicates
+        self.requests += other.requests
+        self.seconds += other.seconds
+        free = MAX_RECORDED_ERRORS - len(self.errors)
+        self.errors.extend(other.errors[: max(free, 0)])
+
+    def __str__(self) -> str:
+        return (
+            f"Indexed {self.indexed} documents in {self.seconds:.1f}s "
+            f"({self.docs_per_second:.1f} docs/s) over {self.requests} bulk "
+            f"requests, with {self.retried} retries, {self.failed} "
+            f"failures and {self.duplicates} duplicate ids"
+        )
+
+
+def chunk(iterable: Iterable, size: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def index_batch(
+    es: Elasticsearch,
+    index_name: str,
+    documents: Dict[str, dict],
+    summary: BulkIndexSummary,
+    lock: threading.Lock,
+    max_retries: int = 3,
+    backoff: float = 1.0,
+):
+    pending = documents
+    for attempt in range(max_retries + 1):
+        body = []
+        for document_id, document in pending.items():
+            body.append({"index": {"_index": index_name, "_id": document_id}})
+            body.append(document)
+
+        retry = {}
+        try:
+            with metrics.timer("index", len(pending)):
+                response = es.bulk(body=body)
+        except TransportError as e:
+            log.warning(
+                f"Bulk request of {len(pending)} documents failed: {e}"
+            )
+            response = None
+            if attempt < max_retries and request_is_retryable(e):
+                retry = pending
+            else:
+                with lock:
+                    summary.failed += len(pending)
+                    for document_id in pending:
+                        record_error(summary, document_id, str(e))
+
+        with lock:
+            summary.requests += 1
+            for item in response["items"] if response else []:
+                result = item["index"]
+                document_id, status = result["_id"], result["status"]
+                if status < 300:
+                    summary.indexed += 1
+                elif status in RETRYABLE_STATUSES and attempt < max_retries:
+                    retry[document_id] = pending[document_id]
+                else:
+                    summary.failed += 1
+                    error = str(result.get("error"))
+                    record_error(summary, document_id, error)
+            summary.retried += len(retry)
+
+        if not retry:
+            return
+        pending = retry
+        time.sleep(backoff * 2**attempt)
+
+
+def request_is_retryable(error: TransportError) -> bool:
+    """
+    Whether a failed bulk request is worth retrying, because the cluster was
+    unreachable or overloaded rather than the request itself being bad. A
+    malformed or unauthorised request fails the same way every time.
+    """
+    # ConnectionTimeout is a subclass of ConnectionError
+    if isinstance(error, ElasticsearchConnectionError):
+        return True
+    status = error.status_code
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+def record_error(summary: BulkIndexSummary, document_id: str, error: str):
+    if len(summary.errors) < MAX_RECORDED_ERRORS:
+        summary.errors.append((document_id, error))
+
+
+def bulk_index(
+    es: Elasticsearch,
+    index_name: str,
+    documents: Iterable[Tuple[str, dict]],
+    batch_size: int = 500,
+    concurrency: int = 4,
+    max_retries: int = 3,
+    backoff: float = 1.0,
+) -> BulkIndexSummary:
+    """
+    Index (id, document) pairs with the bulk API, keeping at most
+    `concurrency` bulk requests of `batch_size` documents in flight. Items
+    which the cluster rejects as overloaded are retried individually with
+    exponential backoff, as are whole requests which fail because the
+    cluster is unreachable or overloaded. Everything else which fails is
+    counted in the returned summary, along with ids which appear more than
+    once in a batch.
+    """
+    summary = BulkIndexSummary()
+    lock = threading.Lock()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = set()
+        for batch in chunk(documents, batch_size):
+            batch_documents = dict(batch)
+            # a bulk request which names an id twice only keeps the last
+            # document, so the earlier ones are counted rather than indexed
+            n_duplicates = len(batch) - len(batch_documents)
+            if n_duplicates:
+                log.warning(
+                    f"Skipping {n_duplicates} documents whose ids appear "
+                    "again later in the same batch"
+                )
+                with lock:
+                    summary.duplicates += n_duplicates
+            if len(in_flight) >= concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            in_flight.add(
+                executor.submit(
+                    index_batch,
+                    es,
+                    index_name,
+                    batch_documents,
+                    summary,
+                    lock,
+                    max_retries,
+                    backoff,
+                )
+            )
+        for future in wait(in_flight).done:
+            future.result()
+
+    summary.seconds = time.perf_counter() - start
+    return summary
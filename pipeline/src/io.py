@@ -1,13 +1,32 @@
+import atexit
 import json
 import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from io import BytesIO
 from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+from uuid import uuid4
 
 import boto3
 import numpy as np
-from botocore.exceptions import ClientError
+from botocore.config import Config
 from PIL import Image
 
+from .cache import DiskCache
 from .log import get_logger
 from .model import LSHModel
 
@@ -17,19 +36,46 @@ log = get_logger()
 storage_env = os.environ.get("STORAGE_ENVIRONMENT")
 bucket = os.environ.get("AWS_S3_BUCKET_ID")
 boto3.setup_default_session(profile_name=os.environ.get("AWS_PROFILE", None))
-session = {"s3": boto3.client("s3")}
-if os.environ.get("AWS_LOCAL_ROLE_ARN"):
+
+
+s3_endpoint_url = os.environ.get("AWS_S3_ENDPOINT_URL")
+s3_concurrency = int(os.environ.get("S3_CONCURRENCY", 32))
+s3_config = Config(
+    max_pool_connections=s3_concurrency,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+)
+# assumed-role credentials are replaced this long before they expire
+credential_refresh_margin = timedelta(minutes=5)
+
+
+def create_s3_client():
+    """
+    Create an s3 client with a connection pool large enough to be shared by
+    s3_concurrency threads, returning it along with the expiry time of its
+    credentials if they come from an assumed role
+    """
+    if not os.environ.get("AWS_LOCAL_ROLE_ARN"):
+        client = boto3.client(
+            "s3", endpoint_url=s3_endpoint_url, config=s3_config
+        )
+        return client, None
     sts = boto3.client("sts")
     credentials = sts.assume_role(
         RoleArn=os.environ.get("AWS_LOCAL_ROLE_ARN"),
         RoleSessionName="local-session"
     )["Credentials"]
-    session["s3"] = boto3.client(
+    client = boto3.client(
         "s3",
         aws_access_key_id=credentials["AccessKeyId"],
         aws_secret_access_key=credentials["SecretAccessKey"],
         aws_session_token=credentials["SessionToken"],
+        endpoint_url=s3_endpoint_url,
+        config=s3_config,
     )
+    return client, credentials["Expiration"]
+
+
+session = {"s3": None, "expiration": None, "lock": threading.Lock()}
 
 data_dir = Path("/data").absolute()
 data_dir.mkdir(parents=True, exist_ok=True)
@@ -39,26 +85,120 @@ feature_dir = data_dir / "features"
 feature_dir.mkdir(parents=True, exist_ok=True)
 model_dir = data_dir / "models"
 model_dir.mkdir(parents=True, exist_ok=True)
+manifest_dir = data_dir / "manifests"
+
+# .lsh files hold the current model format, while .npy files hold models
+# pickled by older versions of LSHModel
+MODEL_SUFFIXES = {".lsh", ".npy"}
+
+
+def get_s3_client():
+    with session["lock"]:
+        expiration = session["expiration"]
+        if session["s3"] is None or (
+            expiration is not None
+            and datetime.now(timezone.utc)
+            > expiration - credential_refresh_margin
+        ):
+            log.debug("Creating s3 client")
+            session["s3"], session["expiration"] = create_s3_client()
+        return session["s3"]
+
+
+def reset_s3_client():
+    # boto3 clients shouldn't be shared across processes, so forked workers
+    # need to create their own
+    session["lock"] = threading.Lock()
+    session["s3"], session["expiration"] = None, None
+
+
+# images, features, feature shards and models are never overwritten once
+# they've been written, so they can be cached on local disk when
+# S3_CACHE_SIZE_GB is set. JSON and manifests change, so they're always read
+# from s3.
+s3_cache_size_gb = float(os.environ.get("S3_CACHE_SIZE_GB", 0))
+s3_cache = (
+    DiskCache(data_dir / "cache", int(s3_cache_size_gb * 1e9))
+    if s3_cache_size_gb
+    else None
+)
+
+
+def fetch_s3_object(key: str, byte_range: Optional[str] = None) -> bytes:
+    kwargs = {"Bucket": bucket, "Key": key}
+    if byte_range is not None:
+        kwargs["Range"] = byte_range
+    return get_s3_client().get_object(**kwargs)["Body"].read()
+
+
+def read_s3_object(key: str) -> bytes:
+    if s3_cache is None:
+        return fetch_s3_object(key)
+    return s3_cache.get_or_fetch(
+        f"{bucket}/{key}", lambda: fetch_s3_object(key)
+    )
 
 
-def get_s3_client(s3=session["s3"]):
-    try:
-        s3.head_bucket(Bucket=bucket)
-    except ClientError:
-        log.debug("Session expired, refreshing")
-        sts = boto3.client("sts")
-        credentials = sts.assume_role(
-            RoleArn=os.environ.get("AWS_LOCAL_ROLE_ARN"),
-            RoleSessionName="local-session"
-        )["Credentials"]
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=credentials["AccessKeyId"],
-            aws_secret_access_key=credentials["SecretAccessKey"],
-            aws_session_token=credentials["SessionToken"],
-        )
-        session["s3"] = s3
-    return s3
+@atexit.register
+def log_cache_stats():
+    if s3_cache is not None and s3_cache.hits + s3_cache.misses:
+        log.info(f"s3 cache stats: {s3_cache.stats()}")
+
+
+def map_concurrently(
+    function: Callable[[Any], Any],
+    items: Iterable[Any],
+    max_workers: int = s3_concurrency,
+    describe: Callable[[Any], str] = str,
+) -> Iterator[Tuple[Any, Any]]:
+    """
+    Apply a function to many items across a pool of threads, keeping a
+    bounded number in flight and yielding (item, result) pairs in order.
+    Items which raise are logged and skipped.
+    """
+
+    def call(item):
+        try:
+            return True, function(item)
+        except Exception as e:
+            log.error(f"Error processing {describe(item)}: {e}")
+            return False, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        for item in items:
+            if len(in_flight) >= max_workers * 2:
+                done_item, future = in_flight.popleft()
+                succeeded, result = future.result()
+                if succeeded:
+                    yield done_item, result
+            in_flight.append((item, executor.submit(call, item)))
+        for done_item, future in in_flight:
+            succeeded, result = future.result()
+            if succeeded:
+                yield done_item, result
+
+
+def load_many(
+    load: Callable[[str], Any],
+    filenames: Iterable[str],
+    max_workers: int = s3_concurrency,
+) -> Iterator[Tuple[str, Any]]:
+    return map_concurrently(load, filenames, max_workers=max_workers)
+
+
+def save_many(
+    save: Callable[[Any, str], None],
+    items: Iterable[Tuple[Any, str]],
+    max_workers: int = s3_concurrency,
+) -> int:
+    saved = map_concurrently(
+        lambda item: save(*item),
+        items,
+        max_workers=max_workers,
+        describe=lambda item: item[1],
+    )
+    return sum(1 for _ in saved)
 
 
 def save_image(image: Image, filename: str):
@@ -68,6 +208,7 @@ def save_image(image: Image, filename: str):
         save_image_to_s3(image, filename)
     else:
         raise ValueError(f"Unknown environment: {storage_env}")
+    get_manifest("images").add(filename)
 
 
 def save_image_locally(image: Image, filename: str):
@@ -102,8 +243,11 @@ def save_json(json_data: dict, filename: str):
 def save_json_locally(json_data: dict, filename: str):
     path = data_dir / f"{filename}.json"
     log.debug(f"Saving json to {path}")
-    with open(path, "w", encoding="utf-8") as f:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = path.with_suffix(".tmp")
+    with open(temporary_path, "w", encoding="utf-8") as f:
         json.dump(json_data, f)
+    os.replace(temporary_path, path)
 
 
 def save_json_to_s3(json_data: dict, filename: str):
@@ -125,6 +269,7 @@ def save_features(array: np.ndarray, filename: str):
         save_features_to_s3(array, filename)
     else:
         raise ValueError(f"Unknown environment: {storage_env}")
+    get_manifest("features").add(filename)
 
 
 def save_features_locally(array: np.ndarray, filename: str):
@@ -157,14 +302,14 @@ def save_model(model: LSHModel, model_name: str):
 
 
 def save_model_locally(model: LSHModel, model_name: str):
-    path = model_dir / model_name
+    path = model_dir / f"{model_name}.lsh"
     log.debug(f"Saving model to {path}")
     model.save(path)
 
 
 def save_model_to_s3(model: LSHModel, model_name: str):
     s3 = get_s3_client()
-    key = f"models/{model_name}.npy"
+    key = f"models/{model_name}.lsh"
     log.debug(f"Saving model to s3: {bucket} {key}")
     model_binary = BytesIO()
     model.save(model_binary)
@@ -172,7 +317,7 @@ def save_model_to_s3(model: LSHModel, model_name: str):
         Bucket=bucket,
         Key=key,
         Body=model_binary.getvalue(),
-        ContentType="application/numpy",
+        ContentType="application/octet-stream",
     )
 
 
@@ -192,14 +337,20 @@ def load_image_locally(filename: str):
 
 
 def load_image_from_s3(filename: str):
-    s3 = get_s3_client()
     key = f"images/{filename}.jpg"
     log.debug(f"Loading image from s3: {bucket} {key}")
-    image_bytes = BytesIO(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
-    return Image.open(image_bytes)
+    return Image.open(BytesIO(read_s3_object(key)))
 
 
 def yield_image_filenames():
+    return iter(get_manifest("images"))
+
+
+def count_images():
+    return len(get_manifest("images"))
+
+
+def list_image_filenames():
     if storage_env == "local":
         return yield_image_filenames_locally()
     elif storage_env == "s3":
@@ -216,33 +367,11 @@ def yield_image_filenames_locally():
 def yield_image_filenames_from_s3():
     s3 = get_s3_client()
     paginator = s3.get_paginator("list_objects_v2")
-    for page in paginator.paginate(Bucket=bucket, Prefix="images"):
-        for content in page["Contents"]:
+    for page in paginator.paginate(Bucket=bucket, Prefix="images/"):
+        for content in page.get("Contents", []):
             yield Path(content["Key"]).stem
 
 
-def count_images():
-    if storage_env == "local":
-        return count_images_locally()
-    elif storage_env == "s3":
-        return count_images_from_s3()
-    else:
-        raise ValueError(f"Unknown environment: {storage_env}")
-
-
-def count_images_locally():
-    return len(list(image_dir.iterdir()))
-
-
-def count_images_from_s3():
-    s3 = get_s3_client()
-    paginator = s3.get_paginator("list_objects_v2")
-    count = 0
-    for page in paginator.paginate(Bucket=bucket, Prefix="images"):
-        count += len(page["Contents"])
-    return count
-
-
 def load_features(filename: str):
     if storage_env == "local":
         return load_features_locally(filename)
@@ -259,16 +388,20 @@ def load_features_locally(filename: str):
 
 
 def load_features_from_s3(filename: str):
-    s3 = get_s3_client()
     key = f"features/{filename}.npy"
     log.debug(f"Loading numpy array from s3: {bucket} {key}")
-    return np.load(
-        BytesIO(s3.get_object(Bucket=bucket, Key=key)["Body"].read()),
-        allow_pickle=True
-    )
+    return np.load(BytesIO(read_s3_object(key)), allow_pickle=True)
 
 
 def yield_feature_filenames():
+    return iter(get_manifest("features"))
+
+
+def count_features():
+    return len(get_manifest("features"))
+
+
+def list_feature_filenames():
     if storage_env == "local":
         return yield_features_filenames_locally()
     elif storage_env == "s3":
@@ -285,33 +418,11 @@ def yield_features_filenames_locally():
 def yield_features_filenames_from_s3():
     s3 = get_s3_client()
     paginator = s3.get_paginator("list_objects_v2")
-    for page in paginator.paginate(Bucket=bucket, Prefix="features"):
-        for content in page["Contents"]:
+    for page in paginator.paginate(Bucket=bucket, Prefix="features/"):
+        for content in page.get("Contents", []):
             yield Path(content["Key"]).stem
 
 
-def count_features():
-    if storage_env == "local":
-        return count_features_locally()
-    elif storage_env == "s3":
-        return count_features_from_s3()
-    else:
-        raise ValueError(f"Unknown environment: {storage_env}")
-
-
-def count_features_locally():
-    return len(list(feature_dir.iterdir()))
-
-
-def count_features_from_s3():
-    s3 = get_s3_client()
-    paginator = s3.get_paginator("list_objects_v2")
-    count = 0
-    for page in paginator.paginate(Bucket=bucket, Prefix="features"):
-        count += len(page["Contents"])
-    return count
-
-
 def get_latest_model_name():
     if storage_env == "local":
         return get_latest_model_name_locally()
@@ -322,7 +433,9 @@ def get_latest_model_name():
 
 
 def get_latest_model_name_locally():
-    models = list(model_dir.iterdir())
+    models = [
+        path for path in model_dir.iterdir() if path.suffix in MODEL_SUFFIXES
+    ]
     if not models:
         raise ValueError("No models found")
     return max(models, key=os.path.getctime).stem
@@ -334,7 +447,8 @@ def get_latest_model_name_from_s3():
     models = []
     for page in paginator.paginate(Bucket=bucket, Prefix="models"):
         for content in page["Contents"]:
-            models.append(Path(content["Key"]).stem)
+            if Path(content["Key"]).suffix in MODEL_SUFFIXES:
+                models.append(Path(content["Key"]).stem)
     if not models:
         raise ValueError("No models found")
     return max(models)
@@ -350,21 +464,25 @@ def load_model(model_name: str):
 
 
 def load_model_locally(model_name: str):
-    path = model_dir / f"{model_name}.npy"
+    path = model_dir / f"{model_name}.lsh"
+    if not path.exists():
+        path = model_dir / f"{model_name}.npy"
+        log.info(f"Converting legacy pickled model {path}")
     log.debug(f"Loading model from {path}")
-    return np.load(path, allow_pickle=True)
+    return LSHModel(path=path)
 
 
 def load_model_from_s3(model_name: str):
     s3 = get_s3_client()
-    key = f"models/{model_name}.npy"
+    key = f"models/{model_name}.lsh"
+    try:
+        model_bytes = read_s3_object(key)
+    except s3.exceptions.NoSuchKey:
+        key = f"models/{model_name}.npy"
+        log.info(f"Converting legacy pickled model {key}")
+        model_bytes = read_s3_object(key)
     log.debug(f"Loading model from s3: {bucket} {key}")
-    return np.load(
-        BytesIO(
-            s3.get_object(Bucket=bucket, Key=key)["Body"].read(),
-            allow_pickle=True
-        )
-    )
+    return LSHModel(model_bytes=model_bytes)
 
 
 def load_json(filename: str):
@@ -387,4 +505,271 @@ def load_json_from_s3(filename: str):
     s3 = get_s3_client()
     key = f"{filename}.json"
     log.debug(f"Loading json from s3: {bucket} {key}")
-    return json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+    try:
+        body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except s3.exceptions.NoSuchKey as e:
+        raise FileNotFoundError(key) from e
+    return json.loads(body)
+
+
+def list_description_files():
+    """
+    The descriptions*.json files which get-images saved before descriptions
+    were kept in a DescriptionStore
+    """
+    if storage_env == "local":
+        return list_description_files_locally()
+    elif storage_env == "s3":
+        return list_description_files_from_s3()
+    else:
+        raise ValueError(f"Unknown environment: {storage_env}")
+
+
+def list_description_files_locally():
+    return sorted(path.stem for path in data_dir.glob("descriptions*.json"))
+
+
+def list_description_files_from_s3():
+    s3 = get_s3_client()
+    paginator = s3.get_paginator("list_objects_v2")
+    filenames = []
+    for page in paginator.paginate(Bucket=bucket, Prefix="descriptions"):
+        for content in page.get("Contents", []):
+            if content["Key"].endswith(".json"):
+                filenames.append(content["Key"][: -len(".json")])
+    return sorted(filenames)
+
+
+# Listing millions of objects is slow, so the ids written under each prefix
+# are also recorded in a manifest. Each process buffers the ids it writes and
+# flushes them as small delta files, which are periodically compacted into a
+# single manifest file. If the manifest ever drifts from what's actually in
+# storage, `python -m src.io reconcile <prefix>` rebuilds it from a listing.
+#
+# Several processes write and compact the same manifest at once, so manifest
+# files are never overwritten. A compaction writes the ids of every file it
+# read to a new, uniquely named file, and then deletes only those files, so
+# files written by other processes in the meantime are left for the next one.
+#
+# Manifests can also record sets of ids which have no listing to rebuild them
+# from, like the feature shards which have been indexed, and start out empty.
+manifest_listings = {
+    "images": list_image_filenames,
+    "features": list_feature_filenames,
+}
+manifests = {}
+manifests_lock = threading.Lock()
+
+
+class Manifest:
+    def __init__(
+        self, prefix: str, flush_every: int = 1000, compact_every: int = 50
+    ):
+        self.prefix = prefix
+        self.flush_every = flush_every
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        self.ids = set()
+        self.pending = []
+        self.deltas = []
+        self.load()
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.ids))
+
+    def read(self):
+        ids = set()
+        filenames = list_manifest_files(self.prefix)
+        for filename in filenames:
+            ids.update(
+                read_manifest_file(self.prefix, filename).split()
+            )
+        deltas = [name for name in filenames if name.endswith(".delta")]
+        return ids, filenames, deltas
+
+    def load(self):
+        ids, filenames, deltas = self.read()
+        if not filenames and self.prefix in manifest_listings:
+            log.info(f"No manifest found for {self.prefix}, building one")
+            self.reconcile()
+            return
+        self.ids, self.deltas = ids, deltas
+        log.debug(f"Loaded manifest of {len(self.ids)} {self.prefix}")
+
+    def add(self, filename: str):
+        with self.lock:
+            if filename in self.ids:
+                return
+            self.ids.add(filename)
+            self.pending.append(filename)
+            if len(self.pending) >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        filename = f"{time.time_ns()}-{uuid4().hex[:8]}.delta"
+        write_manifest_file(self.prefix, filename, "\n".join(self.pending))
+        self.deltas.append(filename)
+        self.pending = []
+        if len(self.deltas) >= self.compact_every:
+            self._compact()
+
+    def compact(self):
+        with self.lock:
+            self._flush()
+            self._compact()
+
+    def _compact(self):
+        # other processes may have written or compacted files since this one
+        # loaded, so only the files which are read here are folded together
+        ids, filenames, _ = self.read()
+        self.ids |= ids
+        self._replace(filenames, ids)
+        self.deltas = []
+        log.debug(f"Compacted manifest of {len(self.ids)} {self.prefix}")
+
+    def reconcile(self):
+        with self.lock:
+            filenames = list_manifest_files(self.prefix)
+            self.ids = set(manifest_listings[self.prefix]())
+            self.pending = []
+            self._replace(filenames, self.ids)
+            self.deltas = []
+        log.info(f"Rebuilt manifest of {len(self.ids)} {self.prefix}")
+
+    def _replace(self, filenames: List[str], ids: Set[str]):
+        """Write ids to a new manifest file, then delete the given files"""
+        filename = f"{time.time_ns()}-{uuid4().hex[:8]}.manifest"
+        write_manifest_file(self.prefix, filename, "\n".join(sorted(ids)))
+        for old_filename in filenames:
+            delete_manifest_file(self.prefix, old_filename)
+
+
+def get_manifest(prefix: str) -> Manifest:
+    with manifests_lock:
+        if prefix not in manifests:
+            manifests[prefix] = Manifest(prefix)
+        return manifests[prefix]
+
+
+@atexit.register
+def flush_manifests():
+    for manifest in manifests.values():
+        try:
+            manifest.flush()
+        except Exception as e:
+            log.error(f"Error flushing manifest of {manifest.prefix}: {e}")
+
+
+def list_manifest_files(prefix: str):
+    if storage_env == "local":
+        return list_manifest_files_locally(prefix)
+    elif storage_env == "s3":
+        return list_manifest_files_from_s3(prefix)
+    else:
+        raise ValueError(f"Unknown environment: {storage_env}")
+
+
+def list_manifest_files_locally(prefix: str):
+    path = manifest_dir / prefix
+    if not path.exists():
+        return []
+    return sorted(
+        path.name for path in path.iterdir() if path.suffix != ".tmp"
+    )
+
+
+def list_manifest_files_from_s3(prefix: str):
+    s3 = get_s3_client()
+    paginator = s3.get_paginator("list_objects_v2")
+    filenames = []
+    for page in paginator.paginate(
+        Bucket=bucket, Prefix=f"manifests/{prefix}/"
+    ):
+        for content in page.get("Contents", []):
+            filenames.append(Path(content["Key"]).name)
+    return sorted(filenames)
+
+
+def read_manifest_file(prefix: str, filename: str) -> str:
+    if storage_env == "local":
+        return read_manifest_file_locally(prefix, filename)
+    elif storage_env == "s3":
+        return read_manifest_file_from_s3(prefix, filename)
+    else:
+        raise ValueError(f"Unknown environment: {storage_env}")
+
+
+def read_manifest_file_locally(prefix: str, filename: str) -> str:
+    try:
+        return (manifest_dir / prefix / filename).read_text(encoding="utf-8")
+    except FileNotFoundError:
+        # deleted by another process's compaction
+        return ""
+
+
+def read_manifest_file_from_s3(prefix: str, filename: str) -> str:
+    s3 = get_s3_client()
+    key = f"manifests/{prefix}/{filename}"
+    try:
+        body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except s3.exceptions.NoSuchKey:
+        return ""
+    return body.decode("utf-8")
+
+
+def write_manifest_file(prefix: str, filename: str, text: str):
+    if storage_env == "local":
+        write_manifest_file_locally(prefix, filename, text)
+    elif storage_env == "s3":
+        write_manifest_file_to_s3(prefix, filename, text)
+    else:
+        raise ValueError(f"Unknown environment: {storage_env}")
+
+
+def write_manifest_file_locally(prefix: str, filename: str, text: str):
+    path = manifest_dir / prefix / filename
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # processes compacting at the same time each write their own temporary file
+    temporary_path = path.with_name(f"{path.name}.{uuid4().hex}.tmp")
+    temporary_path.write_text(text, encoding="utf-8")
+    os.replace(temporary_path, path)
+
+
+def write_manifest_file_to_s3(prefix: str, filename: str, text: str):
+    s3 = get_s3_client()
+    s3.put_object(
+        Bucket=bucket,
+        Key=f"manifests/{prefix}/{filename}",
+        Body=text.encode("utf-8"),
+        ContentType="text/plain",
+    )
+
+
+def delete_manifest_file(prefix: str, filename: str):
+    if storage_env == "local":
+        (manifest_dir / prefix / filename).unlink(missing_ok=True)
+    elif storage_env == "s3":
+        s3 = get_s3_client()
+        s3.delete_object(Bucket=bucket, Key=f"manifests/{prefix}/{filename}")
+    else:
+        raise ValueError(f"Unknown environment: {storage_env}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "reconcile":
+        raise SystemExit("Usage: python -m src.io reconcile [prefix ...]")
+    for prefix in sys.argv[2:] or manifest_listings:
+        get_manifest(prefix).reconcile()
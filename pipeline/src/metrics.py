@@ -0,0 +1,293 @@
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from pathlib import Path
+from typing import Dict, Optional
+
+from .log import get_logger
+
+log = get_logger()
+
+report_interval = float(os.environ.get("METRICS_INTERVAL", 30))
+metrics_file = os.environ.get("METRICS_FILE")
+metrics_port = int(os.environ.get("METRICS_PORT", 0))
+profiling = os.environ.get("PROFILE", "false") == "true"
+profile_dir = Path(os.environ.get("PROFILE_DIR", "/data/profiles"))
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    float("inf"),
+)
+
+
+class Stage:
+    """
+    Counts the items which pass through one stage of a pipeline, and keeps a
+    histogram of how long each call to the stage took. If `total` is set, the
+    stage can also estimate how long it has left to run.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.calls = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.total: Optional[int] = None
+        self.lock = threading.Lock()
+
+    def add(self, n: int = 1):
+        with self.lock:
+            self.count += n
+
+    def error(self, n: int = 1):
+        with self.lock:
+            self.errors += n
+
+    def observe(self, seconds: float, n: int = 1):
+        with self.lock:
+            self.count += n
+            self.calls += 1
+            self.seconds += seconds
+            self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """The upper bound of the histogram bucket holding the q-quantile"""
+        if not self.calls:
+            return None
+        cumulative = 0
+        for upper_bound, bucket_count in zip(LATENCY_BUCKETS, self.buckets):
+            cumulative += bucket_count
+            if cumulative >= q * self.calls:
+                return upper_bound
+        return LATENCY_BUCKETS[-1]
+
+    def summary(self, elapsed: float) -> dict:
+        rate = self.count / elapsed if elapsed else 0.0
+        summary = {
+            "count": self.count,
+            "errors": self.errors,
+            "per_second": rate,
+            "mean_ms": None,
+            "p50_ms": None,
+            "p99_ms": None,
+        }
+        if self.calls:
+            summary["mean_ms"] = self.seconds / self.calls * 1000
+            summary["p50_ms"] = self.quantile(0.5) * 1000
+            summary["p99_ms"] = self.quantile(0.99) * 1000
+        if self.total is not None:
+            summary["total"] = self.total
+            remaining = max(self.total - self.count, 0)
+            summary["eta_seconds"] = remaining / rate if rate else None
+        return summary
+
+
+class Metrics:
+    """
+    Per-stage counters and latency histograms for a pipeline run.
+
+    Hot sections are wrapped in `timer(stage)`, and a background thread
+    reports every stage's throughput, latency and ETA at a fixed interval,
+    so that nothing needs to be logged per item. Reports are logged, appended
+    to METRICS_FILE as json lines if it's set, and served in the prometheus
+    text format on METRICS_PORT if it's set. With PROFILE=true, every timed
+    section is also run under cProfile, and the profiles are written to
+    PROFILE_DIR when the process exits.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, Stage] = {}
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.profilers: Dict[str, cProfile.Profile] = {}
+        self.profiling = threading.local()
+        self.reporter: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    def stage(self, name: str) -> Stage:
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = Stage(name)
+            return self.stages[name]
+
+    def add(self, name: str, n: int = 1):
+        self.stage(name).add(n)
+
+    def set_total(self, name: str, total: int):
+        self.stage(name).total = total
+
+    @contextmanager
+    def timer(self, name: str, n: int = 1):
+        """
+        Time the wrapped section, counting n items through the stage if it
+        succeeds and an error if it raises
+        """
+        stage = self.stage(name)
+        profiler = self._start_profiling(name)
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            stage.error()
+            raise
+        else:
+            stage.observe(time.perf_counter() - start, n)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.profiling.active = False
+
+    def _start_profiling(self, name: str) -> Optional[cProfile.Profile]:
+        # cProfile only sees the thread which enabled it, and can't be nested
+        if not profiling or getattr(self.profiling, "active", False):
+            return None
+        with self.lock:
+            profiler = self.profilers.setdefault(name, cProfile.Profile())
+        try:
+            profiler.enable()
+        except ValueError:
+            return None
+        self.profiling.active = True
+        return profiler
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self.start_time
+        with self.lock:
+            stages = list(self.stages.values())
+        return {
+            "elapsed_seconds": elapsed,
+            "stages": {stage.name: stage.summary(elapsed) for stage in stages},
+        }
+
+    def to_json_line(self) -> str:
+        return json.dumps({"timestamp": time.time(), **self.summary()})
+
+    def to_prometheus(self) -> str:
+        with self.lock:
+            stages = list(self.stages.values())
+        counts = ["# TYPE pipeline_items_total counter"]
+        errors = ["# TYPE pipeline_errors_total counter"]
+        histograms = ["# TYPE pipeline_stage_seconds histogram"]
+        for stage in stages:
+            label = f'stage="{stage.name}"'
+            counts.append(f"pipeline_items_total{{{label}}} {stage.count}")
+            errors.append(f"pipeline_errors_total{{{label}}} {stage.errors}")
+            cumulative = 0
+            for upper_bound, bucket_count in zip(
+                LATENCY_BUCKETS, stage.buckets
+            ):
+                cumulative += bucket_count
+                le = "+Inf" if upper_bound == float("inf") else upper_bound
+                histograms.append(
+                    f'pipeline_stage_seconds_bucket{{{label},le="{le}"}} '
+                    f"{cumulative}"
+                )
+            histograms.append(
+                f"pipeline_stage_seconds_sum{{{label}}} {stage.seconds}"
+            )
+            histograms.append(
+                f"pipeline_stage_seconds_count{{{label}}} {stage.calls}"
+            )
+        return "\n".join(counts + errors + histograms) + "\n"
+
+    def report(self):
+        summary = self.summary()
+        if not summary["stages"]:
+            return
+        parts = []
+        for name, stage in summary["stages"].items():
+            part = f"{name} {stage['count']} ({stage['per_second']:.1f}/s"
+            if stage["p50_ms"] is not None:
+                part += (
+                    f", p50 {stage['p50_ms']:g}ms, p99 {stage['p99_ms']:g}ms"
+                )
+            if stage["errors"]:
+                part += f", {stage['errors']} errors"
+            if stage.get("eta_seconds") is not None:
+                part += f", {stage['count']}/{stage['total']}"
+                part += f", eta {stage['eta_seconds']:.0f}s"
+            parts.append(part + ")")
+        log.info("Progress: " + ", ".join(parts))
+        if metrics_file:
+            with open(metrics_file, "a") as f:
+                f.write(self.to_json_line() + "\n")
+
+    def start_reporting(self, interval: float = report_interval):
+        """Report every `interval` seconds until the process exits"""
+        if self.reporter is not None:
+            return
+        self.start_time = time.monotonic()
+
+        def run():
+            while not self.stopped.wait(interval):
+                self.report()
+
+        self.reporter = threading.Thread(target=run, daemon=True)
+        self.reporter.start()
+        if metrics_port:
+            serve_prometheus(self, metrics_port)
+        atexit.register(self.stop_reporting)
+
+    def stop_reporting(self):
+        self.stopped.set()
+        self.report()
+        if self.profilers:
+            self.write_profiles()
+
+    def write_profiles(self):
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        for name, profiler in self.profilers.items():
+            path = profile_dir / f"{name}.prof"
+            profiler.dump_stats(path)
+            output = StringIO()
+            stats = pstats.Stats(profiler, stream=output)
+            stats.sort_stats("cumulative").print_stats(15)
+            log.info(f"Profile of {name}, written to {path}")
+            log.info(output.getvalue())
+
+
+def serve_prometheus(metrics: Metrics, port: int) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = metrics.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info(f"Serving metrics on port {port}")
+    return server
+
+
+metrics = Metrics()
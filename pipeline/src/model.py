@@ -1,8 +1,102 @@
+import json
+import struct
+from io import BytesIO
+from itertools import product
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import numpy as np
-from sklearn.cluster import KMeans
+
+if TYPE_CHECKING:
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from .reduction import Reduction
+
+# the model file format is an 8 byte magic string, a little-endian uint32
+# giving the length of a JSON header, the header itself, and then the raw
+# (n_groups, n_clusters, group_dim) centroid array, aligned to 64 bytes so
+# that it can be memory-mapped in place. Since version 2, a model with a
+# dimensionality reduction is followed by the reduction's float32 mean and
+# (input_dim, n_components) components, again aligned to 64 bytes
+MAGIC = b"LSHMODEL"
+FORMAT_VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+ALIGNMENT = 64
+
+# hash tokens can be encoded as "{group}-{cluster}" text, as one fixed-width
+# hex number per group, or as one fixed-width hex number per band of
+# band_size consecutive groups, which a document only shares with a query if
+# every group in the band matches
+ENCODINGS = ("text", "packed", "band")
+
+
+def fit_group(
+    features: np.ndarray,
+    n_clusters: int,
+    minibatch: bool = False,
+    n_init: int = 1,
+    max_iter: int = 300,
+    random_state: Optional[int] = None,
+) -> "KMeans":
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    model_class = MiniBatchKMeans if minibatch else KMeans
+    return model_class(
+        n_clusters=n_clusters,
+        n_init=n_init,
+        max_iter=max_iter,
+        random_state=random_state,
+    ).fit(features)
+
+
+def start_group(
+    features: np.ndarray,
+    n_clusters: int,
+    minibatch: bool = False,
+    n_init: int = 1,
+    max_iter: int = 300,
+    random_state: Optional[int] = None,
+) -> "MiniBatchKMeans":
+    """
+    Fit a group's first batch of features with fit_group, and seed a
+    MiniBatchKMeans model with its cluster centres, which later batches can
+    update with partial_fit
+    """
+    from sklearn.cluster import MiniBatchKMeans
+
+    fitted = fit_group(
+        features,
+        n_clusters=n_clusters,
+        minibatch=minibatch,
+        n_init=n_init,
+        max_iter=max_iter,
+        random_state=random_state,
+    )
+    model = MiniBatchKMeans(
+        n_clusters=n_clusters,
+        init=fitted.cluster_centers_,
+        n_init=1,
+        random_state=random_state,
+    )
+    return model.partial_fit(features)
+
+
+def convert_legacy_models(models: List["KMeans"]) -> np.ndarray:
+    """
+    Stack the cluster centres of a list of pickled sklearn models, as saved by
+    older versions of LSHModel, into a single centroid array
+    """
+    return np.stack([model.cluster_centers_ for model in models]).astype(
+        np.float32
+    )
 
 
 class LSHModel:
@@ -12,14 +106,21 @@ class LSHModel:
         model_bytes: Optional[bytes] = None,
         n_groups: Optional[int] = None,
         n_clusters: Optional[int] = None,
+        encoding: str = "text",
+        band_size: int = 1,
     ):
+        self.models: Optional[List["KMeans"]] = None
+        self.reduction: Optional[Reduction] = None
+        self.encoding = encoding
+        self.band_size = band_size
+        self._token_table: Optional[List[List[str]]] = None
         if (
             path is None
             and n_groups is not None
             and n_clusters is not None
             and model_bytes is None
         ):
-            self.models: List[KMeans] = None
+            self.centroids = None
             self.n_groups = n_groups
             self.n_clusters = n_clusters
         elif (
@@ -28,57 +129,508 @@ class LSHModel:
             and n_clusters is None
             and model_bytes is None
         ):
-            self.models = self.load(path)
-            self.n_groups = len(self.models)
-            self.n_clusters = self.models[0].n_clusters
+            self.centroids = self.load(path)
+            self.n_groups, self.n_clusters, _ = self.centroids.shape
         elif (
             path is None
             and n_groups is None
             and n_clusters is None
             and model_bytes is not None
         ):
-            self.models = self.load_binary(model_bytes)
-            self.n_groups = len(self.models)
-            self.n_clusters = self.models[0].n_clusters
+            self.centroids = self.load_binary(model_bytes)
+            self.n_groups, self.n_clusters, _ = self.centroids.shape
         else:
             raise ValueError(
                 "Either path or model_bytes or "
                 "(n_groups and n_clusters) must be specified"
             )
+        self.set_encoding(self.encoding, self.band_size)
+
+    @property
+    def centroids(self) -> Optional[np.ndarray]:
+        return self._centroids
+
+    @centroids.setter
+    def centroids(self, centroids: Optional[np.ndarray]):
+        # every prediction needs the squared norm of every centroid, so they
+        # are computed once whenever the centroids are fitted or loaded
+        self._centroids = centroids
+        self._centroid_norms = None
+        if centroids is not None:
+            norms = (centroids ** 2).sum(axis=2)
+            self._centroid_norms = norms[:, np.newaxis, :]
+
+    def set_encoding(self, encoding: str, band_size: int = 1):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown hash encoding: {encoding}")
+        if encoding != "band":
+            band_size = 1
+        elif self.n_groups % band_size:
+            raise ValueError(
+                f"n_groups ({self.n_groups}) must be divisible by "
+                f"band_size ({band_size})"
+            )
+        elif self.n_clusters ** band_size > 2 ** 63:
+            raise ValueError(f"A band of {band_size} groups is too large")
+        self.encoding = encoding
+        self.band_size = band_size
+        self._token_table = None
+
+    @property
+    def n_tokens(self) -> int:
+        """The number of hash tokens in every document"""
+        return self.n_groups // self.band_size
+
+    def n_query_tokens(self, n_probes: int = 1) -> int:
+        """
+        The number of tokens in a query which probes the n_probes nearest
+        buckets in every group. With the band encoding, every combination of
+        a band's probes is a token.
+        """
+        return self.n_tokens * min(n_probes, self.n_clusters) ** self.band_size
 
-    def fit(self, features: np.ndarray) -> List[KMeans]:
+    @property
+    def input_dims(self) -> Tuple[int, ...]:
+        """
+        The lengths of the feature vectors which the model can hash: raw
+        features, and features in its reduced space if it has a reduction
+        """
+        dims = (self.n_groups * self.centroids.shape[2],)
+        if self.reduction is not None:
+            dims = (self.reduction.input_dim,) + dims
+        return dims
+
+    def fit(
+        self,
+        features: np.ndarray,
+        n_jobs: Optional[int] = None,
+        minibatch: bool = False,
+        n_init: int = 1,
+        max_iter: int = 300,
+        seed: int = 0,
+    ) -> List["KMeans"]:
+        """
+        Fit a clustering model to each group of features. The groups are
+        independent, so they're trained concurrently across n_jobs processes
+        (-1 for all CPUs), and group i is seeded with seed + i so that results
+        are reproducible. If the model has a reduction, it's applied to the
+        features first.
+        """
+        from joblib import Parallel, delayed
+
+        features = self.reduce(features)
         feature_groups = np.split(
             features, indices_or_sections=self.n_groups, axis=1
         )
 
-        models = [
-            KMeans(n_clusters=self.n_clusters).fit(feature_group)
-            for feature_group in feature_groups
-        ]
+        models = Parallel(n_jobs=n_jobs)(
+            delayed(fit_group)(
+                feature_group,
+                n_clusters=self.n_clusters,
+                minibatch=minibatch,
+                n_init=n_init,
+                max_iter=max_iter,
+                random_state=seed + i,
+            )
+            for i, feature_group in enumerate(feature_groups)
+        )
 
         self.models = models
+        self.centroids = convert_legacy_models(models)
         return models
 
-    @staticmethod
-    def encode(clusters):
-        return [f"{i}-{val}" for i, val in enumerate(clusters)]
+    def partial_fit(
+        self,
+        features: np.ndarray,
+        n_jobs: Optional[int] = None,
+        minibatch: bool = False,
+        n_init: int = 1,
+        max_iter: int = 300,
+        seed: int = 0,
+    ) -> List["MiniBatchKMeans"]:
+        """
+        Update a MiniBatchKMeans model for each group with one batch of
+        features, so that a model can be trained on a stream of batches with
+        bounded memory. The first batch is fitted like `fit`, with the same
+        minibatch, n_init and max_iter options, so it needs at least
+        n_clusters rows. Each later batch is a single update step, in n_jobs
+        threads since the models need to be updated in place.
+        """
+        from joblib import Parallel, delayed
+        from sklearn.cluster import MiniBatchKMeans
 
-    def predict(self, features: np.ndarray) -> List[str]:
         feature_groups = np.split(
-            features, indices_or_sections=self.n_groups, axis=1
+            self.reduce(features), indices_or_sections=self.n_groups, axis=1
         )
+        if self.models is None or not all(
+            isinstance(model, MiniBatchKMeans) for model in self.models
+        ):
+            self.models = Parallel(n_jobs=n_jobs)(
+                delayed(start_group)(
+                    feature_group,
+                    n_clusters=self.n_clusters,
+                    minibatch=minibatch,
+                    n_init=n_init,
+                    max_iter=max_iter,
+                    random_state=seed + i,
+                )
+                for i, feature_group in enumerate(feature_groups)
+            )
+        else:
+            Parallel(n_jobs=n_jobs, prefer="threads")(
+                delayed(model.partial_fit)(feature_group)
+                for model, feature_group in zip(self.models, feature_groups)
+            )
+        self.centroids = convert_legacy_models(self.models)
+        return self.models
+
+    def fit_reduction(
+        self,
+        features: np.ndarray,
+        method: str,
+        n_components: int,
+        seed: int = 0,
+    ) -> Reduction:
+        """
+        Fit a dimensionality reduction to a sample of features. It's stored
+        with the model, and applied to every vector before it's clustered or
+        hashed, so it has to be fitted before the clusters are.
+        """
+        if n_components % self.n_groups:
+            raise ValueError(
+                f"n_components ({n_components}) must be divisible by "
+                f"n_groups ({self.n_groups})"
+            )
+        self.reduction = Reduction.fit(features, method, n_components, seed)
+        return self.reduction
 
-        predictions = [
-            model.predict(feature_group)[0]
-            for model, feature_group in zip(self.models, feature_groups)
+    def reduce(self, features: np.ndarray) -> np.ndarray:
+        """
+        Project features into the model's reduced space. Features which are
+        already reduced, or a model without a reduction, pass through as-is.
+        """
+        if (
+            self.reduction is None
+            or features.shape[-1] != self.reduction.input_dim
+        ):
+            return features
+        return self.reduction.transform(features)
+
+    def token_table(self) -> List[List[str]]:
+        """The token for every (group, cluster) pair, for unbanded encodings"""
+        if self._token_table is None:
+            if self.encoding == "text":
+                self._token_table = [
+                    [
+                        f"{group}-{cluster}"
+                        for cluster in range(self.n_clusters)
+                    ]
+                    for group in range(self.n_groups)
+                ]
+            else:
+                width = len(f"{self.n_groups * self.n_clusters - 1:x}")
+                self._token_table = [
+                    [
+                        f"{group * self.n_clusters + cluster:0{width}x}"
+                        for cluster in range(self.n_clusters)
+                    ]
+                    for group in range(self.n_groups)
+                ]
+        return self._token_table
+
+    def band_token(self, band: int, clusters: Sequence[int]) -> str:
+        band_width = len(f"{self.n_tokens - 1:x}")
+        value_width = len(f"{self.n_clusters ** self.band_size - 1:x}")
+        value = 0
+        for cluster in clusters:
+            value = value * self.n_clusters + int(cluster)
+        return f"{band:0{band_width}x}{value:0{value_width}x}"
+
+    def encode(self, clusters: Sequence[int]) -> List[str]:
+        """Turn the cluster index of each group into a document's tokens"""
+        if self.encoding == "band":
+            return [
+                self.band_token(band, clusters[start : start + self.band_size])
+                for band, start in enumerate(
+                    range(0, self.n_groups, self.band_size)
+                )
+            ]
+        table = self.token_table()
+        return [
+            table[group][cluster] for group, cluster in enumerate(clusters)
+        ]
+
+    def encode_probes(
+        self, clusters: np.ndarray, weights: np.ndarray
+    ) -> List[Tuple[str, float]]:
+        """
+        Turn (n_groups, n_probes) arrays of probed clusters and their weights
+        into a query's (token, weight) pairs. With the band encoding, every
+        combination of the probes in a band becomes a token, weighted by the
+        product of their weights.
+        """
+        if self.encoding != "band":
+            table = self.token_table()
+            return [
+                (table[group][cluster], round(float(weight), 4))
+                for group, (group_clusters, group_weights) in enumerate(
+                    zip(clusters, weights)
+                )
+                for cluster, weight in zip(group_clusters, group_weights)
+            ]
+        probes = []
+        for band, start in enumerate(range(0, self.n_groups, self.band_size)):
+            band_probes = [
+                list(zip(clusters[group], weights[group]))
+                for group in range(start, start + self.band_size)
+            ]
+            for combination in product(*band_probes):
+                band_clusters = [cluster for cluster, _ in combination]
+                weight = np.prod([weight for _, weight in combination])
+                probes.append(
+                    (
+                        self.band_token(band, band_clusters),
+                        round(float(weight), 4),
+                    )
+                )
+        return probes
+
+    def predict(self, features: np.ndarray) -> List[str]:
+        return self.predict_batch(features.reshape(1, -1))[0]
+
+    def _chunk_distances(self, chunk: np.ndarray) -> np.ndarray:
+        """
+        Squared distances from every row of an (n, D) chunk of features to
+        every centroid, as an (n_groups, n, n_clusters) array
+        """
+        chunk = self.reduce(chunk)
+        centroids = self.centroids
+        # |x - c|^2 = |x|^2 - 2x.c + |c|^2
+        groups = chunk.reshape(
+            len(chunk), self.n_groups, -1
+        ).transpose(1, 0, 2).astype(centroids.dtype, copy=False)
+        feature_norms = (groups ** 2).sum(axis=2)[:, :, np.newaxis]
+        distances = self._centroid_norms - 2 * np.matmul(
+            groups, centroids.transpose(0, 2, 1)
+        )
+        return distances + feature_norms
+
+    def predict_clusters(
+        self, features: np.ndarray, batch_size: int = 1024
+    ) -> np.ndarray:
+        """
+        Find the nearest centroid in every group for every row of an
+        (N, D) feature matrix, returning an (N, n_groups) array of cluster
+        indices. Rows are processed in chunks of batch_size to cap the size
+        of the intermediate distance arrays.
+        """
+        features = np.atleast_2d(features)
+        clusters = np.empty((len(features), self.n_groups), dtype=np.int32)
+        for start in range(0, len(features), batch_size):
+            chunk = features[start : start + batch_size]
+            distances = self._chunk_distances(chunk)
+            clusters[start : start + batch_size] = distances.argmin(axis=2).T
+        return clusters
+
+    def probe_clusters(
+        self, features: np.ndarray, n_probes: int, batch_size: int = 1024
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the n_probes nearest centroids in every group for every row of
+        an (N, D) feature matrix. Returns (N, n_groups, n_probes) arrays of
+        cluster indices and squared distances, nearest first.
+        """
+        features = np.atleast_2d(features)
+        n_probes = min(n_probes, self.n_clusters)
+        shape = (len(features), self.n_groups, n_probes)
+        clusters = np.empty(shape, dtype=np.int32)
+        distances = np.empty(shape, dtype=np.float32)
+        for start in range(0, len(features), batch_size):
+            chunk = features[start : start + batch_size]
+            chunk_distances = self._chunk_distances(chunk).transpose(1, 0, 2)
+            if n_probes < self.n_clusters:
+                nearest = np.argpartition(
+                    chunk_distances, n_probes - 1, axis=2
+                )[:, :, :n_probes]
+            else:
+                nearest = np.broadcast_to(
+                    np.arange(self.n_clusters), chunk_distances.shape
+                )
+            nearest_distances = np.take_along_axis(
+                chunk_distances, nearest, axis=2
+            )
+            order = nearest_distances.argsort(axis=2)
+            end = start + len(chunk)
+            clusters[start:end] = np.take_along_axis(nearest, order, axis=2)
+            distances[start:end] = np.maximum(
+                np.take_along_axis(nearest_distances, order, axis=2), 0
+            )
+        return clusters, distances
+
+    def predict_batch(
+        self, features: np.ndarray, batch_size: int = 1024
+    ) -> List[List[str]]:
+        clusters = self.predict_clusters(features, batch_size=batch_size)
+        return [self.encode(row) for row in clusters]
+
+    def predict_probes_batch(
+        self, features: np.ndarray, n_probes: int, batch_size: int = 1024
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Multi-probe hashes for querying: the n_probes nearest buckets in every
+        group, as (hash, weight) pairs. Each group's nearest bucket has a
+        weight of 1, and further buckets are weighted by the ratio of the
+        nearest squared distance to their own, so that documents which share
+        a bucket that's only slightly further away still count for almost as
+        much as an exact match.
+        """
+        clusters, distances = self.probe_clusters(
+            features, n_probes, batch_size=batch_size
+        )
+        weights = (distances[:, :, :1] + 1e-6) / (distances + 1e-6)
+        return [
+            self.encode_probes(row_clusters, row_weights)
+            for row_clusters, row_weights in zip(clusters, weights)
         ]
-        return self.encode(predictions)
 
-    def save(self, file):
-        np.save(file, self.models, allow_pickle=True)
+    def predict_probes(
+        self, features: np.ndarray, n_probes: int
+    ) -> List[Tuple[str, float]]:
+        return self.predict_probes_batch(features.reshape(1, -1), n_probes)[0]
 
-    def load(self, path: Path) -> List[KMeans]:
-        return np.load(path, allow_pickle=True)
+    def metadata(self) -> dict:
+        return {
+            "version": FORMAT_VERSION,
+            "n_groups": self.n_groups,
+            "n_clusters": self.n_clusters,
+            "group_dim": self.centroids.shape[2],
+            "dtype": self.centroids.dtype.str,
+            "encoding": self.encoding,
+            "band_size": self.band_size,
+            "reduction": (
+                {
+                    "method": self.reduction.method,
+                    "input_dim": self.reduction.input_dim,
+                    "n_components": self.reduction.n_components,
+                }
+                if self.reduction is not None
+                else None
+            ),
+        }
 
-    def load_binary(self, model_bytes: bytes) -> List[KMeans]:
-        return np.load(model_bytes, allow_pickle=True)
+    def save(self, file: Union[Path, str, BinaryIO]):
+        header = json.dumps(self.metadata()).encode("utf-8")
+        prefix_length = len(MAGIC) + 4 + len(header)
+        padding = -prefix_length % ALIGNMENT
+        header += b" " * padding
+
+        if isinstance(file, (str, Path)):
+            with open(file, "wb") as f:
+                return self.save(f)
+        file.write(MAGIC)
+        file.write(struct.pack("<I", len(header)))
+        file.write(header)
+        centroid_bytes = np.ascontiguousarray(self.centroids).tobytes()
+        file.write(centroid_bytes)
+        if self.reduction is not None:
+            file.write(b"\0" * (-len(centroid_bytes) % ALIGNMENT))
+            file.write(self.reduction.mean.tobytes())
+            file.write(self.reduction.components.tobytes())
+
+    @staticmethod
+    def read_header(prefix: bytes) -> Tuple[dict, int]:
+        (header_length,) = struct.unpack(
+            "<I", prefix[len(MAGIC) : len(MAGIC) + 4]
+        )
+        offset = len(MAGIC) + 4 + header_length
+        metadata = json.loads(prefix[len(MAGIC) + 4 : offset])
+        if metadata["version"] not in SUPPORTED_VERSIONS:
+            raise ValueError(
+                f"Unsupported model format version: {metadata['version']}"
+            )
+        return metadata, offset
+
+    @staticmethod
+    def centroid_shape(metadata: dict) -> Tuple[int, int, int]:
+        return (
+            metadata["n_groups"],
+            metadata["n_clusters"],
+            metadata["group_dim"],
+        )
+
+    @staticmethod
+    def reduction_offset(metadata: dict, offset: int) -> int:
+        shape = LSHModel.centroid_shape(metadata)
+        centroid_bytes = int(np.prod(shape)) * np.dtype(
+            metadata["dtype"]
+        ).itemsize
+        return offset + centroid_bytes + (-centroid_bytes % ALIGNMENT)
+
+    def load(self, path: Union[Path, str]) -> np.ndarray:
+        with open(path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                f.seek(0)
+                return convert_legacy_models(np.load(f, allow_pickle=True))
+            (header_length,) = struct.unpack("<I", f.read(4))
+            f.seek(0)
+            prefix = f.read(len(MAGIC) + 4 + header_length)
+        metadata, offset = self.read_header(prefix)
+        self.encoding = metadata.get("encoding", "text")
+        self.band_size = metadata.get("band_size", 1)
+        reduction = metadata.get("reduction")
+        if reduction:
+            input_dim = reduction["input_dim"]
+            start = self.reduction_offset(metadata, offset)
+            mean = np.memmap(
+                path,
+                dtype=np.float32,
+                mode="r",
+                offset=start,
+                shape=(input_dim,),
+            )
+            components = np.memmap(
+                path,
+                dtype=np.float32,
+                mode="r",
+                offset=start + mean.nbytes,
+                shape=(input_dim, reduction["n_components"]),
+            )
+            self.reduction = Reduction(reduction["method"], mean, components)
+        return np.memmap(
+            path,
+            dtype=np.dtype(metadata["dtype"]),
+            mode="r",
+            offset=offset,
+            shape=self.centroid_shape(metadata),
+        )
+
+    def load_binary(self, model_bytes: bytes) -> np.ndarray:
+        if not model_bytes.startswith(MAGIC):
+            return convert_legacy_models(
+                np.load(BytesIO(model_bytes), allow_pickle=True)
+            )
+        metadata, offset = self.read_header(model_bytes)
+        self.encoding = metadata.get("encoding", "text")
+        self.band_size = metadata.get("band_size", 1)
+        reduction = metadata.get("reduction")
+        if reduction:
+            input_dim = reduction["input_dim"]
+            start = self.reduction_offset(metadata, offset)
+            mean = np.frombuffer(
+                model_bytes, dtype=np.float32, count=input_dim, offset=start
+            )
+            components = np.frombuffer(
+                model_bytes,
+                dtype=np.float32,
+                count=input_dim * reduction["n_components"],
+                offset=start + mean.nbytes,
+            ).reshape(input_dim, reduction["n_components"])
+            self.reduction = Reduction(reduction["method"], mean, components)
+        shape = self.centroid_shape(metadata)
+        return np.frombuffer(
+            model_bytes,
+            dtype=np.dtype(metadata["dtype"]),
+            count=int(np.prod(shape)),
+            offset=offset,
+        ).reshape(shape)
@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+from hashlib import blake2b
+from typing import Iterable, Iterator, List, Optional
+
+from .io import load_json, save_json
+from .log import get_logger
+
+log = get_logger()
+
+# each step can be split across PARTITION_COUNT tasks, which each handle the
+# ids which hash to their PARTITION_INDEX. RUN_ID names the run which a set
+# of tasks belongs to, so that a restarted task can find its checkpoint
+partition_index = int(os.environ.get("PARTITION_INDEX", 0))
+partition_count = int(os.environ.get("PARTITION_COUNT", 1))
+run_id = os.environ.get("RUN_ID") or None
+checkpoint_interval = float(os.environ.get("CHECKPOINT_INTERVAL", 300))
+
+
+def partition_of(item_id: str, count: int) -> int:
+    """
+    The partition which an id belongs to. Python's hash() is salted per
+    process, so a stable digest is used instead
+    """
+    digest = blake2b(str(item_id).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+@dataclass(frozen=True)
+class Partition:
+    index: int = 0
+    count: int = 1
+
+    def __post_init__(self):
+        if self.count < 1 or not 0 <= self.index < self.count:
+            raise ValueError(
+                f"Invalid partition {self.index} of {self.count}"
+            )
+
+    def __contains__(self, item_id: str) -> bool:
+        if self.count == 1:
+            return True
+        return partition_of(item_id, self.count) == self.index
+
+    @property
+    def partitioned(self) -> bool:
+        return self.count > 1
+
+    @property
+    def name(self) -> str:
+        return f"{self.index:03d}-of-{self.count:03d}"
+
+    def filter(self, item_ids: Iterable[str]) -> Iterator[str]:
+        return (item_id for item_id in item_ids if item_id in self)
+
+
+def get_partition() -> Partition:
+    return Partition(partition_index, partition_count)
+
+
+class Checkpoint:
+    """
+    The progress of one partition of a step, saved as a small json file under
+    checkpoints/<step>/<run id>/, so that a task which is restarted with the
+    same RUN_ID can pick up where it stopped. Without a run id, checkpoints
+    are kept in memory and never saved.
+    """
+
+    def __init__(
+        self,
+        step: str,
+        partition: Partition,
+        run_id: Optional[str] = run_id,
+        interval: float = checkpoint_interval,
+    ):
+        self.step = step
+        self.partition = partition
+        self.run_id = run_id
+        self.interval = interval
+        self.last_saved = time.monotonic()
+        self.state = self._read(partition) or {}
+        if self.state:
+            log.info(
+                f"Resuming {step} run {run_id} from its checkpoint for "
+                f"partition {partition.name}"
+            )
+
+    @property
+    def enabled(self) -> bool:
+        return self.run_id is not None
+
+    @property
+    def complete(self) -> bool:
+        return self.state.get("complete", False)
+
+    def due(self) -> bool:
+        return time.monotonic() - self.last_saved >= self.interval
+
+    def save(self, **state):
+        self.state.update(state)
+        self.last_saved = time.monotonic()
+        if self.enabled:
+            save_json(self.state, self._filename(self.partition))
+
+    def save_position(
+        self, stream_position: "StreamPosition", flush: Iterable = (), **state
+    ):
+        """
+        Save the position before which every row of a stream has finished,
+        after flushing everything which finished rows have been written to,
+        so that a restarted task never skips rows whose output was only held
+        in memory. The position is read first, since rows which finish while
+        the flushes run may have missed them.
+        """
+        position = stream_position.finished
+        for store in flush:
+            store.flush()
+        self.save(position=position, **state)
+
+    def mark_complete(self):
+        self.save(complete=True)
+
+    def incomplete_partitions(self) -> List[Partition]:
+        """The partitions of this run which haven't finished yet"""
+        incomplete = []
+        for index in range(self.partition.count):
+            partition = Partition(index, self.partition.count)
+            if partition == self.partition:
+                state = self.state
+            else:
+                state = self._read(partition) or {}
+            if not state.get("complete", False):
+                incomplete.append(partition)
+        return incomplete
+
+    def _filename(self, partition: Partition) -> str:
+        return f"checkpoints/{self.step}/{self.run_id}/{partition.name}"
+
+    def _read(self, partition: Partition) -> Optional[dict]:
+        if not self.enabled:
+            return None
+        try:
+            return load_json(self._filename(partition))
+        except FileNotFoundError:
+            return None
+
+
+class StreamPosition:
+    """
+    Tracks which rows of an ordered stream are still being worked on. Rows
+    finish out of order, so a checkpoint can only safely record the position
+    before which every row has finished.
+    """
+
+    def __init__(self, start: int = 0):
+        self.next_position = start
+        self.in_flight = set()
+        self.lock = threading.Lock()
+
+    def skip(self, position: int):
+        """Move past a row which needs no work"""
+        with self.lock:
+            self.next_position = position + 1
+
+    def start(self, position: int):
+        with self.lock:
+            self.next_position = position + 1
+            self.in_flight.add(position)
+
+    def finish(self, position: int):
+        with self.lock:
+            self.in_flight.discard(position)
+
+    @property
+    def finished(self) -> int:
+        with self.lock:
+            if self.in_flight:
+                return min(self.in_flight)
+            return self.next_position
@@ -0,0 +1,76 @@
+from typing import Optional
+
+import numpy as np
+
+METHODS = ("pca", "random")
+
+
+class Reduction:
+    """
+    A linear projection of feature vectors into fewer dimensions, computed as
+    (x - mean) @ components. PCA keeps the directions of greatest variance in
+    a sample of features, while a gaussian random projection needs no
+    training data and approximately preserves distances between vectors.
+    """
+
+    def __init__(self, method: str, mean: np.ndarray, components: np.ndarray):
+        if method not in METHODS:
+            raise ValueError(f"Unknown reduction method: {method}")
+        self.method = method
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+
+    @property
+    def input_dim(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def n_components(self) -> int:
+        return self.components.shape[1]
+
+    @classmethod
+    def fit(
+        cls,
+        features: np.ndarray,
+        method: str,
+        n_components: int,
+        seed: Optional[int] = 0,
+    ) -> "Reduction":
+        features = np.asarray(features, dtype=np.float32)
+        input_dim = features.shape[1]
+        if n_components >= input_dim:
+            raise ValueError(
+                f"Can't reduce {input_dim} dimensions to {n_components}"
+            )
+        if method == "pca":
+            from sklearn.decomposition import PCA
+
+            pca = PCA(
+                n_components=n_components,
+                svd_solver="randomized",
+                random_state=seed,
+            ).fit(features)
+            return cls(method, pca.mean_, pca.components_.T)
+        if method == "random":
+            rng = np.random.default_rng(seed)
+            components = rng.normal(
+                scale=1 / np.sqrt(n_components), size=(input_dim, n_components)
+            )
+            return cls(method, np.zeros(input_dim), components)
+        raise ValueError(f"Unknown reduction method: {method}")
+
+    def transform(
+        self, features: np.ndarray, batch_size: int = 4096
+    ) -> np.ndarray:
+        features = np.atleast_2d(features)
+        reduced = np.empty(
+            (len(features), self.n_components), dtype=np.float32
+        )
+        for start in range(0, len(features), batch_size):
+            chunk = np.asarray(
+                features[start : start + batch_size], dtype=np.float32
+            )
+            reduced[start : start + batch_size] = (
+                chunk - self.mean
+            ) @ self.components
+        return reduced
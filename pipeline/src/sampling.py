@@ -0,0 +1,96 @@
+import math
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from .feature_store import FeatureStore
+from .log import get_logger
+
+log = get_logger()
+
+_exhausted = object()
+
+
+def reservoir_sample(
+    items: Iterable, n: int, seed: Optional[int] = None
+) -> List:
+    """
+    Uniformly sample n items from an iterable of unknown length in a single
+    pass, holding only the sample in memory.
+
+    This is Li's Algorithm L: rather than drawing a random number for every
+    item, it draws how many items to skip before the next one which enters
+    the reservoir, and skips them without looking at them. Sampling n of N
+    items takes O(n log(N / n)) random draws.
+    """
+    rng = np.random.default_rng(seed)
+    iterator = iter(items)
+    reservoir = list(islice(iterator, n))
+    if len(reservoir) < n or n == 0:
+        return reservoir
+
+    def log_random() -> float:
+        # the log of a uniform draw from (0, 1]
+        return math.log(1.0 - rng.random())
+
+    w = math.exp(log_random() / n)
+    while True:
+        skip = int(log_random() / math.log1p(-w)) if w < 1 else 0
+        item = next(islice(iterator, skip, None), _exhausted)
+        if item is _exhausted:
+            return reservoir
+        reservoir[rng.integers(0, n)] = item
+        w *= math.exp(log_random() / n)
+
+
+def yield_training_batches(
+    feature_store: FeatureStore,
+    batch_size: int,
+    n_vectors: Optional[int] = None,
+    seed: Optional[int] = None,
+    max_workers: int = 4,
+) -> Iterator[np.ndarray]:
+    """
+    Stream shuffled batches of float32 training vectors out of a feature
+    store, holding no more than a few shards in memory at once.
+
+    Shards are read in a random order, up to max_workers at a time. If
+    n_vectors is smaller than the store, each row is kept with probability
+    n_vectors / len(store), which samples uniformly without needing a list
+    of every id. Rows from neighbouring shards are pooled and shuffled before
+    they're split into batches, so that no batch comes from a single shard.
+    """
+    rng = np.random.default_rng(seed)
+    shards = list(feature_store.shard_ids)
+    rng.shuffle(shards)
+    total = len(feature_store)
+    keep_probability = 1.0
+    if n_vectors is not None and n_vectors < total:
+        keep_probability = n_vectors / total
+
+    pool, pooled, produced = [], 0, 0
+    for _, array in feature_store.iter_shards(shards, max_workers):
+        rows = np.arange(len(array))
+        if keep_probability < 1:
+            rows = rows[rng.random(len(rows)) < keep_probability]
+        pool.append(np.asarray(array[rows], dtype=np.float32))
+        pooled += len(rows)
+        if pooled < batch_size * 2:
+            continue
+        vectors = np.concatenate(pool)
+        rng.shuffle(vectors)
+        n_batches = len(vectors) // batch_size
+        for i in range(n_batches):
+            yield vectors[i * batch_size : (i + 1) * batch_size]
+        produced += n_batches * batch_size
+        pool = [vectors[n_batches * batch_size :]]
+        pooled = len(pool[0])
+        if n_vectors is not None and produced >= n_vectors:
+            return
+
+    if pooled:
+        vectors = np.concatenate(pool)
+        rng.shuffle(vectors)
+        for start in range(0, len(vectors), batch_size):
+            yield vectors[start : start + batch_size]
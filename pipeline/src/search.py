@@ -0,0 +1,276 @@
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from elasticsearch import Elasticsearch
+
+from .feature_store import FeatureStore
+from .log import get_logger
+from .model import LSHModel
+
+log = get_logger()
+
+# elasticsearch rejects bool queries with more clauses than its
+# indices.query.bool.max_clause_count setting, which defaults to 1024
+max_clause_count = int(os.environ.get("ELASTICSEARCH_MAX_CLAUSE_COUNT", 1024))
+
+
+@dataclass
+class SearchResult:
+    id: str
+    # None for candidates whose features aren't in the store yet
+    distance: Optional[float]
+    matching_hashes: float
+    description: Optional[str] = None
+
+
+@dataclass
+class SearchResponse:
+    results: List[SearchResult]
+    n_candidates: int
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+# a query's hashes, or its (hash, weight) pairs if it's multi-probe
+QueryHashes = Sequence[Union[str, Tuple[str, float]]]
+
+
+def cosine_distances(query: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+    query = query.astype(np.float32).reshape(-1)
+    candidates = candidates.astype(np.float32)
+    norms = np.linalg.norm(candidates, axis=1) * np.linalg.norm(query)
+    similarities = candidates @ query / np.maximum(norms, 1e-12)
+    return 1 - similarities
+
+
+def build_hash_query(
+    hashes: QueryHashes,
+    minimum_should_match: Union[int, str],
+) -> dict:
+    # each hash is wrapped in a constant_score clause, so a candidate's score
+    # is simply the number of buckets it shares with the query. Multi-probe
+    # hashes come with a weight, which becomes the clause's boost
+    clauses = []
+    for lsh_hash in hashes:
+        weight = None
+        if not isinstance(lsh_hash, str):
+            lsh_hash, weight = lsh_hash
+        clause = {"filter": {"term": {"lsh-hash": lsh_hash}}}
+        if weight is not None:
+            clause["boost"] = weight
+        clauses.append({"constant_score": clause})
+    return {
+        "bool": {
+            "should": clauses,
+            "minimum_should_match": minimum_should_match,
+        }
+    }
+
+
+def resolve_minimum_should_match(
+    minimum_should_match: Union[int, str], n_tokens: int
+) -> Union[int, str]:
+    """
+    A document holds n_tokens hashes, so with multi-probe queries it can
+    match at most n_tokens of the query's clauses. Percentages are converted
+    to a number of tokens, rather than left relative to the number of clauses.
+    """
+    if isinstance(minimum_should_match, str) and "%" in minimum_should_match:
+        percentage = float(minimum_should_match[:-1])
+        return max(int(n_tokens * percentage / 100), 1)
+    return minimum_should_match
+
+
+class SearchEngine:
+    """
+    Finds the nearest neighbours of a feature vector by retrieving the
+    documents which share the most LSH buckets with it, and re-ranking those
+    candidates by their exact cosine distance to the query.
+
+    With n_probes > 1, queries probe the n_probes nearest buckets in each
+    group rather than just the nearest one, weighted by their distance from
+    the query, which recovers neighbours that fell just across a bucket
+    boundary. This reaches a given recall with fewer groups, and so with a
+    smaller index, at the cost of larger queries.
+    """
+
+    def __init__(
+        self,
+        es: Elasticsearch,
+        index_name: str,
+        model: LSHModel,
+        feature_store: FeatureStore,
+        n_candidates: int = 100,
+        minimum_should_match: Union[int, str] = "10%",
+        k: int = 10,
+        n_probes: int = 1,
+    ):
+        self.es = es
+        self.index_name = index_name
+        self.model = model
+        self.feature_store = feature_store
+        self.n_candidates = n_candidates
+        self.minimum_should_match = minimum_should_match
+        self.k = k
+        self.n_probes = n_probes
+        # every query token becomes a clause, so a query which is too large
+        # would fail on every search rather than here
+        n_clauses = model.n_query_tokens(n_probes)
+        if n_clauses > max_clause_count:
+            raise ValueError(
+                f"Queries with {n_probes} probes would have {n_clauses} "
+                f"clauses, more than elasticsearch's limit of "
+                f"{max_clause_count}. Use fewer probes, a model with fewer "
+                "groups or a smaller band size, or raise "
+                "indices.query.bool.max_clause_count and set "
+                "ELASTICSEARCH_MAX_CLAUSE_COUNT to match"
+            )
+
+    def hash_batch(self, features: np.ndarray) -> List[QueryHashes]:
+        """Hash an (N, D) matrix of query vectors"""
+        if self.n_probes > 1:
+            return self.model.predict_probes_batch(features, self.n_probes)
+        return self.model.predict_batch(features)
+
+    def search(
+        self,
+        features: Optional[np.ndarray] = None,
+        image_id: Optional[str] = None,
+        k: Optional[int] = None,
+        n_candidates: Optional[int] = None,
+        minimum_should_match: Optional[Union[int, str]] = None,
+    ) -> SearchResponse:
+        if (features is None) == (image_id is None):
+            raise ValueError("Exactly one of features or image_id is required")
+        timings = {}
+
+        start = time.perf_counter()
+        if image_id is not None:
+            features = np.asarray(self.feature_store.get(image_id))
+        timings["lookup"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        hashes = self.hash_batch(features.reshape(1, -1))[0]
+        timings["hash"] = time.perf_counter() - start
+
+        response = self.search_hashes(
+            features,
+            hashes,
+            k=k,
+            n_candidates=n_candidates,
+            minimum_should_match=minimum_should_match,
+            exclude_id=image_id,
+        )
+        response.timings = {**timings, **response.timings}
+        return response
+
+    def search_hashes(
+        self,
+        features: np.ndarray,
+        hashes: QueryHashes,
+        k: Optional[int] = None,
+        n_candidates: Optional[int] = None,
+        minimum_should_match: Optional[Union[int, str]] = None,
+        exclude_id: Optional[str] = None,
+    ) -> SearchResponse:
+        start = time.perf_counter()
+        response = self.es.search(
+            index=self.index_name,
+            body=self.build_search_body(
+                hashes, n_candidates, minimum_should_match
+            ),
+        )
+        retrieve_time = time.perf_counter() - start
+        search_response = self.rerank(features, response, k, exclude_id)
+        search_response.timings = {
+            "retrieve": retrieve_time,
+            **search_response.timings,
+        }
+        return search_response
+
+    def build_search_body(
+        self,
+        hashes: QueryHashes,
+        n_candidates: Optional[int] = None,
+        minimum_should_match: Optional[Union[int, str]] = None,
+    ) -> dict:
+        if minimum_should_match is None:
+            minimum_should_match = self.minimum_should_match
+        if self.n_probes > 1:
+            minimum_should_match = resolve_minimum_should_match(
+                minimum_should_match, self.model.n_tokens
+            )
+        return {
+            "size": n_candidates or self.n_candidates,
+            "_source": ["description"],
+            "query": build_hash_query(hashes, minimum_should_match),
+        }
+
+    def rerank(
+        self,
+        features: np.ndarray,
+        es_response: dict,
+        k: Optional[int] = None,
+        exclude_id: Optional[str] = None,
+    ) -> SearchResponse:
+        """
+        Re-rank candidates by their exact distance to the query. Documents
+        are indexed before their features are written to the store, so
+        candidates whose features aren't stored yet keep their place in
+        elasticsearch's score order, and the stored candidates are sorted by
+        distance into the places around them. New images are searchable as
+        soon as they're indexed.
+        """
+        k = k or self.k
+        timings = {}
+        hits = [
+            hit
+            for hit in es_response["hits"]["hits"]
+            if hit["_id"] != exclude_id
+        ]
+        stored = [
+            i for i, hit in enumerate(hits) if hit["_id"] in self.feature_store
+        ]
+
+        start = time.perf_counter()
+        if stored:
+            candidate_features = self.feature_store.get_many(
+                [hits[i]["_id"] for i in stored]
+            )
+        timings["fetch"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        distances: List[Optional[float]] = [None] * len(hits)
+        order = list(range(len(hits)))
+        if stored:
+            if candidate_features.shape[1] != features.shape[-1]:
+                # the store holds vectors in the model's reduced space
+                features = self.model.reduce(features)
+            stored_distances = cosine_distances(features, candidate_features)
+            for i, distance in zip(stored, stored_distances.tolist()):
+                distances[i] = distance
+            for place, j in zip(stored, np.argsort(stored_distances)):
+                order[place] = stored[j]
+        results = [
+            SearchResult(
+                id=hits[i]["_id"],
+                distance=distances[i],
+                matching_hashes=hits[i]["_score"],
+                description=hits[i].get("_source", {}).get("description"),
+            )
+            for i in order[:k]
+        ]
+        timings["rerank"] = time.perf_counter() - start
+
+        log.debug(
+            f"Found {len(results)} results from {len(hits)} candidates in "
+            + ", ".join(
+                f"{phase} {seconds * 1000:.1f}ms"
+                for phase, seconds in timings.items()
+            )
+        )
+        return SearchResponse(
+            results=results, n_candidates=len(hits), timings=timings
+        )
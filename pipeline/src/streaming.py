@@ -0,0 +1,174 @@
+import queue
+import threading
+import time
+from typing import Callable, Iterable, List, Optional
+
+from .log import get_logger
+from .metrics import metrics
+
+log = get_logger()
+
+# marks the end of a queue's items
+END = object()
+
+
+class Stopped(Exception):
+    """Raised in a stage's threads when another stage has failed"""
+
+
+class Stream:
+    """
+    A chain of stages, each run by its own threads and connected to the next
+    by a bounded queue. A stage which falls behind fills its input queue,
+    which blocks the stage before it, so memory use stays bounded and the
+    slowest stage sets the pace of the whole stream.
+
+    Each stage calls its function with a batch of up to `batch_size` items,
+    waiting at most `max_wait` seconds after the first item for more to
+    arrive, and passes whatever the function returns on to the next stage.
+    Every call is timed in `metrics` under the stage's name. If any stage
+    raises, the whole stream stops and `run` re-raises the exception.
+    """
+
+    def __init__(self, queue_size: int = 256):
+        self.queue_size = queue_size
+        self.stages = []
+        self.stopped = threading.Event()
+        self.errors: List[BaseException] = []
+
+    def stage(
+        self,
+        name: str,
+        function: Callable[[list], Optional[Iterable]],
+        n_threads: int = 1,
+        batch_size: int = 1,
+        max_wait: float = 0.0,
+    ) -> "Stream":
+        self.stages.append((name, function, n_threads, batch_size, max_wait))
+        return self
+
+    def run(self, items: Iterable):
+        """Feed items through every stage, returning once they're all done"""
+        queues = [
+            queue.Queue(maxsize=self.queue_size)
+            for _ in range(len(self.stages))
+        ]
+        threads = []
+        for i, (name, function, n_threads, batch_size, max_wait) in enumerate(
+            self.stages
+        ):
+            outbox = queues[i + 1] if i + 1 < len(queues) else None
+            remaining = [n_threads]
+            lock = threading.Lock()
+            for _ in range(n_threads):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(
+                        name,
+                        function,
+                        queues[i],
+                        outbox,
+                        batch_size,
+                        max_wait,
+                        remaining,
+                        lock,
+                    ),
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in items:
+                self._put(queues[0], item)
+            self._put(queues[0], END)
+        except Exception as e:
+            self._fail(e)
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def _work(
+        self,
+        name: str,
+        function: Callable[[list], Optional[Iterable]],
+        inbox: queue.Queue,
+        outbox: Optional[queue.Queue],
+        batch_size: int,
+        max_wait: float,
+        remaining: List[int],
+        lock: threading.Lock,
+    ):
+        try:
+            ended = False
+            while not ended:
+                batch, ended = self._next_batch(inbox, batch_size, max_wait)
+                if not batch:
+                    continue
+                with metrics.timer(name, len(batch)):
+                    outputs = function(batch)
+                if outbox is not None:
+                    for output in outputs or []:
+                        self._put(outbox, output)
+            # the last of a stage's threads to finish ends the next stage
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and outbox is not None:
+                self._put(outbox, END)
+        except Stopped:
+            pass
+        except Exception as e:
+            log.error(f"Error in the {name} stage of the stream: {e}")
+            self._fail(e)
+
+    def _next_batch(
+        self, inbox: queue.Queue, batch_size: int, max_wait: float
+    ):
+        item = self._get(inbox)
+        if item is END:
+            # leave the end in place for the stage's other threads
+            inbox.put(END)
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + max_wait
+        while len(batch) < batch_size:
+            # once the wait is over, only take items which are already queued
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = inbox.get(timeout=timeout)
+                else:
+                    item = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is END:
+                inbox.put(END)
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _put(self, destination: queue.Queue, item):
+        while True:
+            if self.stopped.is_set():
+                raise Stopped()
+            try:
+                destination.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, source: queue.Queue):
+        while True:
+            if self.stopped.is_set():
+                raise Stopped()
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def _fail(self, error: BaseException):
+        if not isinstance(error, Stopped):
+            self.errors.append(error)
+        self.stopped.set()
@@ -0,0 +1,279 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+from urllib.parse import urlparse
+
+import numpy as np
+import requests
+import torch
+from datasets import load_dataset
+from PIL import Image, UnidentifiedImageError
+from src.descriptions import DescriptionStore
+from src.download import HostRateLimiter, create_http_session, download_image
+from src.extraction import load_feature_extractor, preprocess
+from src.feature_store import FeatureStore
+from src.indexing import (
+    BulkIndexSummary,
+    create_index,
+    find_missing_ids,
+    get_elasticsearch_client,
+    get_index_name,
+    get_versioned_index_name,
+    index_batch,
+    swap_alias,
+)
+from src.io import (
+    get_latest_model_name,
+    get_manifest,
+    load_model,
+    save_image,
+)
+from src.log import get_logger
+from src.metrics import metrics
+from src.partition import Checkpoint, StreamPosition, get_partition
+from src.streaming import Stream
+
+log = get_logger()
+
+concurrency = int(os.environ.get("DOWNLOAD_CONCURRENCY", 64))
+timeout = float(os.environ.get("DOWNLOAD_TIMEOUT", 5))
+requests_per_host_per_second = float(
+    os.environ.get("REQUESTS_PER_HOST_PER_SECOND", 10)
+)
+preprocess_workers = int(
+    os.environ.get("PREPROCESS_WORKERS", os.cpu_count() or 1)
+)
+feature_batch_size = int(os.environ.get("FEATURE_BATCH_SIZE", 32))
+index_batch_size = int(os.environ.get("INDEX_BATCH_SIZE", 500))
+index_concurrency = int(os.environ.get("INDEX_CONCURRENCY", 4))
+index_max_retries = int(os.environ.get("INDEX_MAX_RETRIES", 3))
+max_wait = float(os.environ.get("BATCH_WAIT_MS", 500)) / 1000
+queue_size = int(os.environ.get("QUEUE_SIZE", 256))
+persist_images = os.environ.get("PERSIST_IMAGES", "false") == "true"
+persist_features = os.environ.get("PERSIST_FEATURES", "true") == "true"
+save_workers = int(os.environ.get("SAVE_WORKERS", 8))
+flush_interval = float(os.environ.get("FEATURE_FLUSH_SECONDS", 300))
+if os.environ.get("TORCH_THREADS"):
+    torch.set_num_threads(int(os.environ.get("TORCH_THREADS")))
+
+
+@dataclass
+class Item:
+    position: int
+    id: str
+    url: str
+    description: str
+    image: Optional[Image.Image] = None
+    tensor: Optional[torch.Tensor] = None
+    features: Optional[np.ndarray] = None
+    hashes: Optional[List[str]] = None
+
+
+partition = get_partition()
+checkpoint = Checkpoint("stream", partition)
+# partitions which don't share a run id would each create their own index,
+# and swap the alias away from the ones the others are writing to
+if partition.partitioned and not checkpoint.enabled:
+    raise ValueError("RUN_ID must be set to run the stream in partitions")
+
+model_name = checkpoint.state.get("model_name") or (
+    os.environ.get("MODEL_NAME") or get_latest_model_name()
+)
+log.info(f"Loading model {model_name}")
+model = load_model(model_name)
+feature_extractor = load_feature_extractor()
+
+# new documents go straight into the live index behind the model's alias,
+# which is created if no other step has built it yet
+es = get_elasticsearch_client(maxsize=index_concurrency + 1)
+alias = get_index_name(model_name)
+if not es.indices.exists(index=alias):
+    index_name = get_versioned_index_name(alias, version=checkpoint.run_id)
+    log.info(f"Creating index {index_name}")
+    create_index(es, index_name, exist_ok=True)
+    swap_alias(es, alias, index_name)
+checkpoint.save(model_name=model_name)
+
+log.info("Streaming dataset")
+dataset = load_dataset(
+    "ChristophSchuhmann/improved_aesthetics_6.5plus",
+    split="train",
+    streaming=True,
+)
+start_position = checkpoint.state.get("position", 0)
+if start_position:
+    log.info(f"Skipping the first {start_position} rows of the dataset")
+    dataset = dataset.skip(start_position)
+stream_position = StreamPosition(start_position)
+
+writer = f"stream-{partition.name}" if partition.partitioned else "stream"
+feature_store = FeatureStore(writer=writer)
+description_store = DescriptionStore(writer=writer)
+session = create_http_session(concurrency)
+rate_limiter = HostRateLimiter(requests_per_host_per_second)
+summary = BulkIndexSummary()
+summary_lock = threading.Lock()
+# items whose features are buffered in the feature store, and can't be
+# checkpointed until it's flushed
+unflushed: List[Item] = []
+last_flush = time.monotonic()
+
+
+def save_checkpoint(**state):
+    # saved images are only listed in the manifest once it's flushed, and its
+    # atexit flush doesn't run when the task is killed
+    stores = [description_store]
+    if persist_images:
+        stores.append(get_manifest("images"))
+    checkpoint.save_position(stream_position, flush=stores, **state)
+
+
+def yield_items():
+    for position, row in enumerate(dataset, start=start_position):
+        if checkpoint.due():
+            save_checkpoint()
+        if str(row["hash"]) not in partition:
+            stream_position.skip(position)
+            continue
+        stream_position.start(position)
+        yield Item(position, str(row["hash"]), row["URL"], row["TEXT"])
+
+
+def lookup(items: List[Item]) -> List[Item]:
+    # documents are indexed before their features and descriptions are
+    # flushed, so a restarted task replays rows which are in the index but
+    # were never persisted. Only rows which are in all three are skipped
+    ids = [item.id for item in items]
+    indexed = set(ids) - set(find_missing_ids(es, alias, ids))
+    described = description_store.get_many(indexed)
+    done = {
+        item_id
+        for item_id in indexed
+        if item_id in described
+        and (not persist_features or item_id in feature_store)
+    }
+    for item in items:
+        if item.id in done:
+            stream_position.finish(item.position)
+    metrics.add("skip", len(done))
+    return [item for item in items if item.id not in done]
+
+
+def download(items: List[Item]) -> List[Item]:
+    item = items[0]
+    try:
+        rate_limiter.wait(urlparse(item.url).netloc)
+        item.image, _ = download_image(session, item.url, timeout)
+    except (requests.RequestException, UnidentifiedImageError, OSError) as e:
+        log.debug(f"Error downloading image from {item.url}: {e}")
+        metrics.stage("download").error()
+        stream_position.finish(item.position)
+        return []
+    return [item]
+
+
+def transform(items: List[Item]) -> List[Item]:
+    for item in items:
+        item.tensor = preprocess(item.image)
+        if not persist_images:
+            item.image = None
+    return items
+
+
+def extract(items: List[Item]) -> List[Item]:
+    features = feature_extractor(torch.stack([item.tensor for item in items]))
+    for item, item_features in zip(items, features):
+        item.features = item_features
+        item.tensor = None
+    return items
+
+
+def hash_features(items: List[Item]) -> List[Item]:
+    hashes = model.predict_batch(np.stack([item.features for item in items]))
+    for item, item_hashes in zip(items, hashes):
+        item.hashes = item_hashes
+    return items
+
+
+def index(items: List[Item]) -> List[Item]:
+    documents = {
+        item.id: {"lsh-hash": item.hashes, "description": item.description}
+        for item in items
+    }
+    index_batch(
+        es,
+        alias,
+        documents,
+        summary,
+        summary_lock,
+        max_retries=index_max_retries,
+    )
+    return items
+
+
+def save_images(items: List[Item]) -> List[Item]:
+    for item in items:
+        save_image(image=item.image, filename=item.id)
+        item.image = None
+    return items
+
+
+def store(items: List[Item]):
+    description_store.add_many((item.id, item.description) for item in items)
+    for item in items:
+        if persist_features:
+            feature_store.append(item.id, item.features)
+        unflushed.append(item)
+        # the feature store writes a shard as soon as it's full, which is
+        # when the items in it can be checkpointed
+        if len(unflushed) >= feature_store.shard_size:
+            flush()
+    # partial shards are only written now and then, since every shard adds
+    # to the cost of reading the store
+    if time.monotonic() - last_flush >= flush_interval:
+        flush()
+
+
+def flush():
+    global last_flush
+    feature_store.flush()
+    for item in unflushed:
+        stream_position.finish(item.position)
+    unflushed.clear()
+    last_flush = time.monotonic()
+
+
+# downloads are io-bound, so they get many threads. Everything after the
+# download runs in parallel with it, and each stage only blocks when the one
+# after it falls behind
+stream = (
+    Stream(queue_size=queue_size)
+    .stage("lookup", lookup, batch_size=100, max_wait=max_wait)
+    .stage("download", download, n_threads=concurrency)
+    .stage("transform", transform, n_threads=preprocess_workers)
+    .stage(
+        "extract", extract, batch_size=feature_batch_size, max_wait=max_wait
+    )
+    .stage("hash", hash_features, batch_size=feature_batch_size)
+    .stage(
+        "bulk",
+        index,
+        n_threads=index_concurrency,
+        batch_size=index_batch_size,
+        max_wait=max_wait,
+    )
+)
+if persist_images:
+    stream.stage("save-image", save_images, n_threads=save_workers)
+stream.stage("store", store, batch_size=feature_batch_size)
+
+log.info(f"Streaming new images into {alias}")
+metrics.start_reporting()
+stream.run(yield_items())
+flush()
+save_checkpoint(complete=True)
+log.info(str(summary))
+for document_id, error in summary.errors:
+    log.error(f"Error indexing {document_id}: {error}")
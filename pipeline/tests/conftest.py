@@ -0,0 +1,43 @@
+import os
+import shutil
+import sys
+from pathlib import Path
+from uuid import uuid4
+
+import pytest
+
+# the containers run with the pipeline directory as their working directory,
+# and the stand-ins live alongside the benchmark which uses them
+pipeline_dir = Path(__file__).parent.parent
+sys.path[:0] = [str(pipeline_dir), str(pipeline_dir / "benchmark")]
+os.environ.setdefault("STORAGE_ENVIRONMENT", "local")
+
+
+@pytest.fixture
+def store_name():
+    """A unique store name under the data directory, removed afterwards"""
+    from src.io import data_dir
+
+    name = f"test-{uuid4().hex[:8]}"
+    yield name
+    shutil.rmtree(data_dir / name, ignore_errors=True)
+
+
+@pytest.fixture
+def manifest_prefix():
+    """A unique manifest prefix, removed afterwards"""
+    from src.io import manifest_dir
+
+    prefix = f"test-{uuid4().hex[:8]}"
+    yield prefix
+    shutil.rmtree(manifest_dir / prefix, ignore_errors=True)
+
+
+@pytest.fixture
+def checkpoint_step():
+    """A unique step name for checkpoints, removed afterwards"""
+    from src.io import data_dir
+
+    step = f"test-{uuid4().hex[:8]}"
+    yield step
+    shutil.rmtree(data_dir / "checkpoints" / step, ignore_errors=True)
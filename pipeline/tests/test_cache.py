@@ -0,0 +1,98 @@
+import os
+import threading
+
+import pytest
+from src.cache import DiskCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = DiskCache(tmp_path, max_bytes=1000)
+    cache.size_scan.join()
+    return cache
+
+
+def test_reads_through(cache):
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return b"data"
+
+    assert cache.get_or_fetch("bucket/key", fetch) == b"data"
+    assert cache.get_or_fetch("bucket/key", fetch) == b"data"
+    path = cache.get_path_or_fetch("bucket/key", fetch)
+    assert path.read_bytes() == b"data"
+    assert len(fetches) == 1
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+
+
+def test_writes_are_atomic(cache):
+    payloads = [bytes([i]) * (100 + i) for i in range(8)]
+    read = []
+
+    def write(payload):
+        for _ in range(50):
+            cache.put("bucket/key", payload)
+
+    def read_while_writing():
+        for _ in range(200):
+            data = cache.get("bucket/key")
+            if data is not None:
+                read.append(data)
+
+    threads = [threading.Thread(target=write, args=(p,)) for p in payloads]
+    threads.append(threading.Thread(target=read_while_writing))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # readers only ever see whole files, and no temporary files are left
+    assert read and all(data in payloads for data in read)
+    assert cache.get("bucket/key") in payloads
+    assert not list(cache.directory.glob("*/*.tmp"))
+
+
+def test_least_recently_used_files_are_evicted(cache):
+    for i in range(9):
+        path = cache.put(f"bucket/{i}", b"x" * 100)
+        os.utime(path, (i, i))
+    # reading a file makes it the most recently used
+    cache.get("bucket/0")
+    assert cache.size == 900
+
+    cache.put("bucket/9", b"x" * 200)
+    # the cache is cut back to 90% of its limit, oldest first
+    assert cache.size == 900
+    assert [cache.get(f"bucket/{i}") is not None for i in range(10)] == [
+        True,
+        False,
+        False,
+        True,
+        True,
+        True,
+        True,
+        True,
+        True,
+        True,
+    ]
+
+
+def test_existing_files_are_counted(cache, tmp_path):
+    cache.put("bucket/a", b"x" * 300)
+    cache.put("bucket/b", b"x" * 400)
+    # files which are still being written aren't counted
+    partial = cache.path_for("bucket/a").with_suffix(".tmp")
+    partial.write_bytes(b"x" * 50)
+
+    reopened = DiskCache(tmp_path, max_bytes=1000)
+    reopened.size_scan.join()
+    assert reopened.size == 700
+    assert reopened.get("bucket/b") == b"x" * 400
+
+    # a cache which starts out over its limit is evicted in the background
+    smaller = DiskCache(tmp_path, max_bytes=500)
+    smaller.size_scan.join()
+    assert smaller.size == 400
+    assert smaller.get("bucket/a") is None
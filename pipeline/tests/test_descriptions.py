@@ -0,0 +1,123 @@
+import numpy as np
+from src.descriptions import BloomFilter, DescriptionStore, id_hashes
+from src.io import data_dir
+
+
+def descriptions(start, stop):
+    return {f"id-{i}": f"description {i}" for i in range(start, stop)}
+
+
+def spy_on_queries(store):
+    """Record the segments which a store queries, and the ids it asks for"""
+    queries = []
+    query = store._query
+
+    def spy(segment, image_ids):
+        queries.append((segment, list(image_ids)))
+        return query(segment, image_ids)
+
+    store._query = spy
+    return queries
+
+
+def test_bloom_filter():
+    image_ids = [f"id-{i}" for i in range(1000)]
+    bloom = BloomFilter.from_bytes(BloomFilter.build(image_ids).to_bytes())
+    assert bloom.might_contain(id_hashes(image_ids)).all()
+    others = id_hashes([f"other-{i}" for i in range(10000)])
+    assert bloom.might_contain(others).mean() < 0.03
+
+
+def test_flushes_merge_partial_segments(store_name):
+    store = DescriptionStore(store_name, segment_size=10)
+    store.add_many(descriptions(0, 4).items())
+    store.flush()
+    store.add_many(descriptions(4, 8).items())
+    store.flush()
+    # the second flush folds the first partial segment into its own
+    assert len(store.segments) == 1
+    store.add_many(descriptions(8, 25).items())
+    store.close()
+
+    # the partial segment is folded into the next full one too, and the rest
+    # are left in a single partial segment
+    store = DescriptionStore(store_name, segment_size=10)
+    assert len(store.segments) == 2
+    assert store.get_many(descriptions(0, 30)) == descriptions(0, 25)
+    assert not list((data_dir / store_name).glob("*.tmp"))
+
+
+def test_lookups_are_routed_to_one_segment(store_name):
+    with DescriptionStore(store_name, segment_size=100) as store:
+        store.add_many(descriptions(0, 1000).items())
+
+    store = DescriptionStore(store_name, segment_size=100)
+    assert len(store.segments) == 10
+    queries = spy_on_queries(store)
+    image_ids = [f"id-{i}" for i in range(0, 1000, 97)]
+    assert store.get_many(image_ids) == {
+        image_id: f"description {image_id[3:]}" for image_id in image_ids
+    }
+    # each id is only looked for in the segment which holds it, give or take
+    # the odd false positive
+    n_lookups = sum(len(ids) for _, ids in queries)
+    assert n_lookups <= len(image_ids) + 2
+    assert store.get_many(["missing"]) == {}
+
+
+def test_segments_without_filters_are_queried(store_name):
+    with DescriptionStore(store_name, segment_size=10) as store:
+        store.add_many(descriptions(0, 20).items())
+    # segments written before filters existed have no .bloom file
+    for path in (data_dir / store_name).glob("*.bloom"):
+        path.unlink()
+
+    store = DescriptionStore(store_name, segment_size=10)
+    assert store.get_many(descriptions(0, 20)) == descriptions(0, 20)
+
+
+def test_writers_share_a_store(store_name):
+    first = DescriptionStore(store_name, segment_size=10, writer="a")
+    second = DescriptionStore(store_name, segment_size=10, writer="b")
+    first.add_many(descriptions(0, 5).items())
+    second.add_many(descriptions(5, 10).items())
+    first.close()
+    second.close()
+    # a writer only ever merges its own partial segment
+    first.add_many(descriptions(10, 12).items())
+    first.close()
+
+    store = DescriptionStore(store_name)
+    assert sorted(store.segments) == ["a-000001", "b-000000"]
+    assert store.get_many(descriptions(0, 12)) == descriptions(0, 12)
+
+
+def test_refreshes_when_a_segment_is_merged_away(store_name):
+    writer = DescriptionStore(store_name, segment_size=10, writer="a")
+    writer.add_many(descriptions(0, 5).items())
+    writer.flush()
+    reader = DescriptionStore(store_name)
+    assert reader.segments == ["a-000000"]
+
+    # the writer merges its partial segment into a new one, which the reader
+    # hasn't seen yet
+    writer.add_many(descriptions(5, 8).items())
+    writer.close()
+    assert reader.get_many(descriptions(0, 8)) == descriptions(0, 8)
+    assert reader.segments == ["a-000001"]
+
+
+def test_few_open_segments(store_name, monkeypatch):
+    monkeypatch.setattr("src.descriptions.max_open_segments", 2)
+    with DescriptionStore(store_name, segment_size=10) as store:
+        store.add_many(descriptions(0, 100).items())
+
+    store = DescriptionStore(store_name, segment_size=10)
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        image_ids = [f"id-{i}" for i in rng.choice(100, 20, replace=False)]
+        found = store.get_many(image_ids)
+        assert found == {
+            image_id: f"description {image_id[3:]}" for image_id in image_ids
+        }
+        assert len(store._connections) <= 2
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from src.duplicates import (
+    band_keys,
+    candidate_pairs,
+    cluster_pairs,
+    find_duplicates,
+    verify_pairs,
+)
+from src.feature_store import FeatureStore
+from test_model import group_dim, make_model, n_groups
+
+
+def test_band_keys():
+    clusters = np.array([[1, 2, 3, 4], [1, 2, 4, 3], [0, 0, 0, 0]])
+    keys = band_keys(clusters, n_clusters=16, band_size=2)
+    assert keys.dtype == np.uint64
+    np.testing.assert_array_equal(
+        keys, [[1 * 16 + 2, 3 * 16 + 4], [1 * 16 + 2, 4 * 16 + 3], [0, 0]]
+    )
+    # a band of one group is just its cluster
+    np.testing.assert_array_equal(band_keys(clusters, 16, 1), clusters)
+    with pytest.raises(ValueError):
+        band_keys(clusters, 16, 3)
+
+
+def test_candidate_pairs():
+    keys = np.array([[1, 5], [1, 6], [2, 6], [1, 7]], dtype=np.uint64)
+    pairs = candidate_pairs(keys)
+    assert pairs.tolist() == [[0, 1], [0, 3], [1, 2], [1, 3]]
+    # no two rows share more than one band, until rows 0 and 1 do
+    assert candidate_pairs(keys, min_shared_bands=2).tolist() == []
+    keys[1, 1] = 5
+    assert candidate_pairs(keys, min_shared_bands=2).tolist() == [[0, 1]]
+
+
+def test_large_buckets_are_skipped():
+    keys = np.zeros((6, 2), dtype=np.uint64)
+    keys[:, 1] = [0, 0, 1, 1, 1, 1]
+    # the first band's bucket holds every row, which is over the limit, but
+    # the second band's buckets are small enough to join
+    pairs = candidate_pairs(keys, max_bucket_size=4)
+    assert pairs.tolist() == [
+        [0, 1], [2, 3], [2, 4], [2, 5], [3, 4], [3, 5], [4, 5]
+    ]
+    assert len(candidate_pairs(keys, max_bucket_size=6)) == 15
+    assert candidate_pairs(keys, max_bucket_size=1).shape == (0, 2)
+
+
+def test_verify_pairs(store_name):
+    vectors = np.array(
+        [[1, 0, 0], [0.99, 0.1, 0], [0, 1, 0], [2, 0.02, 0]], dtype=np.float32
+    )
+    ids = ["a", "b", "c", "d"]
+    with FeatureStore(store_name) as store:
+        store.append_many(ids, vectors)
+    pairs = np.array([[0, 1], [0, 2], [0, 3], [1, 2]])
+    # cosine distance ignores the length of a vector, so a and d match
+    verified = verify_pairs(FeatureStore(store_name), ids, pairs, 0.01)
+    assert verified.tolist() == [[0, 1], [0, 3]]
+    verified = verify_pairs(FeatureStore(store_name), ids, pairs, 0.001)
+    assert verified.tolist() == [[0, 3]]
+    assert verify_pairs(store, ids, pairs[:0], 0.01).shape == (0, 2)
+
+
+def test_transitive_chains_form_one_cluster():
+    # 0-1 and 1-2 link 0 and 2, although they were never paired directly
+    pairs = np.array([[5, 6], [0, 1], [3, 4], [1, 2], [4, 6]])
+    clusters = sorted(sorted(cluster) for cluster in cluster_pairs(pairs))
+    assert clusters == [[0, 1, 2], [3, 4, 5, 6]]
+    assert cluster_pairs(np.empty((0, 2), dtype=np.int64)) == []
+
+
+def test_find_duplicates(store_name):
+    rng = np.random.default_rng(0)
+    dim = n_groups * group_dim
+    originals = rng.normal(size=(20, dim)).astype(np.float32)
+    copies = originals[:3] * 1.5 + rng.normal(scale=1e-3, size=(3, dim))
+    ids = [f"image-{i:02d}" for i in range(20)] + ["copy-0", "copy-1"]
+    with FeatureStore(store_name) as store:
+        store.append_many(ids[:20], originals)
+        store.append_many(ids[20:], copies[:2].astype(np.float32))
+        store.append("copy-of-copy-0", copies[0].astype(np.float32))
+
+    clusters = find_duplicates(
+        FeatureStore(store_name), make_model(), band_size=2
+    )
+    assert clusters == [
+        ["copy-0", "copy-of-copy-0", "image-00"],
+        ["copy-1", "image-01"],
+    ]
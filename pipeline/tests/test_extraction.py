@@ -0,0 +1,65 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+
+from PIL import Image  # noqa: E402
+from src.extraction import (  # noqa: E402
+    FeatureExtractor,
+    from_pixels,
+    input_size,
+    to_pixels,
+)
+
+
+def make_jpeg(size=(1200, 900)) -> Image.Image:
+    # a smooth gradient, so that decoding at a reduced scale loses little
+    x = np.linspace(0, 255, size[0], dtype=np.float32)
+    y = np.linspace(0, 255, size[1], dtype=np.float32)
+    pixels = np.stack(
+        [
+            np.add.outer(y, x) / 2,
+            np.broadcast_to(x, (size[1], size[0])),
+            np.broadcast_to(y[:, np.newaxis], (size[1], size[0])),
+        ],
+        axis=2,
+    ).astype(np.uint8)
+    image_bytes = BytesIO()
+    Image.fromarray(pixels).save(image_bytes, format="JPEG", quality=95)
+    return Image.open(BytesIO(image_bytes.getvalue()))
+
+
+def test_pixels_are_decoded_at_a_reduced_scale():
+    image = make_jpeg()
+    pixels = to_pixels(image)
+    # a quarter of the size is the smallest scale which still covers 224x224
+    assert image.size == (300, 225)
+    assert pixels.dtype == torch.uint8
+    assert tuple(pixels.shape) == (3, *input_size)
+
+    full = make_jpeg().convert("RGB").resize(input_size, Image.BILINEAR)
+    full = torch.from_numpy(np.array(full)).permute(2, 0, 1)
+    assert (pixels.float() - full.float()).abs().mean() < 3
+
+
+def test_pixels_are_normalised_for_the_model():
+    pixels = torch.full((2, 3, *input_size), 255, dtype=torch.uint8)
+    normalised = from_pixels(pixels)
+    assert normalised.dtype == torch.float32
+    expected = (1 - torch.tensor([0.485, 0.456, 0.406])) / torch.tensor(
+        [0.229, 0.224, 0.225]
+    )
+    assert torch.allclose(normalised[1, :, 0, 0], expected)
+
+
+def test_extractors_must_implement_call():
+    class Incomplete(FeatureExtractor):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete("vgg16", "eager")
+    with pytest.raises(TypeError):
+        FeatureExtractor("vgg16", "eager")
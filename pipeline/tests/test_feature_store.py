@@ -0,0 +1,166 @@
+import numpy as np
+import pytest
+from src.feature_store import FeatureStore
+
+dim = 24
+
+
+def make_vectors(n):
+    return np.random.default_rng(0).normal(size=(n, dim)).astype(np.float32)
+
+
+def test_round_trip(store_name):
+    vectors = make_vectors(10)
+    ids = [f"id-{i}" for i in range(10)]
+    with FeatureStore(store_name, shard_size=4) as store:
+        store.append_many(ids, vectors)
+        # buffered vectors are visible before they're flushed
+        assert len(store) == 10
+        assert "id-9" in store
+
+    store = FeatureStore(store_name)
+    assert len(store) == 10
+    assert list(store.ids()) == ids
+    assert len(store.shard_ids) == 3
+    np.testing.assert_array_equal(store.get("id-5"), vectors[5])
+    order = [7, 0, 3, 9, 4]
+    np.testing.assert_array_equal(
+        store.get_many([ids[i] for i in order]), vectors[order]
+    )
+    shard_ids, shard_vectors = zip(*store.iter_shards())
+    assert sum(shard_ids, []) == ids
+    np.testing.assert_array_equal(np.concatenate(shard_vectors), vectors)
+
+
+
+def test_writers_append_to_the_same_store(store_name):
+    # partitioned tasks each write shards prefixed with their own name
+    vectors = make_vectors(6)
+    with FeatureStore(store_name, writer="a") as first:
+        first.append_many(["a0", "a1", "a2"], vectors[:3])
+    with FeatureStore(store_name, writer="b") as second:
+        second.append_many(["b0", "b1", "b2"], vectors[3:])
+    with FeatureStore(store_name, writer="a") as first:
+        first.append("a3", vectors[0])
+
+    store = FeatureStore(store_name)
+    assert sorted(store.shard_ids) == ["a-000000", "a-000001", "b-000000"]
+    assert len(store) == 7
+    np.testing.assert_array_equal(
+        store.get_many(["b1", "a3", "a2"]), vectors[[4, 0, 2]]
+    )
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_compressed_round_trip(store_name, dtype):
+    vectors = make_vectors(10)
+    ids = [f"id-{i}" for i in range(10)]
+    with FeatureStore(store_name, shard_size=4, dtype=dtype) as store:
+        store.append_many(ids, vectors)
+
+    # the dtype of an existing store comes from its metadata
+    store = FeatureStore(store_name)
+    assert store.dtype == np.dtype(dtype)
+    if dtype == "int8":
+        # each row is quantized to 255 levels of its largest magnitude, and
+        # is read back as float32
+        assert store.row_bytes == 4 + dim
+        assert store.get("id-5").dtype == np.float32
+        scales = np.abs(vectors).max(axis=1, keepdims=True) / 127
+        tolerance = scales / 2 + 1e-6
+    else:
+        assert store.row_bytes == 2 * dim
+        assert store.get("id-5").dtype == np.float16
+        tolerance = 1e-3 * (1 + np.abs(vectors))
+    order = [7, 0, 3, 9, 4]
+    read = store.get_many([ids[i] for i in order])
+    assert np.all(np.abs(read - vectors[order]) <= tolerance[order])
+    shard_vectors = np.concatenate([v for _, v in store.iter_shards()])
+    assert np.all(np.abs(shard_vectors - vectors) <= tolerance)
+
+
+def test_uint8_round_trip(store_name):
+    pixels = np.random.default_rng(0).integers(
+        0, 256, size=(5, dim), dtype=np.uint8
+    )
+    with FeatureStore(store_name, shard_size=2, dtype="uint8") as store:
+        store.append_many([f"id-{i}" for i in range(5)], pixels)
+
+    store = FeatureStore(store_name)
+    assert store.row_bytes == dim
+    read = store.get_many(["id-4", "id-1"])
+    assert read.dtype == np.uint8
+    np.testing.assert_array_equal(read, pixels[[4, 1]])
+
+
+def test_compressing_a_store(store_name):
+    from src.feature_store import compress_feature_store
+
+    from test_model import make_model
+
+    model = make_model("pca")
+    vectors = np.random.default_rng(0).normal(size=(10, 48)).astype(
+        np.float32
+    )
+    with FeatureStore(store_name) as source:
+        source.append_many([f"id-{i}" for i in range(10)], vectors)
+    target = FeatureStore(f"{store_name}/compressed", dtype="int8")
+    compress_feature_store(target, FeatureStore(store_name), model)
+
+    target = FeatureStore(f"{store_name}/compressed")
+    assert len(target) == 10
+    assert target.dim == model.reduction.n_components
+    reduced = model.reduce(vectors)
+    read = target.get_many([f"id-{i}" for i in range(10)])
+    scales = np.abs(reduced).max(axis=1, keepdims=True) / 127
+    assert np.all(np.abs(read - reduced) <= scales / 2 + 1e-5)
+
+
+def test_mis_sized_vectors_are_refused(store_name):
+    store = FeatureStore(store_name)
+    store.append("first", np.zeros(dim))
+    with pytest.raises(ValueError, match="length"):
+        store.append("second", np.zeros(dim + 1))
+
+
+def test_empty_store_returns_no_vectors(store_name):
+    store = FeatureStore(store_name)
+    assert store.get_many([]).shape == (0, 0)
+
+
+def test_buffered_vectors_can_be_read(store_name):
+    vectors = make_vectors(3)
+    store = FeatureStore(store_name, shard_size=2)
+    store.append_many(["a", "b", "c"], vectors)
+    # a and b were flushed as a shard, and c is still buffered
+    assert "c" in store
+    np.testing.assert_array_equal(store.get("c"), vectors[2])
+    np.testing.assert_array_equal(
+        store.get_many(["c", "a", "b"]), vectors[[2, 0, 1]]
+    )
+    assert store.get_many([]).shape == (0, dim)
+
+
+def test_migration_skips_vectors_already_stored(store_name, monkeypatch):
+    from src import feature_store
+
+    vectors = make_vectors(5)
+    old_files = {f"image-{i}": vectors[i] for i in range(5)}
+    loaded = []
+
+    def load_features(filename):
+        loaded.append(filename)
+        return old_files[filename]
+
+    monkeypatch.setattr(
+        feature_store, "yield_feature_filenames", lambda: iter(old_files)
+    )
+    monkeypatch.setattr(feature_store, "load_features", load_features)
+    with FeatureStore(store_name) as store:
+        store.append("image-0", vectors[0])
+
+    feature_store.migrate_feature_files(FeatureStore(store_name))
+    assert sorted(loaded) == [f"image-{i}" for i in range(1, 5)]
+    reopened = FeatureStore(store_name)
+    assert len(reopened) == 5
+    np.testing.assert_array_equal(
+        reopened.get_many(list(old_files)), vectors
+    )
@@ -0,0 +1,93 @@
+import pytest
+from elasticsearch import Elasticsearch
+from src.indexing import bulk_index
+from stand_ins import ElasticsearchStandIn
+
+
+@pytest.fixture
+def stand_in():
+    stand_in = ElasticsearchStandIn()
+    yield stand_in
+    stand_in.server.shutdown()
+
+
+def index(stand_in, n_documents=10, **kwargs):
+    es = Elasticsearch(stand_in.url)
+    documents = (
+        (str(i), {"lsh-hash": [f"0-{i}"]}) for i in range(n_documents)
+    )
+    return bulk_index(es, "test", documents, backoff=0, **kwargs)
+
+
+def test_overloaded_items_are_retried(stand_in):
+    stand_in.rejections["1"] = [429]
+    stand_in.rejections["2"] = [503, 502]
+    summary = index(stand_in)
+    assert summary.indexed == 10
+    assert summary.failed == 0
+    assert summary.retried == 3
+    assert summary.requests == 3
+    assert len(stand_in.documents) == 10
+
+
+def test_items_fail_when_retries_run_out(stand_in):
+    stand_in.rejections["1"] = [429] * 3
+    summary = index(stand_in, max_retries=2)
+    assert summary.indexed == 9
+    assert summary.failed == 1
+    assert summary.retried == 2
+    assert [document_id for document_id, _ in summary.errors] == ["1"]
+    assert "1" not in stand_in.documents
+
+
+def test_rejected_items_are_not_retried(stand_in):
+    stand_in.rejections["3"] = [400]
+    summary = index(stand_in)
+    assert summary.indexed == 9
+    assert summary.failed == 1
+    assert summary.retried == 0
+    assert summary.errors[0][0] == "3"
+    assert "status 400" in summary.errors[0][1]
+
+
+def test_failed_requests_are_retried(stand_in):
+    stand_in.failed_requests = [500]
+    summary = index(stand_in, batch_size=5, concurrency=1)
+    assert summary.indexed == 10
+    assert summary.failed == 0
+    assert summary.retried == 5
+    assert stand_in.bulk_requests == 3
+    assert len(stand_in.documents) == 10
+
+
+def test_failed_requests_are_counted_when_retries_run_out(stand_in):
+    stand_in.failed_requests = [429, 500, 500]
+    summary = index(stand_in, max_retries=2)
+    assert summary.indexed == 0
+    assert summary.failed == 10
+    assert summary.requests == 3
+    assert len(summary.errors) == 10
+    assert not stand_in.documents
+
+
+@pytest.mark.parametrize("status", [400, 401])
+def test_bad_requests_are_not_retried(stand_in, status):
+    stand_in.failed_requests = [status]
+    summary = index(stand_in)
+    assert summary.indexed == 0
+    assert summary.failed == 10
+    assert summary.retried == 0
+    assert stand_in.bulk_requests == 1
+
+
+def test_duplicate_ids_are_counted(stand_in):
+    es = Elasticsearch(stand_in.url)
+    documents = [
+        ("a", {"lsh-hash": ["0-1"]}),
+        ("b", {"lsh-hash": ["0-2"]}),
+        ("a", {"lsh-hash": ["0-3"]}),
+    ]
+    summary = bulk_index(es, "test", documents, backoff=0)
+    assert summary.indexed == 2
+    assert summary.duplicates == 1
+    assert stand_in.documents["a"] == {"lsh-hash": ["0-3"]}
@@ -0,0 +1,100 @@
+import os
+import subprocess
+import sys
+
+from src import io
+from src.io import Manifest, list_manifest_files, write_manifest_file
+
+from conftest import pipeline_dir
+
+# adds ids to a manifest with tiny deltas and frequent compactions, so that
+# several of these running at once compact over each other constantly
+WRITER = """
+import sys
+
+from src.io import Manifest
+
+prefix, name, n_ids = sys.argv[1], sys.argv[2], int(sys.argv[3])
+manifest = Manifest(prefix, flush_every=25, compact_every=3)
+for i in range(n_ids):
+    manifest.add(f"{name}-{i}")
+manifest.compact()
+"""
+
+
+def test_unlisted_prefixes_start_empty(manifest_prefix):
+    manifest = Manifest(manifest_prefix)
+    assert len(manifest) == 0
+    manifest.add("000001")
+    manifest.flush()
+    assert "000001" in Manifest(manifest_prefix)
+
+
+def test_ids_are_read_from_deltas(manifest_prefix):
+    manifest = Manifest(manifest_prefix, flush_every=2, compact_every=100)
+    for i in range(5):
+        manifest.add(f"id-{i}")
+    # two deltas have been flushed, and one id is still pending
+    deltas = [
+        filename
+        for filename in list_manifest_files(manifest_prefix)
+        if filename.endswith(".delta")
+    ]
+    assert len(deltas) == 2
+    assert set(Manifest(manifest_prefix)) == {f"id-{i}" for i in range(4)}
+
+    manifest.compact()
+    (filename,) = list_manifest_files(manifest_prefix)
+    assert filename.endswith(".manifest")
+    assert set(Manifest(manifest_prefix)) == {f"id-{i}" for i in range(5)}
+
+
+def test_reconcile_rebuilds_from_a_listing(manifest_prefix, monkeypatch):
+    write_manifest_file(manifest_prefix, "1-stale.manifest", "gone\nkept")
+    write_manifest_file(manifest_prefix, "2-stale.delta", "also-gone")
+    monkeypatch.setitem(
+        io.manifest_listings, manifest_prefix, lambda: ["kept", "new"]
+    )
+    manifest = Manifest(manifest_prefix)
+    assert "gone" in manifest
+
+    manifest.reconcile()
+    assert set(manifest) == {"kept", "new"}
+    assert len(list_manifest_files(manifest_prefix)) == 1
+    assert set(Manifest(manifest_prefix)) == {"kept", "new"}
+
+
+def test_a_missing_manifest_is_built_from_a_listing(
+    manifest_prefix, monkeypatch
+):
+    monkeypatch.setitem(
+        io.manifest_listings, manifest_prefix, lambda: ["a", "b"]
+    )
+    assert set(Manifest(manifest_prefix)) == {"a", "b"}
+    assert list_manifest_files(manifest_prefix)
+
+
+def test_concurrent_compactions_keep_every_id(manifest_prefix):
+    write_manifest_file(manifest_prefix, "0-seed.manifest", "seed")
+    n_writers, n_ids = 4, 3000
+    writers = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                WRITER,
+                manifest_prefix,
+                f"writer{i}",
+                str(n_ids),
+            ],
+            cwd=pipeline_dir,
+            env={**os.environ, "STORAGE_ENVIRONMENT": "local"},
+        )
+        for i in range(n_writers)
+    ]
+    assert [writer.wait() for writer in writers] == [0] * n_writers
+
+    expected = {"seed"} | {
+        f"writer{i}-{j}" for i in range(n_writers) for j in range(n_ids)
+    }
+    assert set(Manifest(manifest_prefix)) == expected
@@ -0,0 +1,203 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from src.model import ENCODINGS, LSHModel
+from src.reduction import Reduction
+
+n_groups, n_clusters, group_dim = 4, 16, 8
+
+
+def make_model(reduction=None, encoding="text"):
+    rng = np.random.default_rng(0)
+    model = LSHModel(
+        n_groups=n_groups,
+        n_clusters=n_clusters,
+        encoding=encoding,
+        band_size=2 if encoding == "band" else 1,
+    )
+    model.centroids = rng.normal(
+        size=(n_groups, n_clusters, group_dim)
+    ).astype(np.float32)
+    if reduction is not None:
+        features = rng.normal(size=(256, 48)).astype(np.float32)
+        model.reduction = Reduction.fit(
+            features, reduction, n_groups * group_dim
+        )
+    return model
+
+
+def assert_same_model(loaded, model):
+    assert loaded.n_groups == model.n_groups
+    assert loaded.n_clusters == model.n_clusters
+    assert loaded.encoding == model.encoding
+    assert loaded.band_size == model.band_size
+    np.testing.assert_array_equal(loaded.centroids, model.centroids)
+    if model.reduction is None:
+        assert loaded.reduction is None
+    else:
+        assert loaded.reduction.method == model.reduction.method
+        np.testing.assert_array_equal(
+            loaded.reduction.mean, model.reduction.mean
+        )
+        np.testing.assert_array_equal(
+            loaded.reduction.components, model.reduction.components
+        )
+    features = np.random.default_rng(1).normal(
+        size=(32, model.input_dims[0])
+    )
+    assert loaded.predict_batch(features) == model.predict_batch(features)
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+@pytest.mark.parametrize("reduction", [None, "pca", "random"])
+def test_round_trip_through_a_file(tmp_path, reduction, encoding):
+    model = make_model(reduction, encoding)
+    model.save(tmp_path / "model.lsh")
+    assert_same_model(LSHModel(tmp_path / "model.lsh"), model)
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+@pytest.mark.parametrize("reduction", [None, "pca", "random"])
+def test_round_trip_through_bytes(reduction, encoding):
+    model = make_model(reduction, encoding)
+    model_bytes = BytesIO()
+    model.save(model_bytes)
+    assert_same_model(LSHModel(model_bytes=model_bytes.getvalue()), model)
+
+
+def test_centroids_are_memory_mapped_in_place(tmp_path):
+    make_model().save(tmp_path / "model.lsh")
+    loaded = LSHModel(tmp_path / "model.lsh")
+    assert isinstance(loaded.centroids, np.memmap)
+    assert loaded.centroids.offset % 64 == 0
+
+
+def test_reduction_is_memory_mapped_in_place(tmp_path):
+    make_model("pca").save(tmp_path / "model.lsh")
+    loaded = LSHModel(tmp_path / "model.lsh")
+    assert loaded.input_dims == (48, n_groups * group_dim)
+    assert loaded.reduction.components.shape == (48, n_groups * group_dim)
+
+
+def test_version_1_models_still_load():
+    model_bytes = BytesIO()
+    make_model().save(model_bytes)
+    data = model_bytes.getvalue().replace(b'"version": 2', b'"version": 1')
+    loaded = LSHModel(model_bytes=data)
+    assert loaded.reduction is None
+    np.testing.assert_array_equal(loaded.centroids, make_model().centroids)
+
+
+def test_legacy_pickled_models_are_converted(tmp_path):
+    from sklearn.cluster import KMeans
+
+    features = np.random.default_rng(0).normal(size=(64, 2 * group_dim))
+    models = [
+        KMeans(n_clusters=n_clusters, n_init=1, random_state=0).fit(group)
+        for group in np.split(features, 2, axis=1)
+    ]
+    legacy = np.empty(len(models), dtype=object)
+    legacy[:] = models
+    np.save(tmp_path / "model.npy", legacy, allow_pickle=True)
+
+    loaded = LSHModel(tmp_path / "model.npy")
+    assert loaded.centroids.shape == (2, n_clusters, group_dim)
+    np.testing.assert_allclose(
+        loaded.centroids[1], models[1].cluster_centers_, rtol=1e-6
+    )
+
+
+def test_unsupported_versions_are_refused():
+    model_bytes = BytesIO()
+    make_model().save(model_bytes)
+    data = model_bytes.getvalue().replace(b'"version": 2', b'"version": 9')
+    with pytest.raises(ValueError, match="version"):
+        LSHModel(model_bytes=data)
+
+
+def test_packed_tokens_are_unique_and_fixed_width():
+    model = make_model(encoding="packed")
+    tokens = [token for group in model.token_table() for token in group]
+    assert len(set(tokens)) == n_groups * n_clusters
+    assert {len(token) for token in tokens} == {2}
+
+
+def test_band_tokens_only_match_when_every_group_matches():
+    model = make_model(encoding="band")
+    tokens = model.encode([1, 2, 3, 4])
+    assert len(tokens) == model.n_tokens == n_groups // 2
+    assert len({len(token) for token in tokens}) == 1
+    # changing one group changes only its own band's token
+    changed = model.encode([1, 5, 3, 4])
+    assert changed[0] != tokens[0]
+    assert changed[1] == tokens[1]
+    # the same clusters in a different band make a different token
+    assert model.encode([3, 4, 3, 4])[0] != tokens[1]
+
+
+def test_incremental_training_honours_the_options(monkeypatch):
+    import src.model
+
+    calls = []
+    fit_group = src.model.fit_group
+
+    def spy(features, **kwargs):
+        calls.append(kwargs)
+        return fit_group(features, **kwargs)
+
+    monkeypatch.setattr(src.model, "fit_group", spy)
+    rng = np.random.default_rng(0)
+    batches = rng.normal(size=(3, 64, n_groups * group_dim))
+
+    def train(seed):
+        model = LSHModel(n_groups=n_groups, n_clusters=n_clusters)
+        for batch in batches:
+            model.partial_fit(batch, n_init=2, max_iter=7, seed=seed)
+        return model.centroids
+
+    centroids = train(seed=5)
+    # only the first batch is fitted from scratch, one group at a time, with
+    # the given options and seed + the group's index
+    assert calls == [
+        {
+            "n_clusters": n_clusters,
+            "minibatch": False,
+            "n_init": 2,
+            "max_iter": 7,
+            "random_state": 5 + i,
+        }
+        for i in range(n_groups)
+    ]
+    np.testing.assert_array_equal(train(seed=5), centroids)
+    assert not np.array_equal(train(seed=6), centroids)
+
+
+@pytest.mark.parametrize("reduction", [None, "pca"])
+def test_predictions_match_sklearn(reduction):
+    from sklearn.cluster import KMeans
+
+    rng = np.random.default_rng(1)
+    features = rng.normal(size=(500, n_groups * group_dim))
+    features = features.astype(np.float32)
+    model = LSHModel(n_groups=n_groups, n_clusters=n_clusters)
+    if reduction is not None:
+        wide = rng.normal(size=(500, 48)).astype(np.float32)
+        model.fit_reduction(wide, reduction, n_groups * group_dim)
+        features = wide
+    models = model.fit(features, n_jobs=1)
+    assert all(isinstance(group, KMeans) for group in models)
+
+    # a small batch size makes predictions span several chunks
+    clusters = model.predict_clusters(features, batch_size=64)
+    groups = np.split(model.reduce(features), n_groups, axis=1)
+    expected = np.stack(
+        [group.predict(x) for group, x in zip(models, groups)], axis=1
+    )
+    np.testing.assert_array_equal(clusters, expected)
+
+    # and a loaded model predicts the same clusters
+    model_bytes = BytesIO()
+    model.save(model_bytes)
+    loaded = LSHModel(model_bytes=model_bytes.getvalue())
+    np.testing.assert_array_equal(loaded.predict_clusters(features), expected)
@@ -0,0 +1,133 @@
+import os
+import signal
+import subprocess
+import sys
+from collections import Counter
+
+import pytest
+from src.io import Manifest
+from src.partition import Checkpoint, Partition, StreamPosition, partition_of
+
+from conftest import pipeline_dir
+
+# adds an image to the manifest for every row and checkpoints now and then,
+# as get-images does, until it's killed without any chance to clean up
+KILLED_WRITER = """
+import os
+import signal
+import sys
+
+from src.io import Manifest
+from src.partition import Checkpoint, Partition, StreamPosition
+
+prefix, step = sys.argv[1:]
+manifest = Manifest(prefix, flush_every=1000)
+checkpoint = Checkpoint(step, Partition(), run_id="run")
+stream_position = StreamPosition()
+for position in range(2500):
+    stream_position.start(position)
+    manifest.add(f"image-{position}")
+    stream_position.finish(position)
+    if position % 700 == 699:
+        checkpoint.save_position(stream_position, flush=[manifest])
+os.kill(os.getpid(), signal.SIGKILL)
+"""
+
+
+def test_partitions_are_stable():
+    # python's hash() would give different partitions in every process
+    assert [partition_of(f"id-{i}", 4) for i in range(8)] == [
+        0, 2, 0, 0, 2, 1, 0, 1
+    ]
+
+
+def test_partitions_are_disjoint_and_cover_every_id():
+    ids = [f"id-{i}" for i in range(4000)]
+    partitions = [Partition(index, 4) for index in range(4)]
+    owners = Counter()
+    for partition in partitions:
+        owners.update(partition.filter(ids))
+    assert set(owners) == set(ids)
+    assert set(owners.values()) == {1}
+    sizes = [len(list(partition.filter(ids))) for partition in partitions]
+    assert all(900 < size < 1100 for size in sizes)
+    assert all(item_id in Partition() for item_id in ids)
+
+
+def test_invalid_partitions_are_refused():
+    with pytest.raises(ValueError):
+        Partition(4, 4)
+    with pytest.raises(ValueError):
+        Partition(0, 0)
+
+
+def test_checkpoints_resume(checkpoint_step):
+    partitions = [Partition(index, 3) for index in range(3)]
+    checkpoint = Checkpoint(checkpoint_step, partitions[0], run_id="run")
+    assert checkpoint.state == {}
+    checkpoint.save(position=5, model_name="model")
+    checkpoint.mark_complete()
+    Checkpoint(checkpoint_step, partitions[1], run_id="run").save(position=9)
+
+    resumed = Checkpoint(checkpoint_step, partitions[0], run_id="run")
+    assert resumed.state == {
+        "position": 5,
+        "model_name": "model",
+        "complete": True,
+    }
+    assert resumed.complete
+    assert resumed.incomplete_partitions() == partitions[1:]
+    # each run keeps its own checkpoints
+    other_run = Checkpoint(checkpoint_step, partitions[0], run_id="other")
+    assert other_run.state == {}
+
+
+def test_checkpoints_without_a_run_id_are_not_saved(checkpoint_step):
+    checkpoint = Checkpoint(checkpoint_step, Partition(), run_id=None)
+    checkpoint.save(position=5)
+    assert checkpoint.state == {"position": 5}
+    assert Checkpoint(checkpoint_step, Partition(), run_id=None).state == {}
+
+
+def test_stream_position_waits_for_rows_in_flight():
+    stream_position = StreamPosition(10)
+    for position in range(10, 15):
+        stream_position.start(position)
+    stream_position.skip(15)
+    assert stream_position.finished == 10
+    # rows finish out of order, and the position only moves past a row once
+    # every row before it has finished too
+    for position in (12, 11, 14):
+        stream_position.finish(position)
+    assert stream_position.finished == 10
+    stream_position.finish(10)
+    assert stream_position.finished == 13
+    stream_position.finish(13)
+    assert stream_position.finished == 16
+
+
+def test_checkpointed_rows_survive_a_kill(manifest_prefix, checkpoint_step):
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            KILLED_WRITER,
+            manifest_prefix,
+            checkpoint_step,
+        ],
+        cwd=pipeline_dir,
+        env={**os.environ, "STORAGE_ENVIRONMENT": "local"},
+    )
+    assert process.returncode == -signal.SIGKILL
+
+    position = Checkpoint(
+        checkpoint_step, Partition(), run_id="run"
+    ).state["position"]
+    assert position == 2100
+    manifest = Manifest(manifest_prefix)
+    missing = [
+        position
+        for position in range(position)
+        if f"image-{position}" not in manifest
+    ]
+    assert not missing
@@ -0,0 +1,41 @@
+from collections import Counter
+
+import numpy as np
+from src.feature_store import FeatureStore
+from src.sampling import reservoir_sample, yield_training_batches
+
+
+def test_reservoir_sample_is_uniform():
+    counts = Counter()
+    for seed in range(4000):
+        sample = reservoir_sample(iter(range(50)), 10, seed=seed)
+        assert len(set(sample)) == 10
+        counts.update(sample)
+    # every item is sampled with probability 1/5
+    assert len(counts) == 50
+    assert all(abs(count - 800) < 120 for count in counts.values())
+
+
+def test_reservoir_sample_of_a_short_iterable():
+    assert reservoir_sample(range(3), 10) == [0, 1, 2]
+    assert reservoir_sample(range(3), 0) == []
+
+
+def test_reservoir_sample_is_seeded():
+    assert reservoir_sample(range(10000), 20, seed=1) == reservoir_sample(
+        range(10000), 20, seed=1
+    )
+
+
+def test_training_batches(store_name):
+    vectors = np.arange(200 * 4, dtype=np.float32).reshape(200, 4)
+    with FeatureStore(store_name, shard_size=30) as store:
+        store.append_many([str(i) for i in range(200)], vectors)
+
+    store = FeatureStore(store_name)
+    batches = list(yield_training_batches(store, batch_size=32, seed=0))
+    assert all(len(batch) == 32 for batch in batches[:-1])
+    rows = np.concatenate(batches)
+    # every row comes out exactly once, and shuffled
+    np.testing.assert_array_equal(np.sort(rows[:, 0]), vectors[:, 0])
+    assert not np.array_equal(rows[:, 0], vectors[:, 0])
@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+from src.feature_store import FeatureStore
+from src.model import LSHModel
+from src.search import SearchEngine, resolve_minimum_should_match
+
+n_groups, n_clusters, group_dim = 4, 16, 8
+
+
+def make_model(**kwargs):
+    model = LSHModel(n_groups=n_groups, n_clusters=n_clusters, **kwargs)
+    model.centroids = (
+        np.random.default_rng(0)
+        .normal(size=(n_groups, n_clusters, group_dim))
+        .astype(np.float32)
+    )
+    return model
+
+
+def make_engine(feature_store, **kwargs):
+    return SearchEngine(None, "test", make_model(), feature_store, **kwargs)
+
+
+def es_response(*ids):
+    return {
+        "hits": {
+            "hits": [
+                {"_id": document_id, "_score": float(len(ids) - rank)}
+                for rank, document_id in enumerate(ids)
+            ]
+        }
+    }
+
+
+@pytest.fixture
+def feature_store(store_name):
+    query = np.ones(n_groups * group_dim, dtype=np.float32)
+    with FeatureStore(store_name) as store:
+        # near is closer to the query than far
+        store.append("far", -query)
+        store.append("near", query + 0.1)
+    return FeatureStore(store_name)
+
+
+def test_stored_candidates_are_reranked(feature_store):
+    engine = make_engine(feature_store)
+    query = np.ones(n_groups * group_dim, dtype=np.float32)
+    response = engine.rerank(query, es_response("far", "near"))
+    assert [result.id for result in response.results] == ["near", "far"]
+    assert response.results[0].distance < response.results[1].distance
+
+
+def test_unstored_candidates_keep_their_place(feature_store):
+    engine = make_engine(feature_store)
+    query = np.ones(n_groups * group_dim, dtype=np.float32)
+    response = engine.rerank(
+        query, es_response("new", "far", "newer", "near"), exclude_id="x"
+    )
+    assert [result.id for result in response.results] == [
+        "new",
+        "near",
+        "newer",
+        "far",
+    ]
+    assert response.results[0].distance is None
+    assert response.results[0].matching_hashes == 4.0
+    assert response.n_candidates == 4
+
+
+def test_nothing_stored_yet(store_name):
+    engine = make_engine(FeatureStore(store_name), k=1)
+    query = np.ones(n_groups * group_dim, dtype=np.float32)
+    response = engine.rerank(query, es_response("new", "newer"))
+    assert [result.id for result in response.results] == ["new"]
+
+
+@pytest.mark.parametrize(
+    "encoding, band_size, n_probes, n_clauses",
+    [("text", 1, 5, 20), ("packed", 1, 5, 20), ("band", 2, 3, 18)],
+)
+def test_queries_within_the_clause_limit(
+    store_name, monkeypatch, encoding, band_size, n_probes, n_clauses
+):
+    monkeypatch.setattr("src.search.max_clause_count", 20)
+    engine = SearchEngine(
+        None,
+        "test",
+        make_model(encoding=encoding, band_size=band_size),
+        FeatureStore(store_name),
+        n_probes=n_probes,
+    )
+    query = np.ones((1, n_groups * group_dim), dtype=np.float32)
+    (hashes,) = engine.hash_batch(query)
+    body = engine.build_search_body(hashes)
+    assert len(body["query"]["bool"]["should"]) == n_clauses
+
+
+@pytest.mark.parametrize(
+    "encoding, band_size, n_probes",
+    [("text", 1, 6), ("packed", 1, 6), ("band", 2, 4)],
+)
+def test_queries_over_the_clause_limit(
+    store_name, monkeypatch, encoding, band_size, n_probes
+):
+    monkeypatch.setattr("src.search.max_clause_count", 20)
+    model = make_model(encoding=encoding, band_size=band_size)
+    with pytest.raises(ValueError, match="more than elasticsearch's limit"):
+        SearchEngine(
+            None, "test", model, FeatureStore(store_name), n_probes=n_probes
+        )
+
+
+def test_resolve_minimum_should_match():
+    assert resolve_minimum_should_match("50%", 4) == 2
+    assert resolve_minimum_should_match("75%", 10) == 7
+    # at least one token always has to match
+    assert resolve_minimum_should_match("10%", 4) == 1
+    assert resolve_minimum_should_match(3, 4) == 3
+
+
+def test_multi_probe_minimum_should_match(store_name):
+    engine = SearchEngine(
+        None,
+        "test",
+        make_model(encoding="band", band_size=2),
+        FeatureStore(store_name),
+        minimum_should_match="50%",
+        n_probes=3,
+    )
+    query = np.ones((1, n_groups * group_dim), dtype=np.float32)
+    (hashes,) = engine.hash_batch(query)
+    bool_query = engine.build_search_body(hashes)["query"]["bool"]
+    # half of a document's two bands, rather than half of the 18 clauses
+    assert bool_query["minimum_should_match"] == 1
+    assert len(bool_query["should"]) == 18
@@ -0,0 +1,155 @@
+import asyncio
+import importlib.util
+
+import numpy as np
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from conftest import pipeline_dir
+from elasticsearch import Elasticsearch
+from src.feature_store import FeatureStore
+from src.indexing import bulk_index
+from stand_ins import ElasticsearchStandIn
+from test_search import group_dim, make_model, n_groups
+
+dim = n_groups * group_dim
+
+# the service is a script in a directory which isn't a valid module name
+spec = importlib.util.spec_from_file_location(
+    "search_api", pipeline_dir / "search-api" / "main.py"
+)
+search_api = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(search_api)
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    stand_in = ElasticsearchStandIn()
+    monkeypatch.setenv("ELASTICSEARCH_URL", stand_in.url)
+    yield stand_in
+    stand_in.server.shutdown()
+
+
+@pytest.fixture
+def corpus(store_name, stand_in):
+    """Vectors which are stored, hashed and indexed, keyed by id"""
+    model = make_model()
+    vectors = np.random.default_rng(0).normal(size=(200, dim))
+    vectors = vectors.astype(np.float32)
+    ids = [str(i) for i in range(len(vectors))]
+    with FeatureStore(store_name) as store:
+        store.append_many(ids, vectors)
+    documents = zip(
+        ids,
+        ({"lsh-hash": hashes} for hashes in model.predict_batch(vectors)),
+    )
+    bulk_index(Elasticsearch(stand_in.url), "test", documents)
+    return model, dict(zip(ids, vectors))
+
+
+def serve(model, store_name, requests):
+    """Run a coroutine function against a client of the service"""
+
+    async def run():
+        app = search_api.create_app(model, FeatureStore(store_name), "test")
+        async with TestClient(TestServer(app)) as client:
+            return await requests(app, client)
+
+    return asyncio.run(run())
+
+
+def test_bad_queries_fail_alone():
+    def hash_batch(features):
+        if np.isnan(features).any():
+            raise ValueError("features must be finite")
+        return [f"hash of {row[0]:.0f}" for row in features]
+
+    async def run():
+        batcher = search_api.HashBatcher(hash_batch, 8, max_delay=0.05)
+        task = asyncio.create_task(batcher.run())
+        queries = [np.full(4, i, dtype=np.float32) for i in range(4)]
+        queries[2][1] = np.nan
+        results = await asyncio.gather(
+            *map(batcher.hash, queries), return_exceptions=True
+        )
+        later = await batcher.hash(np.full(4, 5, dtype=np.float32))
+        task.cancel()
+        return results, later
+
+    results, later = asyncio.run(run())
+    assert results[:2] == ["hash of 0", "hash of 1"]
+    assert isinstance(results[2], ValueError)
+    assert results[3] == "hash of 3"
+    assert later == "hash of 5"
+
+
+def test_wrong_dimension_is_a_bad_request(store_name, corpus):
+    model, vectors = corpus
+
+    async def requests(app, client):
+        wrong = await client.post("/search", json={"features": [1.0] * 3})
+        right = await client.post(
+            "/search", json={"features": vectors["7"].tolist()}
+        )
+        metrics = await (await client.get("/metrics")).json()
+        return wrong.status, await wrong.text(), right.status, metrics
+
+    status, text, later_status, metrics = serve(model, store_name, requests)
+    assert status == 400
+    assert f"length {dim}" in text
+    # the service carries on serving after a bad request
+    assert later_status == 200
+    assert metrics["errors"] == 1
+    assert metrics["requests"] == 1
+
+
+def test_concurrent_load(store_name, corpus):
+    model, vectors = corpus
+    n_requests = 300
+    rng = np.random.default_rng(1)
+    query_ids = [str(i) for i in rng.integers(0, len(vectors), n_requests)]
+    batches = []
+
+    async def search(client, i, image_id):
+        # alternate between searching by id and by vector
+        if i % 2:
+            response = await client.get("/search", params={"id": image_id})
+        else:
+            response = await client.post(
+                "/search", json={"features": vectors[image_id].tolist()}
+            )
+        assert response.status == 200
+        return await response.json()
+
+    async def requests(app, client):
+        batcher = app["batcher"]
+        hash_batch = batcher.hash_batch
+
+        def counting_hash_batch(features):
+            batches.append(len(features))
+            return hash_batch(features)
+
+        batcher.hash_batch = counting_hash_batch
+        responses = await asyncio.gather(
+            *(
+                search(client, i, image_id)
+                for i, image_id in enumerate(query_ids)
+            )
+        )
+        metrics = await (await client.get("/metrics")).json()
+        return responses, metrics
+
+    responses, metrics = serve(model, store_name, requests)
+    for i, (image_id, response) in enumerate(zip(query_ids, responses)):
+        result_ids = [result["id"] for result in response["results"]]
+        if i % 2:
+            # searches by id leave out the image itself
+            assert image_id not in result_ids
+        else:
+            assert result_ids[0] == image_id
+            assert response["results"][0]["distance"] < 1e-5
+    assert metrics["requests"] == n_requests
+    assert metrics["errors"] == 0
+    # concurrent queries are hashed together, and repeated ids are cached
+    assert sum(batches) < n_requests
+    assert len(batches) < sum(batches)
+    assert metrics["hash_cache_hits"] > 0
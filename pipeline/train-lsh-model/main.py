@@ -1,10 +1,13 @@
 from datetime import datetime
 
-import numpy as np
 import typer
-from src.io import load_features, save_model, yield_feature_filenames
+from src.feature_store import FeatureStore
+from src.io import save_model
 from src.log import get_logger
+from src.metrics import metrics
 from src.model import LSHModel
+from src.reduction import METHODS
+from src.sampling import reservoir_sample, yield_training_batches
 
 log = get_logger()
 app = typer.Typer()
@@ -13,7 +16,11 @@ app = typer.Typer()
 @app.command()
 def main(
     n_training_vectors: int = typer.Option(
-        10000, help="Number of training vectors to use"
+        10000,
+        help=(
+            "Number of training vectors to use, or 0 to stream every vector "
+            "in the store when training incrementally"
+        ),
     ),
     n_groups: int = typer.Option(
         256,
@@ -25,27 +32,151 @@ def main(
     n_clusters: int = typer.Option(
         256, help="Number of clusters to fit within each group"
     ),
+    n_jobs: int = typer.Option(
+        -1,
+        help=(
+            "Number of processes to train groups in parallel, "
+            "or -1 to use every CPU"
+        ),
+    ),
+    minibatch: bool = typer.Option(
+        False, help="Use MiniBatchKMeans instead of KMeans"
+    ),
+    n_init: int = typer.Option(
+        1, help="Number of times to run k-means with different seeds"
+    ),
+    max_iter: int = typer.Option(
+        300, help="Maximum number of k-means iterations for each run"
+    ),
+    seed: int = typer.Option(
+        0, help="Random seed, offset by the index of each group"
+    ),
+    incremental: bool = typer.Option(
+        False,
+        help=(
+            "Stream batches of training vectors into MiniBatchKMeans models "
+            "with partial_fit, rather than fitting in memory"
+        ),
+    ),
+    batch_size: int = typer.Option(
+        2048,
+        help=(
+            "Number of vectors in each incremental training batch, each of "
+            "which is one update step after the first"
+        ),
+    ),
+    read_workers: int = typer.Option(
+        4, help="Number of feature shards to read ahead when incremental"
+    ),
+    reduction: str = typer.Option(
+        "none",
+        help=(
+            "Reduce the features' dimensionality with pca or a random "
+            "projection before clustering them, or none"
+        ),
+    ),
+    n_components: int = typer.Option(
+        512,
+        help=(
+            "Number of dimensions to reduce features to, which must be "
+            "divisible by n_groups"
+        ),
+    ),
+    encoding: str = typer.Option(
+        "packed",
+        help=(
+            "How hashes are encoded as index tokens: text, packed (one "
+            "fixed-width hex token per group), or band (one token per band "
+            "of band_size groups)"
+        ),
+    ),
+    band_size: int = typer.Option(
+        2, help="Number of groups in each band, with the band encoding"
+    ),
 ):
+    if reduction != "none" and reduction not in METHODS:
+        raise typer.BadParameter(
+            f"must be one of none, {', '.join(METHODS)}",
+            param_hint="--reduction",
+        )
     timestamp = datetime.now().isoformat(timespec="seconds")
     log.info(
         f"Training LSH model with {n_training_vectors} training vectors, "
         f"{n_groups} groups, and {n_clusters} clusters"
     )
-    log.info("Loading features")
+    feature_store = FeatureStore()
+    try:
+        model = LSHModel(
+            n_groups=n_groups,
+            n_clusters=n_clusters,
+            encoding=encoding,
+            band_size=band_size,
+        )
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
 
-    filenames = list(yield_feature_filenames())
-    log.info(f"Selecting {n_training_vectors} training vectors")
-    random_indices = np.random.choice(
-        len(filenames), n_training_vectors, replace=False
-    )
-    training_filenames = [filenames[index] for index in random_indices]
-    training_features = np.vstack(
-        [load_features(filename) for filename in training_filenames]
-    )
+    if incremental:
+        if batch_size < n_clusters:
+            raise typer.BadParameter(
+                "must be at least n_clusters", param_hint="--batch-size"
+            )
+        log.info("Training model incrementally")
+        metrics.start_reporting()
+        batches = yield_training_batches(
+            feature_store,
+            batch_size=batch_size,
+            n_vectors=n_training_vectors or None,
+            seed=seed,
+            max_workers=read_workers,
+        )
+        n_batches = 0
+        for batch in batches:
+            if reduction != "none" and model.reduction is None:
+                log.info(f"Fitting {reduction} reduction on the first batch")
+                model.fit_reduction(batch, reduction, n_components, seed=seed)
+            # every call to partial_fit needs at least n_clusters rows
+            if len(batch) < n_clusters:
+                continue
+            with metrics.timer("fit", len(batch)):
+                model.partial_fit(
+                    batch,
+                    n_jobs=n_jobs,
+                    minibatch=minibatch,
+                    n_init=n_init,
+                    max_iter=max_iter,
+                    seed=seed,
+                )
+            n_batches += 1
+        if model.centroids is None:
+            raise ValueError("Not enough features to train a model")
+        if n_batches == 1:
+            log.warning(
+                "Only one batch was large enough to train on, so the model "
+                "was fitted to it without any incremental updates. Use a "
+                "smaller --batch-size or more --n-training-vectors"
+            )
+    else:
+        log.info(f"Sampling {n_training_vectors} training vectors")
+        training_ids = reservoir_sample(
+            feature_store.ids(), n_training_vectors, seed=seed
+        )
+        training_features = feature_store.get_many(training_ids)
+
+        if reduction != "none":
+            log.info(f"Fitting {reduction} reduction")
+            model.fit_reduction(
+                training_features, reduction, n_components, seed=seed
+            )
 
-    log.info("Training model")
-    model = LSHModel(n_groups=n_groups, n_clusters=n_clusters)
-    model.fit(training_features)
+        log.info("Training model")
+        model.fit(
+            training_features,
+            n_jobs=n_jobs,
+            minibatch=minibatch,
+            n_init=n_init,
+            max_iter=max_iter,
+            seed=seed,
+        )
 
     model_name = f"lsh-{timestamp}"
     log.info(f"Saving model {model_name}")
@@ -1,17 +1,34 @@
 set -euo pipefail
 
-# get the task name from the first argument
+# usage: scripts/run-task.sh <task name> [partition count] [partition index ...]
+#
+# launches one task per partition, each of which handles the ids that hash to
+# its partition index. every task in a run shares a RUN_ID, which names its
+# checkpoints. to resume a run, set RUN_ID to the id which was printed when
+# it was launched, optionally listing the partitions to relaunch
 TASK_NAME=$1
+PARTITION_COUNT=${2:-1}
+if [ $# -gt 2 ]; then
+  shift 2
+  PARTITION_INDICES="$*"
+else
+  PARTITION_INDICES=$(seq 0 $((PARTITION_COUNT - 1)))
+fi
+RUN_ID=${RUN_ID:-$(date +%Y%m%d%H%M%S)}
 
 # load environment variables from the .env file
 source .env
 
-# run the ecs task using the task name and the aws cli
-aws ecs run-task \
-  --cluster $AWS_ECS_CLUSTER_ARN \
-  --task-definition elastic-lsh-$TASK_NAME \
-  --profile $AWS_PROFILE \
-  --region $AWS_REGION \
-  --launch-type FARGATE \
-  --network-configuration "awsvpcConfiguration={subnets=[$AWS_ECS_SUBNET_ID],securityGroups=[$AWS_ECS_SECURITY_GROUP_ID],assignPublicIp=DISABLED}" \
+echo "Launching $TASK_NAME run $RUN_ID with $PARTITION_COUNT partitions"
 
+# run an ecs task for each partition using the aws cli
+for PARTITION_INDEX in $PARTITION_INDICES; do
+  aws ecs run-task \
+    --cluster $AWS_ECS_CLUSTER_ARN \
+    --task-definition elastic-lsh-$TASK_NAME \
+    --profile $AWS_PROFILE \
+    --region $AWS_REGION \
+    --launch-type FARGATE \
+    --network-configuration "awsvpcConfiguration={subnets=[$AWS_ECS_SUBNET_ID],securityGroups=[$AWS_ECS_SECURITY_GROUP_ID],assignPublicIp=DISABLED}" \
+    --overrides "{\"containerOverrides\": [{\"name\": \"elastic-lsh-$TASK_NAME\", \"environment\": [{\"name\": \"PARTITION_INDEX\", \"value\": \"$PARTITION_INDEX\"}, {\"name\": \"PARTITION_COUNT\", \"value\": \"$PARTITION_COUNT\"}, {\"name\": \"RUN_ID\", \"value\": \"$RUN_ID\"}]}]}"
+done